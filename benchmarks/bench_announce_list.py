@@ -0,0 +1,99 @@
+"""
+time to the first peers from an announce-list of loopback trackers with
+different latencies and failure modes. every tier is announced to at the
+same time, within a tier the trackers are tried one after the other.
+udp timeouts are scaled down by --udp-timeout.
+
+    python -m benchmarks.bench_announce_list --udp-timeout 0.5
+"""
+
+import random
+import asyncio
+import argparse
+
+from bittorrent.tracker import Announcer
+from bittorrent.timers import TimerWheel
+from .swarm import LocalTracker, LocalUdpTracker
+
+PEERS = [('127.0.0.{}'.format(i), 6881) for i in range(1, 21)]
+
+
+class StubTorrent():
+    info_hash = bytes(20)
+    peer_id = '-AS0001-000000000000'
+
+    def __init__(self, tiers):
+        self.announce_tiers = tiers
+
+
+async def first_peers(tiers, udp_timeout, timeout):
+    loop = asyncio.get_event_loop()
+    timers = TimerWheel(loop)
+    timers.start()
+    got = loop.create_future()
+
+    def on_peers(peers):
+        if peers and not got.done():
+            got.set_result(None)
+
+    announcer = Announcer(loop, timers, StubTorrent(tiers), lambda: (0, 0, 1), on_peers)
+    for tracker in announcer.trackers:
+        tracker.udp_timeout = udp_timeout
+    start = loop.time()
+    announcer.start()
+    try:
+        await asyncio.wait_for(got, timeout)
+        elapsed = loop.time() - start
+    except asyncio.TimeoutError:
+        elapsed = None
+    await announcer.stop()
+    timers.stop()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--udp-timeout', type=float, default=0.5)
+    parser.add_argument('--timeout', type=float, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    dead_udp = LocalUdpTracker(PEERS, drop=10**9)
+    fast_udp = LocalUdpTracker(PEERS)
+    slow_udp = LocalUdpTracker(PEERS, latency=0.3)
+    urls = {
+        'dead udp': loop.run_until_complete(dead_udp.start()),
+        'fast udp': loop.run_until_complete(fast_udp.start()),
+        'slow udp': loop.run_until_complete(slow_udp.start()),
+        'refused http': 'http://127.0.0.1:9/announce',
+    }
+    with LocalTracker(PEERS, latency=0.5) as slow_http, \
+            LocalTracker(PEERS, failure='unregistered torrent') as failing_http:
+        urls['slow http'] = slow_http.url
+        urls['failing http'] = failing_http.url
+
+        scenarios = [
+            [['dead udp']],
+            [['dead udp', 'slow http']],
+            [['refused http', 'failing http', 'fast udp']],
+            [['dead udp'], ['slow http'], ['slow udp']],
+            [['dead udp', 'refused http'], ['failing http'], ['slow udp', 'fast udp']],
+        ]
+        print('{:<70} {:>10}'.format('tiers', 'first peer'))
+        for scenario in scenarios:
+            tiers = [[urls[name] for name in tier] for tier in scenario]
+            elapsed = loop.run_until_complete(first_peers(tiers, args.udp_timeout, args.timeout))
+            label = ' | '.join(', '.join(tier) for tier in scenario)
+            print('{:<70} {:>10}'.format(label, 'never' if elapsed is None
+                                         else '{:.0f} ms'.format(elapsed * 1e3)))
+
+    for tracker in (dead_udp, fast_udp, slow_udp):
+        tracker.stop()
+    loop.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""
+cost of the BITFIELD path for big torrents: 1000 bitfields of 200k pieces,
+a third of them from seeds, parsed into Bitfields and checked for whether
+the peer has anything we need, against the old string based parsing,
+which also got the indexes wrong. the old parsing and adding a partial
+peer's pieces to the picker's availability are timed on a sample.
+
+    python -m benchmarks.bench_bitfield --bitfields 1000 --pieces 200000
+"""
+
+import time
+import random
+import argparse
+
+from bittorrent.bitfield import Bitfield
+from bittorrent.utils import Pieces
+from bittorrent.picker import PiecePicker
+from .swarm import SyntheticTorrent
+
+
+def old_parse(payload, number_of_pieces):
+    bitstring = ''.join([bin(x)[2:] for x in bytearray(payload)])
+    return [i for i, x in enumerate(bitstring) if x == '1' and i < number_of_pieces]
+
+
+def make_payloads(count, number_of_pieces, rng):
+    full = Bitfield.full(number_of_pieces).to_bytes()
+    payloads = []
+    for i in range(count):
+        if i % 3 == 0:
+            payloads.append(full)
+        else:
+            value = rng.getrandbits(number_of_pieces) & rng.getrandbits(number_of_pieces)
+            value <<= (-number_of_pieces) % 8
+            payloads.append(value.to_bytes((number_of_pieces + 7) // 8, 'big'))
+    return payloads
+
+
+def timed(func, items):
+    start = time.perf_counter()
+    results = [func(item) for item in items]
+    return (time.perf_counter() - start) / len(items), results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--bitfields', type=int, default=1000)
+    parser.add_argument('--pieces', type=int, default=200000)
+    parser.add_argument('--sample', type=int, default=10, help='bitfields for the slow paths')
+    args = parser.parse_args()
+
+    n = args.pieces
+    rng = random.Random(0)
+    payloads = make_payloads(args.bitfields, n, rng)
+    ours = Bitfield(n)
+    for index in range(0, n, 2):
+        ours.add(index)
+
+    print('{} bitfields of {} pieces'.format(args.bitfields, n))
+    print('{:<40} {:>14}'.format('', 'us/bitfield'))
+
+    sample = payloads[1:1 + args.sample]
+    per, old = timed(lambda p: old_parse(p, n), sample)
+    print('{:<40} {:>14.0f}'.format('old string parse', per * 1e6))
+    per, bitfields = timed(lambda p: Bitfield.from_bytes(p, n), payloads)
+    print('{:<40} {:>14.1f}'.format('Bitfield.from_bytes', per * 1e6))
+    wrong = sum(indexes != list(bitfields[1 + i]) for i, indexes in enumerate(old))
+    print('{:<40} {:>14}'.format('old parses with wrong indexes', '{} of {}'.format(wrong, len(old))))
+
+    per, _ = timed(lambda b: b.has_any_not_in(ours), bitfields)
+    print('{:<40} {:>14.1f}'.format('interested?', per * 1e6))
+    per, _ = timed(lambda b: len(b.difference(ours)), bitfields)
+    print('{:<40} {:>14.1f}'.format('pieces it has that we need', per * 1e6))
+
+    torrent = SyntheticTorrent(n * SyntheticTorrent.PIECE_LENGTH)
+    picker = PiecePicker(torrent, Pieces(torrent))
+    seeds = [b for b in bitfields if b.all()]
+    partial = [b for b in bitfields if not b.all()][:args.sample]
+    per, _ = timed(lambda b: picker.seed_joined(), seeds)
+    print('{:<40} {:>14.2f}'.format('availability, seed', per * 1e6))
+    per, _ = timed(picker.peer_has_pieces, partial)
+    print('{:<40} {:>14.0f}'.format('availability, partial peer', per * 1e6))
+    per, _ = timed(picker.peer_lost, partial)
+    print('{:<40} {:>14.0f}'.format('availability, partial peer leaves', per * 1e6))
+
+
+if __name__ == '__main__':
+    main()
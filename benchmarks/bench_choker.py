@@ -0,0 +1,103 @@
+"""
+the choker against simulated peers on a simulated clock. every peer has
+its own upload capacity and, tit-for-tat, only sends to us at full speed
+while we unchoke it, otherwise at a trickle. compares what we download
+with the choker against unchoking random peers each round, then times a
+choke round for bigger swarms.
+
+    python -m benchmarks.bench_choker --peers 40 --seconds 600
+"""
+
+import time
+import random
+import argparse
+
+from bittorrent.peer import Peer
+from bittorrent.choker import Choker, CHOKE_INTERVAL, DEFAULT_UPLOAD_SLOTS
+from .swarm import SyntheticTorrent
+
+TRICKLE = 0.02 # share of its capacity a peer sends while we choke it
+
+
+class Clock():
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class RandomChoker():
+    def __init__(self, upload_slots, rng):
+        self.upload_slots = upload_slots
+        self.rng = rng
+
+    def unchoke_set(self, peers, seeding):
+        return set(self.rng.sample(peers, min(self.upload_slots, len(peers))))
+
+
+def make_peers(count, clock, rng):
+    torrent = SyntheticTorrent(2**30)
+    peers = []
+    for i in range(count):
+        peer = Peer('10.0.0.{}'.format(i), 6881, torrent, clock=clock)
+        peer.interested = True
+        peer.choked = False
+        peer.capacity = int(rng.paretovariate(1.5) * 20 * 2**10) # bytes/s
+        peers.append(peer)
+    return peers
+
+
+def simulate(choker, peers, clock, seconds):
+    downloaded = 0
+    unchoke = set()
+    for second in range(seconds):
+        clock.now = float(second)
+        if second % CHOKE_INTERVAL == 0:
+            unchoke = choker.unchoke_set(peers, False)
+            for peer in peers:
+                peer.am_choking = peer not in unchoke
+        for peer in peers:
+            sent = peer.capacity if not peer.am_choking else int(peer.capacity * TRICKLE)
+            peer.download_rate.add(sent)
+            downloaded += sent
+    return downloaded / seconds, unchoke
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--peers', type=int, default=40)
+    parser.add_argument('--seconds', type=int, default=600)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    print('{:>12} {:>12} {:>16}'.format('choker', 'KiB/s', 'best peers kept'))
+    for name in ['tit-for-tat', 'random']:
+        clock = Clock()
+        rng = random.Random(args.seed)
+        peers = make_peers(args.peers, clock, rng)
+        best = set(sorted(peers, key=lambda p: p.capacity, reverse=True)[:DEFAULT_UPLOAD_SLOTS - 1])
+        if name == 'random':
+            choker = RandomChoker(DEFAULT_UPLOAD_SLOTS, rng)
+        else:
+            choker = Choker(clock=clock, rng=rng)
+        rate, unchoke = simulate(choker, peers, clock, args.seconds)
+        print('{:>12} {:>12.1f} {:>16}'.format(name, rate / 2**10, len(best & unchoke)))
+
+    print('{:>12} {:>12}'.format('peers', 'us/round'))
+    for count in [50, 200, 1000]:
+        clock = Clock()
+        rng = random.Random(args.seed)
+        peers = make_peers(count, clock, rng)
+        choker = Choker(clock=clock, rng=rng)
+        rounds = 200
+        start = time.perf_counter()
+        for i in range(rounds):
+            clock.now += CHOKE_INTERVAL
+            choker.unchoke_set(peers, False)
+        elapsed = time.perf_counter() - start
+        print('{:>12} {:>12.1f}'.format(count, elapsed / rounds * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""
+time to the last piece from loopback seeders where one of them is slow,
+with and without end game mode. the tail is the time from having 90% of
+the pieces to having all of them.
+
+    python -m benchmarks.bench_endgame --size 8 --latencies 0.02,0.02,0.02,2
+"""
+
+import time
+import argparse
+import asyncio
+import tempfile
+
+from bittorrent.client import TorrentClient
+from .swarm import make_torrent, random_content, LocalTracker, Seeder
+from .bench_pipeline import PIECE_LENGTH
+
+
+async def download(client, timeout):
+    task = asyncio.ensure_future(client.connect_to_peers())
+    start = time.monotonic()
+    ninety = None
+    total = client.torrent.number_of_pieces
+    try:
+        while len(client.pieces_downloaded) < total:
+            if time.monotonic() - start > timeout:
+                break
+            if ninety is None and len(client.pieces_downloaded) >= total * 0.9:
+                ninety = time.monotonic()
+            await asyncio.sleep(0.005)
+        end = time.monotonic()
+        return end - start, end - (ninety or end)
+    finally:
+        await client.stop()
+        task.cancel()
+
+
+def run(content, latencies, end_game, timeout):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    with tempfile.TemporaryDirectory() as tmp:
+        seeders = [Seeder(content, PIECE_LENGTH, latency) for latency in latencies]
+        addresses = [loop.run_until_complete(s.start()) for s in seeders]
+        with LocalTracker(addresses) as tracker:
+            torrent_path = make_torrent(tmp, tracker.url, content, PIECE_LENGTH)
+            client = TorrentClient(torrent_path, tmp, loop, end_game=end_game)
+            elapsed, tail = loop.run_until_complete(download(client, timeout))
+        for seeder in seeders:
+            loop.run_until_complete(seeder.stop())
+    loop.close()
+    return elapsed, tail, client.endgame.cancels
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--size', type=int, default=8, help='torrent size in MiB')
+    parser.add_argument('--latencies', default='0.02,0.02,0.02,2',
+                        help='seconds per request for each seeder')
+    parser.add_argument('--timeout', type=float, default=120)
+    args = parser.parse_args()
+
+    content = random_content(args.size * 2**20)
+    latencies = [float(x) for x in args.latencies.split(',')]
+    print('{} MiB, seeder latencies {}'.format(args.size, latencies))
+    print('{:>10} {:>10} {:>10} {:>10}'.format('end game', 'seconds', 'tail', 'cancels'))
+    for end_game in [False, True]:
+        elapsed, tail, cancels = run(content, latencies, end_game, args.timeout)
+        print('{:>10} {:>10.2f} {:>10.2f} {:>10}'.format(
+            'on' if end_game else 'off', elapsed, tail, cancels))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""
+download from a loopback swarm where some of the seeders sit behind a NAT:
+the tracker does not list them and they cannot be connected to, they
+connect to us instead. with the listener off only the reachable seeders
+are usable. one NATed seeder dials in twice with the same peer id, and
+the second connection has to be dropped.
+
+    python -m benchmarks.bench_inbound --size 8 --reachable 2 --natted 4
+"""
+
+import time
+import argparse
+import asyncio
+import tempfile
+
+from bittorrent.client import TorrentClient
+from .swarm import make_torrent, random_content, LocalTracker, Seeder
+from .bench_pipeline import PIECE_LENGTH
+
+
+async def dial(seeder, port, info_hash):
+    try:
+        await seeder.dial('127.0.0.1', port, info_hash)
+    except OSError:
+        pass
+
+
+async def download(client, natted, listen, timeout):
+    task = asyncio.ensure_future(client.connect_to_peers())
+    start = time.monotonic()
+    if listen:
+        while client.listener.server is None:
+            await asyncio.sleep(0.001)
+        port = client.listener.port
+    else:
+        port = 1 # nothing there, like a NATed peer trying to reach us
+    dials = [asyncio.ensure_future(dial(s, port, client.torrent.info_hash))
+             for s in natted + natted[:1]]
+    peers = 0
+    try:
+        while len(client.pieces_downloaded) < client.torrent.number_of_pieces:
+            if time.monotonic() - start > timeout:
+                break
+            peers = max(peers, len(client.active_peers))
+            await asyncio.sleep(0.005)
+        complete = len(client.pieces_downloaded) == client.torrent.number_of_pieces
+        return (time.monotonic() - start if complete else None), peers
+    finally:
+        await client.stop()
+        task.cancel()
+        for d in dials:
+            d.cancel()
+
+
+def run(content, reachable, natted, listen, latency, timeout):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    with tempfile.TemporaryDirectory() as tmp:
+        seeders = [Seeder(content, PIECE_LENGTH, latency) for _ in range(reachable)]
+        addresses = [loop.run_until_complete(s.start()) for s in seeders]
+        hidden = [Seeder(content, PIECE_LENGTH, latency) for _ in range(natted)]
+        with LocalTracker(addresses) as tracker:
+            torrent_path = make_torrent(tmp, tracker.url, content, PIECE_LENGTH)
+            client = TorrentClient(torrent_path, tmp, loop, port=0 if listen else None)
+            elapsed, peers = loop.run_until_complete(download(client, hidden, listen, timeout))
+        for seeder in seeders:
+            loop.run_until_complete(seeder.stop())
+    loop.close()
+    listener = client.listener
+    return elapsed, peers, listener.accepted if listener else 0, listener.refused if listener else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--size', type=int, default=8, help='torrent size in MiB')
+    parser.add_argument('--reachable', type=int, default=2)
+    parser.add_argument('--natted', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds per request')
+    parser.add_argument('--timeout', type=float, default=60)
+    args = parser.parse_args()
+
+    content = random_content(args.size * 2**20)
+    print('{} MiB, {} reachable and {} NATed seeders'.format(args.size, args.reachable, args.natted))
+    print('{:>10} {:>10} {:>8} {:>10} {:>10}'.format('listener', 'seconds', 'peers', 'accepted', 'refused'))
+    for listen in [False, True]:
+        elapsed, peers, accepted, refused = run(content, args.reachable, args.natted,
+                                                listen, args.latency, args.timeout)
+        print('{:>10} {:>10} {:>8} {:>10} {:>10}'.format(
+            'on' if listen else 'off', 'never' if elapsed is None else '{:.2f}'.format(elapsed),
+            peers, accepted, refused))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""
+loading the metadata of a big torrent, --pieces pieces over --files
+files. the old way decoded the file with bcoding, re-encoded the info dict
+for the info hash and split the piece hashes by slicing off the front of
+the string again and again, which is quadratic, so that part is timed
+on --sample pieces. now the info dict is only found for the hash, decoded
+by our own decoder or read from the cache, and the hashes are a view.
+
+piece_length is timed too, it used to add up every file on every call.
+
+    python -m benchmarks.bench_metainfo --pieces 500000 --files 100000
+"""
+
+import os
+import time
+import argparse
+import tempfile
+from hashlib import sha1
+
+from bcoding import bdecode, bencode
+
+from bittorrent.torrent import Torrent
+from .swarm import random_content
+
+
+def write_big_torrent(directory, pieces, files, piece_length):
+    total_length = pieces * piece_length
+    file_length = total_length // files
+    lengths = [file_length] * (files - 1)
+    lengths.append(total_length - sum(lengths))
+    hashes = random_content(pieces * 20)
+    info = {
+        'name': 'big',
+        'piece length': piece_length,
+        'pieces': hashes,
+        'files': [{'path': ['dir{}'.format(i // 1000), 'file{}'.format(i)], 'length': l}
+                  for i, l in enumerate(lengths)],
+    }
+    path = os.path.join(directory, 'big.torrent')
+    with open(path, 'wb') as f:
+        f.write(bencode({'announce': 'http://127.0.0.1:1/announce', 'info': info}))
+    return path
+
+
+def old_hash_list(pieces_hash):
+    piece_hash_list = []
+    while len(pieces_hash) > 0:
+        piece_hash_list.append(pieces_hash[0:20])
+        pieces_hash = pieces_hash[20:]
+    return piece_hash_list
+
+
+def old_piece_length(info, piece_index):
+    total_length = 0
+    for file_dict in info['files']:
+        total_length += file_dict['length']
+    piece_length = info['piece length']
+    if piece_index == total_length // piece_length:
+        return total_length % piece_length
+    return piece_length
+
+
+def timed(func, repeat=1, best_of=1):
+    """ cpu seconds per call, the best of `best_of` rounds of `repeat` calls """
+
+    best = None
+    for _ in range(best_of):
+        start = time.process_time()
+        for _ in range(repeat):
+            result = func()
+        elapsed = (time.process_time() - start) / repeat
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--pieces', type=int, default=500000)
+    parser.add_argument('--files', type=int, default=100000)
+    parser.add_argument('--piece-length', type=int, default=2**18)
+    parser.add_argument('--sample', type=int, default=50000, help='pieces for the quadratic split')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = write_big_torrent(directory, args.pieces, args.files, args.piece_length)
+        cache = os.path.join(directory, 'cache')
+        print('{} pieces, {} files, {:.1f} MiB .torrent'.format(
+            args.pieces, args.files, os.path.getsize(path) / 2**20))
+        print('{:<40} {:>12}'.format('', 'cpu seconds'))
+
+        with open(path, 'rb') as f:
+            data = f.read()
+        old_decode, metainfo = timed(lambda: bdecode(data))
+        print('{:<40} {:>12.3f}'.format('old: bcoding decode', old_decode))
+        old_hash, _ = timed(lambda: sha1(bencode(metainfo['info'])).digest())
+        print('{:<40} {:>12.3f}'.format('old: re-encode for the info hash', old_hash))
+        sample = metainfo['info']['pieces'][:args.sample * 20]
+        old_split, _ = timed(lambda: old_hash_list(sample))
+        estimate = old_split * (args.pieces / args.sample) ** 2
+        print('{:<40} {:>12.3f}'.format('old: split {} hashes'.format(args.sample), old_split))
+        print('{:<40} {:>12.0f}'.format('old: split all, quadratic estimate', estimate))
+        old_lookup, _ = timed(lambda: old_piece_length(metainfo['info'], 1), 20)
+        print('{:<40} {:>12.6f}'.format('old: piece_length', old_lookup))
+
+        cold, torrent = timed(lambda: Torrent(path), best_of=3)
+        print('{:<40} {:>12.3f}'.format('new: load', cold))
+        timed(lambda: Torrent(path, cache_dir=cache))
+        warm, cached = timed(lambda: Torrent(path, cache_dir=cache), best_of=3)
+        print('{:<40} {:>12.3f}'.format('new: load from the cache', warm))
+        lookup, _ = timed(lambda: torrent.piece_length(1), 100000)
+        print('{:<40} {:>12.9f}'.format('new: piece_length', lookup))
+
+        files = [(tuple(f['path']), f['length']) for f in metainfo['info']['files']]
+        same = (torrent.info_hash == cached.info_hash == sha1(bencode(metainfo['info'])).digest()
+                and torrent.files == cached.files == files
+                and torrent.piece_hash_list[args.pieces - 1] == metainfo['info']['pieces'][-20:])
+        print('{:<40} {:>12}'.format('same info hash, files and hashes', 'yes' if same else 'NO'))
+
+
+if __name__ == '__main__':
+    main()
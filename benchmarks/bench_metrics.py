@@ -0,0 +1,85 @@
+"""
+what the metrics cost. on the per message path: the debug line every
+message used to format, whether or not debug logging was on, against
+counting the message and putting a round trip into the histogram.
+and what one scrape of a busy client costs, with --peers connected
+peers in the prometheus text format and as json.
+
+    python -m benchmarks.bench_metrics --messages 1000000 --peers 500
+"""
+
+import json
+import time
+import random
+import logging
+import argparse
+
+from bittorrent.metrics import Metrics, Histogram, RTT_BUCKETS, PIECE_BUCKETS, VERIFY_BUCKETS
+
+
+def per_message(func, count):
+    start = time.perf_counter()
+    for i in range(count):
+        func(i)
+    return (time.perf_counter() - start) / count
+
+
+def synthetic_source(peers, rng):
+    labels = {'torrent': '%040x' % rng.getrandbits(160)}
+    histograms = []
+    for bounds in (RTT_BUCKETS, PIECE_BUCKETS, VERIFY_BUCKETS):
+        histogram = Histogram(bounds)
+        for _ in range(1000):
+            histogram.observe(rng.expovariate(10))
+        histograms.append(histogram)
+    addresses = ['10.0.{}.{}:6881'.format(i // 256, i % 256) for i in range(peers)]
+
+    def collect():
+        yield 'bittorrent_downloaded_bytes_total', labels, 2**30
+        yield 'bittorrent_peers', labels, peers
+        yield 'bittorrent_request_rtt_seconds', labels, histograms[0]
+        yield 'bittorrent_piece_seconds', labels, histograms[1]
+        yield 'bittorrent_verify_seconds', labels, histograms[2]
+        for address in addresses:
+            peer_labels = dict(labels, peer=address)
+            yield 'bittorrent_peer_downloaded_bytes_total', peer_labels, 2**20
+            yield 'bittorrent_peer_uploaded_bytes_total', peer_labels, 2**19
+    return collect
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--messages', type=int, default=1000000)
+    parser.add_argument('--peers', type=int, default=500)
+    parser.add_argument('--scrapes', type=int, default=100)
+    args = parser.parse_args()
+
+    logger = logging.getLogger('main.bench_metrics')
+    logger.setLevel(logging.INFO)
+    address = {'host': '10.0.0.1', 'port': 6881}
+    counts = {}
+    rtt = Histogram(RTT_BUCKETS)
+
+    def old(message_id):
+        logger.debug('Peer {} sent PIECE message'.format(address))
+
+    def new(message_id):
+        counts[message_id & 7] = counts.get(message_id & 7, 0) + 1
+        rtt.observe(0.02)
+
+    print('{:<40} {:>12}'.format('', 'ns/message'))
+    print('{:<40} {:>12.0f}'.format('debug line, debug logging off', per_message(old, args.messages) * 1e9))
+    print('{:<40} {:>12.0f}'.format('message count and rtt histogram', per_message(new, args.messages) * 1e9))
+
+    metrics = Metrics([synthetic_source(args.peers, random.Random(0))])
+    for label, render in [('prometheus text', metrics.prometheus),
+                          ('json snapshot', lambda: json.dumps(metrics.snapshot()))]:
+        start = time.perf_counter()
+        for _ in range(args.scrapes):
+            body = render()
+        per = (time.perf_counter() - start) / args.scrapes
+        print('{:<40} {:>9.2f} ms  {} KiB'.format('scrape, ' + label, per * 1e3, len(body) // 1024))
+
+
+if __name__ == '__main__':
+    main()
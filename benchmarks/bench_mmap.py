@@ -0,0 +1,98 @@
+"""
+throughput of the block receive path for the storage backends, from a
+PIECE message body to a verified piece on disk, and the heap bytes
+allocated per block on the way (every copy into a new object shows up
+there, copies into existing buffers and the mapping do not).
+
+pwrite is faster, but it assembles every piece in flight in a piece sized
+buffer from the pool, and the pool's size caps how many pieces can be in
+flight at once. mmap needs no buffers at all, which is what it is for:
+big pieces from many peers at once. the last column is that memory for
+--in-flight pieces.
+
+    python -m benchmarks.bench_mmap --size 256
+"""
+
+import os
+import time
+import struct
+import argparse
+import tempfile
+import tracemalloc
+from hashlib import sha1
+
+from bittorrent.utils import Pieces
+from bittorrent.file_manager import FileManager
+from .swarm import SyntheticTorrent
+
+
+def messages(torrent, content):
+    """ PIECE message bodies (without the id) for every block """
+
+    for index in range(torrent.number_of_pieces):
+        for i in range(torrent.blocks_per_piece(index)):
+            begin = i * torrent.REQUEST_LENGTH
+            start = index * torrent.info['piece length'] + begin
+            data = content[start:start + torrent.block_length(index, i)]
+            yield struct.pack('!ii', index, begin) + data
+
+
+def receive(file_manager, pieces, message):
+    """ the same steps TorrentClient._handle_piece_msg takes """
+
+    index, begin_offset = struct.unpack_from('!ii', message)
+    payload = memoryview(message)[8:]
+    block = {'index': index, 'begin_offset': begin_offset,
+             'request_length': len(payload), 'payload': payload}
+    piece_index, piece = pieces.add_received(block)
+    if piece_index is None:
+        return
+    if piece is None:
+        hashed = file_manager.hash_piece(piece_index)
+    else:
+        hashed = sha1(piece).digest()
+        file_manager.write(piece_index, piece)
+    pieces.release_piece(piece_index)
+    return hashed
+
+
+def run(storage, size):
+    torrent = SyntheticTorrent(size, files=4)
+    content = os.urandom(size)
+    bodies = list(messages(torrent, content))
+    with tempfile.TemporaryDirectory() as directory:
+        file_manager = FileManager(torrent, directory, storage=storage)
+        pieces = Pieces(torrent, store_blocks=not file_manager.writes_blocks,
+                        write_block=file_manager.write_block)
+
+        tracemalloc.start()
+        allocated = 0
+        start = time.perf_counter()
+        for body in bodies:
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            receive(file_manager, pieces, body)
+            allocated += tracemalloc.get_traced_memory()[1] - before
+        elapsed = time.perf_counter() - start
+        tracemalloc.stop()
+        file_manager.close()
+    buffer_bytes = torrent.piece_length(0) if pieces.store_blocks else 0
+    return size / elapsed / 2**20, allocated / len(bodies), buffer_bytes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--size', type=int, default=256, help='torrent size in MiB')
+    parser.add_argument('--in-flight', type=int, default=64, help='pieces being downloaded at once')
+    args = parser.parse_args()
+
+    print('{:>8} {:>10} {:>22} {:>18}'.format('storage', 'MiB/s', 'bytes allocated/block',
+                                              'piece buffers MiB'))
+    for storage in ('pwrite', 'mmap'):
+        rate, per_block, buffer_bytes = run(storage, args.size * 2**20)
+        print('{:>8} {:>10.1f} {:>22.0f} {:>18.0f}'.format(
+            storage, rate, per_block, buffer_bytes * args.in_flight / 2**20))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+"""
+socket writes per MiB downloaded from loopback seeders. before the
+outbound queue every message was its own write followed by a drain,
+so the message count is what the old client would have needed.
+
+    python -m benchmarks.bench_outbound --size 16 --seeders 2
+"""
+
+import argparse
+import asyncio
+import tempfile
+
+from bittorrent.client import TorrentClient
+from .swarm import make_torrent, random_content, LocalTracker, Seeder
+from .bench_pipeline import download, PIECE_LENGTH
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--size', type=int, default=16, help='torrent size in MiB')
+    parser.add_argument('--seeders', type=int, default=2)
+    parser.add_argument('--latency', type=float, default=0.02)
+    args = parser.parse_args()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    with tempfile.TemporaryDirectory() as tmp:
+        content = random_content(args.size * 2**20)
+        seeders = [Seeder(content, PIECE_LENGTH, args.latency) for _ in range(args.seeders)]
+        addresses = [loop.run_until_complete(s.start()) for s in seeders]
+        with LocalTracker(addresses) as tracker:
+            torrent_path = make_torrent(tmp, tracker.url, content, PIECE_LENGTH)
+            client = TorrentClient(torrent_path, tmp, loop)
+            loop.run_until_complete(download(client, 120))
+        for seeder in seeders:
+            loop.run_until_complete(seeder.stop())
+    loop.close()
+
+    mib = len(client.pieces_downloaded) * PIECE_LENGTH / 2**20
+    queues = [peer.outbound for peer in client.peers if peer.outbound is not None]
+    sent = sum(q.messages for q in queues)
+    writes = sum(q.writes for q in queues)
+    print('downloaded {:.1f} MiB'.format(mib))
+    print('{:>26} {:>10.1f}'.format('writes/MiB before (1/msg)', sent / mib))
+    print('{:>26} {:>10.1f}'.format('writes/MiB after', writes / mib))
+
+
+if __name__ == '__main__':
+    main()
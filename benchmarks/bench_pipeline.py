@@ -0,0 +1,66 @@
+"""
+download throughput from one loopback seeder with injected latency
+for different caps on the number of outstanding requests.
+
+    python -m benchmarks.bench_pipeline --latency 0.05 --size 8
+"""
+
+import time
+import argparse
+import asyncio
+import tempfile
+
+from bittorrent.client import TorrentClient
+from .swarm import make_torrent, random_content, LocalTracker, Seeder
+
+PIECE_LENGTH = 2**18
+
+
+async def download(client, timeout):
+    task = asyncio.ensure_future(client.connect_to_peers())
+    start = time.monotonic()
+    try:
+        while len(client.pieces_downloaded) < client.torrent.number_of_pieces:
+            if time.monotonic() - start > timeout:
+                break
+            await asyncio.sleep(0.01)
+        return time.monotonic() - start
+    finally:
+        await client.stop()
+        task.cancel()
+
+
+def run(max_requests, latency, size, timeout):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    with tempfile.TemporaryDirectory() as tmp:
+        content = random_content(size)
+        seeder = Seeder(content, PIECE_LENGTH, latency)
+        address = loop.run_until_complete(seeder.start())
+        with LocalTracker([address]) as tracker:
+            torrent_path = make_torrent(tmp, tracker.url, content, PIECE_LENGTH)
+            client = TorrentClient(torrent_path, tmp, loop, max_requests)
+            elapsed = loop.run_until_complete(download(client, timeout))
+            done = len(client.pieces_downloaded) * PIECE_LENGTH
+        loop.run_until_complete(seeder.stop())
+    loop.close()
+    return done / elapsed / 2**20, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds per request')
+    parser.add_argument('--size', type=int, default=8, help='torrent size in MiB')
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--windows', default='1,2,4,8,16,32,64,128')
+    args = parser.parse_args()
+
+    print('latency {}s, {} MiB'.format(args.latency, args.size))
+    print('{:>8} {:>10} {:>10}'.format('max N', 'MiB/s', 'seconds'))
+    for n in [int(x) for x in args.windows.split(',')]:
+        rate, elapsed = run(n, args.latency, args.size * 2**20, args.timeout)
+        print('{:>8} {:>10.2f} {:>10.2f}'.format(n, rate, elapsed))
+
+
+if __name__ == '__main__':
+    main()
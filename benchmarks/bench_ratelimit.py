@@ -0,0 +1,138 @@
+"""
+accuracy, fairness and cost of the token bucket rate limits, on a
+simulated clock so nothing actually has to wait.
+
+greedy peers send 16 KiB blocks as fast as their throttles let them,
+through a per-peer, a torrent and a session bucket. half way through the
+session cap is changed, as a user would at runtime. reported are the
+achieved rates against the caps and Jain's fairness index over the peers
+without a cap of their own (1.0 is a perfectly even split). the cost is
+wall time per ready() + take() on a real clock, with and without limits.
+
+    python -m benchmarks.bench_ratelimit --peers 50 --seconds 60
+"""
+
+import time
+import heapq
+import argparse
+
+from bittorrent.ratelimit import TokenBucket, Throttle
+
+BLOCK = 2**14
+
+
+class SimulatedLoop():
+    """ the two things a bucket needs from the loop, with time jumping to the next timer """
+
+    class Handle():
+        def __init__(self):
+            self.cancelled = False
+
+        def cancel(self):
+            self.cancelled = True
+
+    def __init__(self):
+        self.now = 0.0
+        self.timers = []
+        self.sequence = 0
+
+    def time(self):
+        return self.now
+
+    def call_later(self, delay, callback, *args):
+        handle = self.Handle()
+        self.sequence += 1
+        heapq.heappush(self.timers, (self.now + delay, self.sequence, handle, callback, args))
+        return handle
+
+    def run_until(self, end):
+        while self.timers and self.timers[0][0] <= end:
+            when, _, handle, callback, args = heapq.heappop(self.timers)
+            self.now = when
+            if not handle.cancelled:
+                callback(*args)
+        self.now = end
+
+
+class GreedyPeer():
+
+    def __init__(self, loop, buckets):
+        self.throttle = Throttle(loop, buckets)
+        self.sent = 0
+
+    def send(self):
+        while self.throttle.ready(self.send):
+            self.throttle.take(BLOCK)
+            self.sent += BLOCK
+
+
+def jain(values):
+    return sum(values) ** 2 / (len(values) * sum(v * v for v in values)) if values else 1.0
+
+
+def simulate(peers, capped, peer_rate, torrent_rate, session_rate, new_session_rate, seconds):
+    loop = SimulatedLoop()
+    session = TokenBucket(loop, session_rate)
+    torrent = TokenBucket(loop, torrent_rate)
+    swarm = [GreedyPeer(loop, [TokenBucket(loop, peer_rate if i < capped else None), torrent, session])
+             for i in range(peers)]
+    halves = []
+    for rate in [session_rate, new_session_rate]:
+        session.set_rate(rate)
+        before = [p.sent for p in swarm]
+        start = loop.now
+        for peer in swarm:
+            peer.send()
+        loop.run_until(start + seconds / 2)
+        sent = [p.sent - b for p, b in zip(swarm, before)]
+        halves.append((rate, sent))
+    return halves
+
+
+def cost(limited, calls):
+    loop = SimulatedLoop()
+    rate = 1e15 if limited else None
+    peer = GreedyPeer(loop, [TokenBucket(loop, rate), TokenBucket(loop, rate), TokenBucket(loop, rate)])
+    throttle = peer.throttle
+    start = time.perf_counter()
+    for _ in range(calls):
+        if throttle.ready(peer.send):
+            throttle.take(BLOCK)
+    return (time.perf_counter() - start) / calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--peers', type=int, default=50)
+    parser.add_argument('--capped', type=int, default=10, help='peers with a cap of their own')
+    parser.add_argument('--peer-rate', type=float, default=20, help='KiB/s')
+    parser.add_argument('--torrent-rate', type=float, default=4096, help='KiB/s')
+    parser.add_argument('--session-rate', type=float, default=1024, help='KiB/s')
+    parser.add_argument('--new-session-rate', type=float, default=2048, help='KiB/s')
+    parser.add_argument('--seconds', type=float, default=60, help='simulated')
+    parser.add_argument('--calls', type=int, default=200000)
+    args = parser.parse_args()
+
+    halves = simulate(args.peers, args.capped, args.peer_rate * 1024, args.torrent_rate * 1024,
+                      args.session_rate * 1024, args.new_session_rate * 1024, args.seconds)
+    span = args.seconds / 2
+    print('{} peers, {} capped at {:.0f} KiB/s, torrent cap {:.0f} KiB/s'.format(
+        args.peers, args.capped, args.peer_rate, args.torrent_rate))
+    print('{:>14} {:>14} {:>10} {:>16} {:>10}'.format(
+        'session cap', 'achieved', 'error', 'capped peers', 'fairness'))
+    for rate, sent in halves:
+        expected = min(rate, args.torrent_rate * 1024)
+        achieved = sum(sent) / span
+        capped = sent[:args.capped]
+        capped_rate = sum(capped) / len(capped) / span / 1024 if capped else 0
+        print('{:>9.0f} KiB/s {:>8.0f} KiB/s {:>9.2f}% {:>10.1f} KiB/s {:>10.4f}'.format(
+            rate / 1024, achieved / 1024, (achieved - expected) / expected * 100,
+            capped_rate, jain(sent[args.capped:])))
+
+    print('{:>14} {:>14}'.format('limits', 'ns/message'))
+    for limited in [False, True]:
+        print('{:>14} {:>14.0f}'.format('on' if limited else 'off', cost(limited, args.calls) * 1e9))
+
+
+if __name__ == '__main__':
+    main()
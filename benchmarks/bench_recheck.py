@@ -0,0 +1,81 @@
+"""
+throughput of the startup recheck over a synthetic torrent already on disk,
+for different numbers of hashing threads. the data is written right before
+the check, so unless the page cache is dropped in between (as root:
+`sync; echo 3 > /proc/sys/vm/drop_caches`) this measures hashing more than disk.
+
+    python -m benchmarks.bench_recheck --size 4096 --files 16
+"""
+
+import os
+import time
+import asyncio
+import argparse
+import tempfile
+from hashlib import sha1
+from concurrent.futures import ThreadPoolExecutor
+
+from bittorrent.file_manager import FileManager
+from bittorrent.resume import recheck, RECHECK_AHEAD
+from .swarm import SyntheticTorrent
+
+
+def write_torrent(torrent, directory):
+    """ fill the torrent's files with random data and record the piece hashes """
+
+    piece_length = torrent.info['piece length']
+    torrent.piece_hash_list = []
+    dir_path = os.path.join(directory, torrent.info['name'])
+    os.makedirs(dir_path)
+    paths = [os.path.join(dir_path, *f['path']) for f in torrent.info['files']]
+    lengths = [f['length'] for f in torrent.info['files']]
+
+    current = 0
+    out = open(paths[0], 'wb')
+    left_in_file = lengths[0]
+    for index in range(torrent.number_of_pieces):
+        data = os.urandom(torrent.piece_length(index))
+        torrent.piece_hash_list.append(sha1(data).digest())
+        while data:
+            while left_in_file == 0:
+                out.close()
+                current += 1
+                out = open(paths[current], 'wb')
+                left_in_file = lengths[current]
+            chunk = data[:left_in_file]
+            out.write(chunk)
+            left_in_file -= len(chunk)
+            data = data[len(chunk):]
+    out.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--size', type=int, default=2048, help='torrent size in MiB')
+    parser.add_argument('--files', type=int, default=8)
+    parser.add_argument('--piece-length', type=int, default=2**20)
+    parser.add_argument('--workers', default='1,2,4,{}'.format(os.cpu_count() or 2))
+    args = parser.parse_args()
+
+    torrent = SyntheticTorrent(args.size * 2**20, args.piece_length, args.files)
+    with tempfile.TemporaryDirectory() as directory:
+        write_torrent(torrent, directory)
+        print('{:>8} {:>10} {:>10} {:>8}'.format('workers', 'seconds', 'MiB/s', 'good'))
+        for workers in [int(x) for x in args.workers.split(',')]:
+            file_manager = FileManager(torrent, directory)
+            loop = asyncio.new_event_loop()
+            with ThreadPoolExecutor(workers) as executor:
+                def hash_piece(index):
+                    return loop.run_in_executor(executor, file_manager.hash_piece, index)
+                start = time.perf_counter()
+                good = loop.run_until_complete(
+                        recheck(torrent, file_manager, hash_piece, workers * RECHECK_AHEAD))
+                elapsed = time.perf_counter() - start
+            loop.close()
+            file_manager.close()
+            print('{:>8} {:>10.2f} {:>10.1f} {:>8}'.format(
+                workers, elapsed, args.size / elapsed, len(good)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+"""
+many small torrents on one event loop, each with its own loopback seeder
+and udp tracker: memory, threads and cpu time per torrent while they
+download and once they sit idle, for one Session against the same
+torrents run as separate TorrentClients.
+
+memory is what tracemalloc sees allocated by the clients, so it leaves
+out thread stacks, which the thread count stands for.
+
+    python -m benchmarks.bench_session --torrents 100 --size 256
+"""
+
+import os
+import time
+import argparse
+import asyncio
+import tempfile
+import threading
+import tracemalloc
+
+from bittorrent.client import TorrentClient
+from bittorrent.session import Session
+from .swarm import make_torrent, random_content, LocalUdpTracker, Seeder
+
+PIECE_LENGTH = 2**16
+
+
+class Separate():
+    """ the torrents as independent clients, for comparison """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.clients = []
+        self.tasks = []
+
+    async def start(self):
+        pass
+
+    def add_torrent(self, torrent_file, destination):
+        client = TorrentClient(torrent_file, destination, self.loop, port=0)
+        self.clients.append(client)
+        self.tasks.append(self.loop.create_task(client.connect_to_peers()))
+        return client
+
+    async def stop(self):
+        await asyncio.gather(*[client.stop() for client in self.clients])
+        for task in self.tasks:
+            task.cancel()
+
+
+async def run(kind, contents, idle, timeout):
+    loop = asyncio.get_event_loop()
+    with tempfile.TemporaryDirectory() as tmp:
+        seeders, trackers, torrents = [], [], []
+        for i, content in enumerate(contents):
+            seeder = Seeder(content, PIECE_LENGTH)
+            tracker = LocalUdpTracker([await seeder.start()])
+            url = await tracker.start()
+            directory = os.path.join(tmp, str(i))
+            os.mkdir(directory)
+            torrents.append((make_torrent(directory, url, content, PIECE_LENGTH), directory))
+            seeders.append(seeder)
+            trackers.append(tracker)
+
+        tracemalloc.start()
+        base = tracemalloc.get_traced_memory()[0]
+        if kind == 'session':
+            runner = Session(loop, port=0)
+        else:
+            runner = Separate(loop)
+        await runner.start()
+        cpu = time.process_time()
+        start = time.monotonic()
+        clients = [runner.add_torrent(path, directory) for path, directory in torrents]
+        while time.monotonic() - start < timeout:
+            if all(len(c.pieces_downloaded) == c.torrent.number_of_pieces for c in clients):
+                break
+            await asyncio.sleep(0.01)
+        elapsed = time.monotonic() - start
+        download_cpu = time.process_time() - cpu
+        complete = sum(len(c.pieces_downloaded) == c.torrent.number_of_pieces for c in clients)
+        memory, peak = tracemalloc.get_traced_memory()
+        threads = threading.active_count()
+
+        cpu = time.process_time()
+        await asyncio.sleep(idle)
+        idle_cpu = time.process_time() - cpu
+        idle_memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        await runner.stop()
+        for seeder, tracker in zip(seeders, trackers):
+            await seeder.stop()
+            tracker.stop()
+
+    n = len(contents)
+    return {
+        'complete': complete,
+        'seconds': elapsed,
+        'threads': threads,
+        'peak KiB/torrent': (peak - base) / n / 1024,
+        'idle KiB/torrent': (idle_memory - base) / n / 1024,
+        'download cpu ms/torrent': download_cpu / n * 1e3,
+        'idle cpu ms/torrent/s': idle_cpu / n / idle * 1e3,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--torrents', type=int, default=100)
+    parser.add_argument('--size', type=int, default=256, help='torrent size in KiB')
+    parser.add_argument('--idle', type=float, default=3, help='seconds to measure idle cpu over')
+    parser.add_argument('--timeout', type=float, default=120)
+    args = parser.parse_args()
+
+    contents = [random_content(args.size * 1024, seed=i) for i in range(args.torrents)]
+    print('{} torrents of {} KiB'.format(args.torrents, args.size))
+    results = {}
+    for kind in ['separate', 'session']:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        results[kind] = loop.run_until_complete(run(kind, contents, args.idle, args.timeout))
+        loop.close()
+
+    print('{:>24} {:>10} {:>10}'.format('', 'separate', 'session'))
+    for key in results['session']:
+        print('{:>24} {:>10.1f} {:>10.1f}'.format(
+            key, results['separate'][key], results['session'][key]))
+
+
+if __name__ == '__main__':
+    main()
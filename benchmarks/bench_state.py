@@ -0,0 +1,68 @@
+"""
+memory used by the shared block state and piece picker,
+and the time it takes to pick a block, for torrents of different sizes.
+
+    python -m benchmarks.bench_state --pieces 1000,100000,1000000
+"""
+
+import time
+import random
+import argparse
+import tracemalloc
+
+from bittorrent.utils import Pieces
+from bittorrent.bitfield import Bitfield
+from bittorrent.picker import PiecePicker
+from .swarm import SyntheticTorrent
+
+
+def run(number_of_pieces, peers, picks):
+    torrent = SyntheticTorrent(number_of_pieces * SyntheticTorrent.PIECE_LENGTH)
+    rng = random.Random(number_of_pieces)
+    peer_pieces = []
+    for _ in range(peers):
+        have = Bitfield(number_of_pieces)
+        for index in range(number_of_pieces):
+            if rng.random() < 0.5:
+                have.add(index)
+        peer_pieces.append(have)
+
+    tracemalloc.start()
+    pieces = Pieces(torrent)
+    picker = PiecePicker(torrent, pieces, random_first=0)
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    for have in peer_pieces:
+        for index in have:
+            picker.peer_has(index)
+
+    start = time.perf_counter()
+    done = 0
+    for i in range(picks):
+        block = picker.pick(peer_pieces[i % peers])
+        if block is None:
+            break
+        if pieces.all_requested(block['index']):
+            # pretend the piece arrived so the buffer pool never runs dry
+            pieces.release_piece(block['index'])
+        done += 1
+    elapsed = time.perf_counter() - start
+    return memory, elapsed / max(done, 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--pieces', default='1000,100000,1000000')
+    parser.add_argument('--peers', type=int, default=8)
+    parser.add_argument('--picks', type=int, default=20000)
+    args = parser.parse_args()
+
+    print('{:>10} {:>12} {:>14}'.format('pieces', 'memory MiB', 'us per pick'))
+    for n in [int(x) for x in args.pieces.split(',')]:
+        memory, per_pick = run(n, args.peers, args.picks)
+        print('{:>10} {:>12.2f} {:>14.2f}'.format(n, memory / 2**20, per_pick * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""
+time and peak RSS for writing a whole torrent to disk, comparing the
+old temporary file + stitch approach with positional writes straight
+into the destination files. each run happens in its own process.
+
+    python -m benchmarks.bench_storage --size 1024 --files 8
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import resource
+import tempfile
+import subprocess
+
+from bittorrent.file_manager import FileManager
+from .swarm import SyntheticTorrent
+
+
+def pieces_in_random_order(torrent):
+    order = list(range(torrent.number_of_pieces))
+    random.Random(0).shuffle(order)
+    data = os.urandom(torrent.info['piece length'])
+    for index in order:
+        yield index, memoryview(data)[:torrent.piece_length(index)]
+
+
+def write_via_tmp(torrent, directory):
+    """ what FileManager used to do """
+
+    tmp_path = os.path.join(directory, 'tmp.tmp')
+    piece_length = torrent.info['piece length']
+    with open(tmp_path, 'w+b') as tmp:
+        for index, data in pieces_in_random_order(torrent):
+            tmp.seek(index * piece_length)
+            tmp.write(data)
+    with open(tmp_path, 'rb') as tmp:
+        content = tmp.read()
+    for f in torrent.info['files']:
+        with open(os.path.join(directory, f['path'][0]), 'wb') as out:
+            out.write(content[:f['length']])
+            content = content[f['length']:]
+
+
+def write_direct(torrent, directory):
+    file_manager = FileManager(torrent, directory)
+    for index, data in pieces_in_random_order(torrent):
+        file_manager.write(index, data)
+    file_manager.close()
+
+
+def child(mode, size, files):
+    torrent = SyntheticTorrent(size, files=files)
+    with tempfile.TemporaryDirectory() as directory:
+        start = time.perf_counter()
+        if mode == 'tmp':
+            write_via_tmp(torrent, directory)
+        else:
+            write_direct(torrent, directory)
+        os.sync()
+        elapsed = time.perf_counter() - start
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({'mode': mode, 'seconds': elapsed, 'peak_rss_kib': rss}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--size', type=int, default=1024, help='torrent size in MiB')
+    parser.add_argument('--files', type=int, default=8)
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    size = args.size * 2**20
+    if args.child:
+        child(args.child, size, args.files)
+        return
+
+    print('{:>8} {:>10} {:>14}'.format('mode', 'seconds', 'peak RSS MiB'))
+    for mode in ('tmp', 'direct'):
+        out = subprocess.check_output([sys.executable, '-m', 'benchmarks.bench_storage',
+            '--size', str(args.size), '--files', str(args.files), '--child', mode])
+        result = json.loads(out.decode())
+        print('{:>8} {:>10.2f} {:>14.1f}'.format(
+            mode, result['seconds'], result['peak_rss_kib'] / 1024))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""
+playing the first file of a torrent while it downloads from loopback
+seeders that each have part of the pieces, with every peer held to
+--peer-rate. a player reads the file front to back at --bitrate;
+time to first byte is how long the first read took, a stall is a later
+read that had to wait for data by more than STALL_THRESHOLD.
+
+compared are plain rarest first, streaming with deadlines on the pieces
+ahead of the player, and streaming with the second file skipped.
+
+    python -m benchmarks.bench_streaming --size 32 --bitrate 4 --peer-rate 1
+"""
+
+import random
+import argparse
+import asyncio
+import tempfile
+
+from bittorrent.client import TorrentClient
+from bittorrent.picker import SKIP
+from .swarm import make_torrent, random_content, LocalTracker, Seeder
+
+PIECE_LENGTH = 2**18
+CHUNK = 2**18
+STALL_THRESHOLD = 0.01
+
+
+async def play(client, bitrate, timeout):
+    loop = asyncio.get_event_loop()
+    length = client.file_manager.files[0]['length']
+    start = loop.time()
+    await client.read(0, 0, CHUNK)
+    ttfb = loop.time() - start
+    playing = loop.time()
+    consumed = CHUNK
+    stalls = 0
+    stalled = 0.0
+    while consumed < length and loop.time() - start < timeout:
+        due = playing + consumed / bitrate + stalled
+        await asyncio.sleep(max(0, due - loop.time()))
+        asked = loop.time()
+        data = await client.read(0, consumed, CHUNK)
+        late = loop.time() - asked
+        if late > STALL_THRESHOLD:
+            stalls += 1
+            stalled += late
+        consumed += len(data)
+    return ttfb, stalls, stalled, loop.time() - start
+
+
+def run(content, holdings, latency, peer_rate, bitrate, window, skip, timeout):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    with tempfile.TemporaryDirectory() as tmp:
+        seeders = [Seeder(content, PIECE_LENGTH, latency, pieces) for pieces in holdings]
+        addresses = [loop.run_until_complete(s.start()) for s in seeders]
+        with LocalTracker(addresses) as tracker:
+            torrent_path = make_torrent(tmp, tracker.url, content, PIECE_LENGTH, files=2)
+            client = TorrentClient(torrent_path, tmp, loop, port=None, stream_window=window,
+                                   peer_download_rate=peer_rate)
+            if skip:
+                client.set_file_priority(1, SKIP)
+            task = asyncio.ensure_future(client.connect_to_peers())
+            try:
+                result = loop.run_until_complete(
+                        asyncio.wait_for(play(client, bitrate, timeout), timeout))
+            finally:
+                loop.run_until_complete(client.stop())
+                task.cancel()
+        for seeder in seeders:
+            loop.run_until_complete(seeder.stop())
+    loop.close()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--size', type=int, default=32, help='torrent size in MiB, two files')
+    parser.add_argument('--seeders', type=int, default=6)
+    parser.add_argument('--share', type=float, default=0.5, help='part of the pieces each seeder has')
+    parser.add_argument('--latency', type=float, default=0.02)
+    parser.add_argument('--peer-rate', type=float, default=1, help='MiB/s per peer')
+    parser.add_argument('--bitrate', type=float, default=4, help='MiB/s the player reads at')
+    parser.add_argument('--window', type=int, default=16, help='pieces with a deadline')
+    parser.add_argument('--timeout', type=float, default=120)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    content = random_content(args.size * 2**20)
+    number_of_pieces = -(-len(content) // PIECE_LENGTH)
+    rng = random.Random(args.seed)
+    holdings = [set(i for i in range(number_of_pieces) if rng.random() < args.share)
+                for _ in range(args.seeders)]
+    for i in range(number_of_pieces):
+        # every piece somewhere
+        holdings[rng.randrange(args.seeders)].add(i)
+
+    print('{} MiB, {} seeders with {:.0%} of the pieces each at {} MiB/s, playing at {} MiB/s'.format(
+        args.size, args.seeders, args.share, args.peer_rate, args.bitrate))
+    print('{:<26} {:>8} {:>8} {:>10} {:>10}'.format('', 'ttfb', 'stalls', 'stalled', 'played'))
+    for label, window, skip in [('rarest first', 0, False),
+                                ('streaming', args.window, False),
+                                ('streaming, 2nd skipped', args.window, True)]:
+        ttfb, stalls, stalled, played = run(content, holdings, args.latency,
+                args.peer_rate * 2**20, args.bitrate * 2**20, window, skip, args.timeout)
+        print('{:<26} {:>7.2f}s {:>8} {:>9.2f}s {:>9.2f}s'.format(label, ttfb, stalls, stalled, played))
+
+
+if __name__ == '__main__':
+    main()
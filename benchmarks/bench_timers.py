@@ -0,0 +1,81 @@
+"""
+memory and cpu of keeping `--peers` simulated connections checked every
+`--interval` seconds, with a sleeping coroutine per peer like the old
+keep_alive versus one timer each on the TimerWheel.
+
+    python -m benchmarks.bench_timers --peers 5000 --seconds 5
+"""
+
+import time
+import asyncio
+import argparse
+import tracemalloc
+
+from bittorrent.timers import TimerWheel
+
+
+class SimulatedPeer():
+    def __init__(self):
+        self.checks = 0
+
+
+def check(peer):
+    peer.checks += 1
+
+
+async def sleeper(peer, interval):
+    while True:
+        await asyncio.sleep(interval)
+        check(peer)
+
+
+def coroutines(loop, peers, interval):
+    return [loop.create_task(sleeper(p, interval)) for p in peers], None
+
+
+def wheel(loop, peers, interval):
+    timers = TimerWheel(loop, tick=interval / 4)
+    timers.start()
+    return [timers.every(interval, check, p) for p in peers], timers
+
+
+def measure(setup, count, interval, seconds):
+    loop = asyncio.new_event_loop()
+    peers = [SimulatedPeer() for _ in range(count)]
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    handles, timers = setup(loop, peers, interval)
+    memory = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    start = time.process_time()
+    loop.run_until_complete(asyncio.sleep(seconds))
+    cpu = time.process_time() - start
+
+    if timers is not None:
+        timers.stop()
+    else:
+        for task in handles:
+            task.cancel()
+        loop.run_until_complete(asyncio.sleep(0))
+    loop.close()
+    return memory, cpu, sum(p.checks for p in peers)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--peers', type=int, default=5000)
+    parser.add_argument('--interval', type=float, default=1.0)
+    parser.add_argument('--seconds', type=float, default=5)
+    args = parser.parse_args()
+
+    print('{} peers checked every {}s for {}s'.format(args.peers, args.interval, args.seconds))
+    print('{:>12} {:>12} {:>14} {:>10}'.format('scheduler', 'memory KiB', 'cpu us/check', 'checks'))
+    for name, setup in [('coroutines', coroutines), ('wheel', wheel)]:
+        memory, cpu, checks = measure(setup, args.peers, args.interval, args.seconds)
+        print('{:>12} {:>12.0f} {:>14.2f} {:>10}'.format(
+            name, memory / 2**10, cpu / max(checks, 1) * 1e6, checks))
+
+
+if __name__ == '__main__':
+    main()
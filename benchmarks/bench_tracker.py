@@ -0,0 +1,68 @@
+"""
+announce latency against the loopback http and udp trackers, and how
+long a udp announce takes when the first packets get lost (with the
+BEP 15 timeouts scaled down by --udp-timeout).
+
+    python -m benchmarks.bench_tracker --announces 200
+"""
+
+import time
+import asyncio
+import argparse
+
+from bittorrent.tracker import Tracker
+from .swarm import LocalTracker, LocalUdpTracker
+
+PEERS = [('127.0.0.{}'.format(i), 6881) for i in range(1, 51)]
+
+
+class StubTorrent():
+    info_hash = bytes(20)
+    peer_id = '-AS0001-000000000000'
+
+    def __init__(self, url):
+        self.announce_url = url
+
+
+async def announce_many(tracker, count):
+    start = time.perf_counter()
+    for _ in range(count):
+        _, peers = await tracker.announce(None, 0, 0, 1)
+        assert len(peers) == len(PEERS)
+    return (time.perf_counter() - start) / count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--announces', type=int, default=200)
+    parser.add_argument('--udp-timeout', type=float, default=0.05)
+    args = parser.parse_args()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    print('{:>14} {:>12}'.format('tracker', 'ms/announce'))
+
+    with LocalTracker(PEERS) as http:
+        tracker = Tracker(StubTorrent(http.url), loop)
+        per = loop.run_until_complete(announce_many(tracker, args.announces))
+        print('{:>14} {:>12.2f}'.format('http', per * 1e3))
+
+    udp = LocalUdpTracker(PEERS)
+    url = loop.run_until_complete(udp.start())
+    tracker = Tracker(StubTorrent(url), loop)
+    per = loop.run_until_complete(announce_many(tracker, args.announces))
+    print('{:>14} {:>12.2f}'.format('udp', per * 1e3))
+    tracker.close()
+
+    for drop in [1, 2, 3]:
+        udp.drop = drop
+        tracker = Tracker(StubTorrent(url), loop, udp_timeout=args.udp_timeout)
+        per = loop.run_until_complete(announce_many(tracker, 1))
+        print('{:>14} {:>12.2f}'.format('udp, {} lost'.format(drop), per * 1e3))
+        tracker.close()
+    udp.stop()
+    loop.close()
+
+
+if __name__ == '__main__':
+    main()
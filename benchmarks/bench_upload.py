@@ -0,0 +1,71 @@
+"""
+upload throughput of a client that has the whole torrent, to loopback
+leechers that all want every piece, for different read cache sizes.
+a cache of 0 reads a piece from disk for every block sent.
+
+    python -m benchmarks.bench_upload --size 32 --leechers 4 --caches 0,16,64
+"""
+
+import time
+import argparse
+import asyncio
+import tempfile
+
+from bittorrent.client import TorrentClient
+from .swarm import make_torrent, random_content, write_content, LocalTracker, Leecher
+from .bench_pipeline import PIECE_LENGTH
+
+
+async def upload(client, leechers, timeout):
+    task = asyncio.ensure_future(client.connect_to_peers())
+    start = time.monotonic()
+    try:
+        await asyncio.wait_for(asyncio.gather(*[l.done for l in leechers]), timeout)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        elapsed = time.monotonic() - start
+        await client.stop()
+        task.cancel()
+    return elapsed
+
+
+def run(content, leechers, cache_bytes, timeout):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    with tempfile.TemporaryDirectory() as tmp:
+        write_content(tmp, content)
+        swarm = [Leecher(content, PIECE_LENGTH) for _ in range(leechers)]
+        addresses = [loop.run_until_complete(l.start()) for l in swarm]
+        with LocalTracker(addresses) as tracker:
+            torrent_path = make_torrent(tmp, tracker.url, content, PIECE_LENGTH)
+            # one upload slot per leecher, so every leecher is unchoked right away
+            client = TorrentClient(torrent_path, tmp, loop, cache_bytes=cache_bytes,
+                    upload_slots=leechers)
+            elapsed = loop.run_until_complete(upload(client, swarm, timeout))
+        for l in swarm:
+            loop.run_until_complete(l.stop())
+    loop.close()
+    assert all(l.bad == 0 for l in swarm)
+    return client.uploader, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--size', type=int, default=32, help='torrent size in MiB')
+    parser.add_argument('--leechers', type=int, default=4)
+    parser.add_argument('--timeout', type=float, default=120)
+    parser.add_argument('--caches', default='0,16,64', help='read cache sizes in MiB')
+    args = parser.parse_args()
+
+    content = random_content(args.size * 2**20)
+    print('{} MiB to {} leechers'.format(args.size, args.leechers))
+    print('{:>10} {:>10} {:>10} {:>12}'.format('cache MiB', 'MiB/s', 'seconds', 'disk reads'))
+    for cache in [int(x) for x in args.caches.split(',')]:
+        uploader, elapsed = run(content, args.leechers, cache * 2**20, args.timeout)
+        print('{:>10} {:>10.1f} {:>10.2f} {:>12}'.format(
+            cache, uploader.uploaded / elapsed / 2**20, elapsed, uploader.disk_reads))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""
+messages/sec and MiB/s parsed from a recorded peer wire byte stream,
+comparing PeerProtocol with the StreamReader loop the client used before.
+the stream is handed over in socket sized chunks.
+
+    python -m benchmarks.bench_wire --blocks 20000 --chunk 65536
+"""
+
+import os
+import time
+import struct
+import asyncio
+import argparse
+
+from bittorrent.protocol import PeerProtocol, HANDSHAKE_LENGTH
+
+
+def record(blocks):
+    """ a handshake, a bitfield and then PIECE messages with a HAVE every 16 blocks """
+
+    data = os.urandom(2**14)
+    stream = bytearray(HANDSHAKE_LENGTH)
+    stream += struct.pack('!IB', 1 + 1250, 5) + bytes(1250)
+    messages = 1
+    for i in range(blocks):
+        stream += struct.pack('!IBII', 9 + len(data), 7, i // 16, (i % 16) * 2**14)
+        stream += data
+        messages += 1
+        if i % 16 == 15:
+            stream += struct.pack('!IBI', 5, 4, i // 16)
+            messages += 1
+    return bytes(stream), messages
+
+
+class Transport():
+    def pause_reading(self):
+        pass
+
+    def resume_reading(self):
+        pass
+
+
+def parse_protocol(stream, chunk):
+    protocol = PeerProtocol(None)
+    protocol.connection_made(Transport())
+    messages = 0
+    position = 0
+    while position < len(stream):
+        buffer = protocol.get_buffer(-1)
+        n = min(len(buffer), chunk, len(stream) - position)
+        buffer[:n] = stream[position:position + n]
+        position += n
+        protocol.buffer_updated(n)
+        while protocol.next_message() is not None:
+            messages += 1
+    return messages
+
+
+async def _parse_streams(reader):
+    """ the loop TorrentClient._receive_data used to run """
+
+    messages = 0
+    await reader.readexactly(HANDSHAKE_LENGTH)
+    while True:
+        message_body = b''
+        first_4_bytes = b''
+        while len(first_4_bytes) < 4:
+            chunk = await reader.read(4 - len(first_4_bytes))
+            if not chunk:
+                return messages
+            first_4_bytes += chunk
+        message_length = struct.unpack('!i', first_4_bytes)[0]
+        while len(message_body) < message_length:
+            message_body += await reader.read(message_length - len(message_body))
+        message_id = message_body[0]
+        payload = message_body[1:]
+        messages += 1
+
+
+def parse_streams(stream, chunk):
+    loop = asyncio.new_event_loop()
+    reader = asyncio.StreamReader(limit=2**26)
+    for i in range(0, len(stream), chunk):
+        reader.feed_data(stream[i:i + chunk])
+    reader.feed_eof()
+    start = time.perf_counter()
+    messages = loop.run_until_complete(_parse_streams(reader))
+    elapsed = time.perf_counter() - start
+    loop.close()
+    return messages, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--blocks', type=int, default=20000)
+    parser.add_argument('--chunk', type=int, default=65536)
+    args = parser.parse_args()
+
+    stream, expected = record(args.blocks)
+    print('{:>10} {:>14} {:>10}'.format('reader', 'messages/s', 'MiB/s'))
+
+    start = time.perf_counter()
+    messages = parse_protocol(stream, args.chunk)
+    elapsed = time.perf_counter() - start
+    assert messages == expected
+    print('{:>10} {:>14.0f} {:>10.1f}'.format(
+        'protocol', messages / elapsed, len(stream) / elapsed / 2**20))
+
+    messages, elapsed = parse_streams(stream, args.chunk)
+    assert messages == expected
+    print('{:>10} {:>14.0f} {:>10.1f}'.format(
+        'streams', messages / elapsed, len(stream) / elapsed / 2**20))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,277 @@
+"""
+the benchmark suite: downloads synthetic torrents from loopback swarms,
+one scenario after the other, and writes the results as json so runs
+can be compared.
+
+every scenario makes its own torrent, single or multi file with its own
+piece size, and starts seeders that can add latency, cap their bandwidth,
+choke now and then and corrupt blocks. the client runs in a process of
+its own, so the cpu time and peak rss it reports are the client's alone,
+the seeders and the tracker stay in this one.
+
+    python -m benchmarks.suite --output before.json
+    python -m benchmarks.suite --output after.json --compare before.json
+
+with --compare the run fails when a scenario got slower, more cpu hungry
+or bigger than --tolerance allows, or did not finish.
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import platform
+import resource
+import subprocess
+import tempfile
+
+from .swarm import make_torrent, random_content, LocalTracker, Seeder
+
+MiB = 2**20
+GiB = 2**30
+
+# name -> what the torrent and the seeders look like. seeders lists one
+# dict of Seeder options per seeder, sizes are in MiB and rates in MiB/s.
+SCENARIOS = {
+    'single-file': {
+        'size': 64, 'piece_length': 2**18, 'files': 1, 'single': True,
+        'seeders': [{'latency': 0.005}] * 4,
+    },
+    'many-files-small-pieces': {
+        'size': 32, 'piece_length': 2**15, 'files': 256,
+        'seeders': [{'latency': 0.005}] * 4,
+    },
+    'large-pieces': {
+        'size': 64, 'piece_length': 2**22, 'files': 4,
+        'seeders': [{'latency': 0.005}] * 4,
+    },
+    'high-latency': {
+        'size': 32, 'piece_length': 2**18, 'files': 4,
+        'seeders': [{'latency': 0.1}] * 4,
+    },
+    'bandwidth-capped': {
+        'size': 32, 'piece_length': 2**18, 'files': 4,
+        'seeders': [{'latency': 0.01, 'rate': 4}, {'latency': 0.01, 'rate': 4},
+                    {'latency': 0.01, 'rate': 2}, {'latency': 0.01, 'rate': 1}],
+    },
+    'choking': {
+        'size': 32, 'piece_length': 2**18, 'files': 4,
+        'seeders': [{'latency': 0.01, 'choke_interval': 0.2, 'choke_duration': 0.1}] * 4,
+    },
+    'corrupt-blocks': {
+        'size': 32, 'piece_length': 2**18, 'files': 4,
+        'seeders': [{'latency': 0.01}] * 3 + [{'latency': 0.01, 'corrupt': 0.05}],
+    },
+}
+
+REGRESSION_CHECKS = [
+    # key, True if bigger is better
+    ('mib_per_s', True),
+    ('cpu_s_per_gib', False),
+    ('peak_rss_mib', False),
+]
+
+
+def peak_rss_mib():
+    try:
+        # the high water mark of this process image, getrusage would also
+        # count what the process was before the exec
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return peak / (MiB if sys.platform == 'darwin' else 1024)
+
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def download(torrent_path, destination, timeout):
+    """ runs in the client process: download the torrent and measure it """
+
+    from bittorrent.client import TorrentClient
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    client = TorrentClient(torrent_path, destination, loop, port=None)
+
+    async def run():
+        task = asyncio.ensure_future(client.connect_to_peers())
+        try:
+            while len(client.pieces_downloaded) < client.torrent.number_of_pieces:
+                if loop.time() - started > timeout:
+                    break
+                await asyncio.sleep(0.005)
+            return loop.time() - started
+        finally:
+            await client.stop()
+            task.cancel()
+
+    cpu = cpu_seconds()
+    started = loop.time()
+    seconds = loop.run_until_complete(run())
+    cpu = cpu_seconds() - cpu
+    loop.close()
+    return {
+        'complete': len(client.pieces_downloaded) == client.torrent.number_of_pieces,
+        'seconds': seconds,
+        'bytes': client.downloaded,
+        'received_bytes': client.received,
+        'hash_failures': client.verifier.failed,
+        'cpu_seconds': cpu,
+        'peak_rss_mib': peak_rss_mib(),
+    }
+
+
+async def run_client(torrent_path, destination, timeout):
+    process = await asyncio.create_subprocess_exec(
+            sys.executable, '-m', 'benchmarks.suite', '--client',
+            torrent_path, destination, '--timeout', str(timeout),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = await process.communicate()
+    if process.returncode != 0:
+        raise RuntimeError('client failed:\n' + err.decode())
+    return json.loads(out.decode())
+
+
+def run_scenario(name, scenario, content, timeout):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    seeders = []
+    for i, options in enumerate(scenario['seeders']):
+        options = dict(options)
+        if 'rate' in options:
+            options['rate'] *= MiB
+        seeders.append(Seeder(content, scenario['piece_length'], seed=i, **options))
+    try:
+        addresses = [loop.run_until_complete(s.start()) for s in seeders]
+        with tempfile.TemporaryDirectory() as tmp, LocalTracker(addresses) as tracker:
+            torrent_path = make_torrent(tmp, tracker.url, content, scenario['piece_length'],
+                                        files=scenario['files'], single=scenario.get('single', False))
+            destination = os.path.join(tmp, 'download')
+            os.mkdir(destination)
+            result = loop.run_until_complete(run_client(torrent_path, destination, timeout))
+    finally:
+        for seeder in seeders:
+            loop.run_until_complete(seeder.stop())
+        loop.close()
+    result['corrupted_blocks'] = sum(s.corrupted for s in seeders)
+    result['chokes'] = sum(s.chokes for s in seeders)
+    return result
+
+
+def summarize(runs):
+    """ the median run by time, with the rates worked out """
+
+    runs = sorted(runs, key=lambda r: r['seconds'])
+    result = dict(runs[len(runs) // 2])
+    result['complete'] = all(r['complete'] for r in runs)
+    result['mib_per_s'] = result['bytes'] / MiB / result['seconds'] if result['seconds'] else 0
+    result['cpu_s_per_gib'] = result['cpu_seconds'] / (result['bytes'] / GiB) if result['bytes'] else None
+    result['runs'] = len(runs)
+    result['seconds_all'] = [r['seconds'] for r in runs]
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, tolerance):
+    """ the regressions against `baseline`, as readable lines """
+
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get('scenarios', {}).get(name)
+        if before is None:
+            continue
+        if before['complete'] and not result['complete']:
+            regressions.append('{}: did not finish'.format(name))
+            continue
+        for key, higher_is_better in REGRESSION_CHECKS:
+            old, new = before.get(key), result.get(key)
+            if not old or new is None:
+                continue
+            change = new / old - 1
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append('{}: {} {:.3g} -> {:.3g} ({:+.0%})'.format(name, key, old, new, change))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('scenarios', nargs='*', help='names from SCENARIOS, all by default')
+    parser.add_argument('--repeat', type=int, default=1, help='runs per scenario, the median is kept')
+    parser.add_argument('--timeout', type=float, default=120, help='seconds per download')
+    parser.add_argument('--output', help='write the json here instead of to stdout')
+    parser.add_argument('--compare', help='json of an earlier run to check against')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--list', action='store_true', help='list the scenarios')
+    parser.add_argument('--client', nargs=2, metavar=('TORRENT', 'DESTINATION'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.client:
+        json.dump(download(args.client[0], args.client[1], args.timeout), sys.stdout)
+        return
+    if args.list:
+        for name, scenario in SCENARIOS.items():
+            print('{:<28} {}'.format(name, json.dumps(scenario)))
+        return
+
+    names = args.scenarios or list(SCENARIOS)
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        parser.error('unknown scenarios: {}'.format(', '.join(unknown)))
+
+    results = {}
+    for name in names:
+        scenario = SCENARIOS[name]
+        content = random_content(scenario['size'] * MiB)
+        runs = [run_scenario(name, scenario, content, args.timeout) for _ in range(args.repeat)]
+        results[name] = dict(summarize(runs), scenario=scenario)
+        result = results[name]
+        print('{:<28} {:>8.1f} MiB/s {:>8} cpu s/GiB {:>7.0f} MiB rss{}'.format(
+            name, result['mib_per_s'],
+            'n/a' if result['cpu_s_per_gib'] is None else '{:.2f}'.format(result['cpu_s_per_gib']),
+            result['peak_rss_mib'], '' if result['complete'] else '  did not finish'),
+            file=sys.stderr)
+
+    report = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'scenarios': results,
+    }
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print('regression: ' + line, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
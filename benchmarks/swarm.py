@@ -0,0 +1,431 @@
+"""
+helpers to run the client against a swarm that lives entirely on loopback:
+a synthetic torrent, a tiny http tracker, seeders with injected latency,
+bandwidth caps, chokes and corrupt blocks, and leechers to upload to.
+"""
+
+import os
+import math
+import time
+import struct
+import random
+import socket
+import asyncio
+import itertools
+import threading
+from hashlib import sha1
+from urllib.parse import urlparse, parse_qs
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+from bcoding import bencode
+
+HANDSHAKE_LENGTH = 68
+PSTR = b'BitTorrent protocol'
+
+_peer_ids = itertools.count(1)
+
+
+def make_peer_id(client):
+    """ a peer id of its own for every stand-in peer, the client drops duplicates """
+
+    return '-{}0001-{:012d}'.format(client, next(_peer_ids)).encode()
+
+
+def make_torrent(directory, announce, content, piece_length=2**18, files=4, announce_list=None,
+                 single=False):
+    """
+    write a .torrent describing `content` and return its path, a multi
+    file one of `files` files or with `single` a single file one
+    """
+
+    total_length = len(content)
+    pieces = b''.join(sha1(content[i:i + piece_length]).digest()
+            for i in range(0, total_length, piece_length))
+
+    info = {
+        'name': 'bench',
+        'piece length': piece_length,
+        'pieces': pieces,
+    }
+    if single:
+        info['length'] = total_length
+    else:
+        file_length = total_length // files
+        lengths = [file_length] * (files - 1)
+        lengths.append(total_length - sum(lengths))
+        info['files'] = [{'path': ['file{}'.format(i)], 'length': l}
+                         for i, l in enumerate(lengths)]
+    path = os.path.join(directory, 'bench.torrent')
+    metainfo = {'announce': announce, 'info': info}
+    if announce_list is not None:
+        metainfo['announce-list'] = announce_list
+    with open(path, 'wb') as f:
+        f.write(bencode(metainfo))
+    return path
+
+
+def write_content(directory, content, files=4):
+    """ put `content` on disk the way make_torrent splits it, as a finished download """
+
+    dir_path = os.path.join(directory, 'bench')
+    os.makedirs(dir_path, exist_ok=True)
+    file_length = len(content) // files
+    for i in range(files):
+        end = len(content) if i == files - 1 else (i + 1) * file_length
+        with open(os.path.join(dir_path, 'file{}'.format(i)), 'wb') as f:
+            f.write(content[i * file_length:end])
+
+
+def random_content(length, seed=0):
+    block = sha1(str(seed).encode()).digest() * 1024
+    out = bytearray()
+    counter = 0
+    while len(out) < length:
+        out += sha1(block + struct.pack('!I', counter)).digest() * 512
+        counter += 1
+    return bytes(out[:length])
+
+
+class SyntheticTorrent():
+    """
+    stands in for Torrent where only the layout matters, so huge
+    torrents can be described without writing a .torrent file
+    """
+
+    PIECE_LENGTH = 2**18
+    REQUEST_LENGTH = 2**14
+
+    def __init__(self, total_length, piece_length=PIECE_LENGTH, files=1):
+        file_length = total_length // files
+        lengths = [file_length] * (files - 1)
+        lengths.append(total_length - sum(lengths))
+        self.info = {
+            'name': 'bench',
+            'piece length': piece_length,
+            'files': [{'path': ['file{}'.format(i)], 'length': l}
+                      for i, l in enumerate(lengths)],
+        }
+        self.name = 'bench'
+        self.files = [(('file{}'.format(i),), l) for i, l in enumerate(lengths)]
+        self.multi_file = True
+        self.standard_piece_length = piece_length
+        self.total_length = total_length
+        self.number_of_pieces = math.ceil(total_length / piece_length)
+
+    def file_length(self):
+        return self.total_length
+
+    def piece_length(self, piece_index):
+        if piece_index == self.number_of_pieces - 1:
+            return self.total_length - piece_index * self.info['piece length']
+        return self.info['piece length']
+
+    def blocks_per_piece(self, piece_index):
+        return math.ceil(self.piece_length(piece_index) / self.REQUEST_LENGTH)
+
+    def block_length(self, piece_index, block_index):
+        piece_length = self.piece_length(piece_index)
+        return min(self.REQUEST_LENGTH, piece_length - block_index * self.REQUEST_LENGTH)
+
+
+class QuietHTTPServer(HTTPServer):
+    def handle_error(self, request, client_address):
+        pass # clients hanging up early are expected
+
+
+class LocalTracker():
+    """
+    http tracker that hands out a fixed list of compact peers and keeps
+    the query of every announce in `announces`. it answers after `latency`
+    seconds, with `failure` as the failure reason if one is given.
+    `response` is bencoded and sent in place of the usual answer.
+    """
+
+    def __init__(self, peers, interval=1800, latency=0.0, failure=None, response=None):
+        compact = b''.join(socket.inet_aton(host) + struct.pack('!H', port)
+                for host, port in peers)
+        if response is not None:
+            body = bencode(response)
+        elif failure is None:
+            body = bencode({'interval': interval, 'peers': compact})
+        else:
+            body = bencode({'failure reason': failure})
+        announces = self.announces = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                query = parse_qs(urlparse(self.path).query)
+                announces.append({k: v[0] for k, v in query.items()})
+                time.sleep(latency)
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = QuietHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}/announce'.format(self.server.server_port)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class LocalUdpTracker(asyncio.DatagramProtocol):
+    """
+    udp tracker (BEP 15) on the running loop with the same fixed peer list,
+    answering after `latency` seconds. the first `drop` packets are
+    ignored, to make the client retry. announces are kept as
+    (event, downloaded, left, uploaded).
+    """
+
+    def __init__(self, peers, interval=1800, drop=0, latency=0.0):
+        self.compact = b''.join(socket.inet_aton(host) + struct.pack('!H', port)
+                for host, port in peers)
+        self.interval = interval
+        self.drop = drop
+        self.latency = latency
+        self.connection_ids = set()
+        self.connects = 0
+        self.announces = []
+        self.transport = None
+
+    async def start(self, host='127.0.0.1'):
+        loop = asyncio.get_event_loop()
+        self.transport, _ = await loop.create_datagram_endpoint(
+                lambda: self, local_addr=(host, 0))
+        address = self.transport.get_extra_info('sockname')
+        self.url = 'udp://{}:{}/announce'.format(*address[:2])
+        return self.url
+
+    def stop(self):
+        self.transport.close()
+
+    def datagram_received(self, data, addr):
+        if self.drop:
+            self.drop -= 1
+            return
+        if self.latency:
+            asyncio.get_event_loop().call_later(self.latency, self._answer, data, addr)
+        else:
+            self._answer(data, addr)
+
+    def _answer(self, data, addr):
+        if self.transport.is_closing():
+            return
+        connection_id, action, transaction_id = struct.unpack_from('!QII', data)
+        if action == 0:
+            self.connects += 1
+            new_id = int.from_bytes(os.urandom(8), 'big')
+            self.connection_ids.add(new_id)
+            self.transport.sendto(struct.pack('!IIQ', 0, transaction_id, new_id), addr)
+        elif action == 1:
+            if connection_id not in self.connection_ids:
+                self.transport.sendto(struct.pack('!II', 3, transaction_id) + b'bad connection id', addr)
+                return
+            downloaded, left, uploaded, event = struct.unpack_from('!QQQI', data, 56)
+            self.announces.append((event, downloaded, left, uploaded))
+            self.transport.sendto(struct.pack('!IIIII', 1, transaction_id, self.interval, 0, 1)
+                                  + self.compact, addr)
+
+
+class Seeder():
+    """
+    a seeder that has every piece, or only the indexes in `pieces`, and
+    answers each REQUEST after `latency` seconds, without making later
+    requests wait behind earlier ones.
+
+    `rate` caps what it sends over all of its connections, in bytes a
+    second. with `choke_interval` it chokes every connection for
+    `choke_duration` seconds once every `choke_interval`, dropping the
+    requests it had, like a real peer. `corrupt` is the chance of a block
+    going out with a flipped byte, drawn from a generator seeded with `seed`.
+    """
+
+    def __init__(self, content, piece_length, latency=0.0, pieces=None, rate=None,
+                 choke_interval=None, choke_duration=1.0, corrupt=0.0, seed=0):
+        self.content = content
+        self.piece_length = piece_length
+        self.latency = latency
+        self.number_of_pieces = -(-len(content) // piece_length)
+        self.pieces = set(range(self.number_of_pieces)) if pieces is None else set(pieces)
+        self.rate = rate
+        self.choke_interval = choke_interval
+        self.choke_duration = choke_duration
+        self.corrupt = corrupt
+        self.rng = random.Random(seed)
+        self.requests = 0
+        self.corrupted = 0
+        self.chokes = 0
+        self.cancelled = set()
+        self.choked = set()  # writers of the connections we are choking
+        self.rounds = {}     # writer -> times it was choked, stale blocks are not sent
+        self.next_send = 0.0 # loop time the link is free again with a rate
+        self.server = None
+        self.peer_id = make_peer_id('SD')
+
+    async def start(self, host='127.0.0.1', port=0):
+        self.server = await asyncio.start_server(self._serve, host, port)
+        self.address = self.server.sockets[0].getsockname()[:2]
+        return self.address
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def dial(self, host, port, info_hash):
+        """ connect to the client, like a peer behind a NAT that cannot be connected to """
+
+        reader, writer = await asyncio.open_connection(host, port)
+        writer.write(bytes([len(PSTR)]) + PSTR + bytes(8) + info_hash + self.peer_id)
+        await self._serve(reader, writer, dialed=True)
+
+    def _bitfield(self):
+        field = bytearray(-(-self.number_of_pieces // 8))
+        for i in self.pieces:
+            field[i // 8] |= 0x80 >> (i % 8)
+        return struct.pack('!IB', len(field) + 1, 5) + bytes(field)
+
+    async def _serve(self, reader, writer, dialed=False):
+        loop = asyncio.get_event_loop()
+        choker = None
+        self.rounds[writer] = 0
+        try:
+            handshake = await reader.readexactly(HANDSHAKE_LENGTH)
+            if not dialed:
+                writer.write(handshake[:48] + self.peer_id)
+            writer.write(self._bitfield())
+            writer.write(struct.pack('!IB', 1, 1))  # UNCHOKE
+            if self.choke_interval:
+                choker = loop.call_later(self.choke_interval, self._choke, writer)
+            while True:
+                length = struct.unpack('!I', await reader.readexactly(4))[0]
+                if length == 0:
+                    continue
+                message = await reader.readexactly(length)
+                if message[0] == 6:
+                    index, begin, size = struct.unpack('!III', message[1:13])
+                    if index not in self.pieces or writer in self.choked:
+                        continue
+                    self.requests += 1
+                    when = loop.time() + self.latency
+                    if self.rate:
+                        when = max(when, self.next_send)
+                        self.next_send = when + size / self.rate
+                    loop.call_at(when, self._send_block, writer, index, begin, size,
+                                 self.rounds[writer])
+                elif message[0] == 8:
+                    self.cancelled.add((writer, struct.unpack('!II', message[1:9])))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            if choker is not None:
+                choker.cancel()
+            self.choked.discard(writer)
+            self.rounds.pop(writer, None)
+            writer.close()
+
+    def _choke(self, writer):
+        if writer.transport.is_closing():
+            return
+        loop = asyncio.get_event_loop()
+        if writer in self.choked:
+            self.choked.discard(writer)
+            writer.write(struct.pack('!IB', 1, 1))  # UNCHOKE
+            loop.call_later(self.choke_interval, self._choke, writer)
+        else:
+            self.choked.add(writer)
+            self.rounds[writer] += 1
+            self.chokes += 1
+            writer.write(struct.pack('!IB', 1, 0))  # CHOKE
+            loop.call_later(self.choke_duration, self._choke, writer)
+
+    def _send_block(self, writer, index, begin, size, choke_round=0):
+        if writer.transport.is_closing() or self.rounds.get(writer) != choke_round:
+            return
+        if (writer, (index, begin)) in self.cancelled:
+            self.cancelled.discard((writer, (index, begin)))
+            return
+        start = index * self.piece_length + begin
+        block = self.content[start:start + size]
+        if self.corrupt and self.rng.random() < self.corrupt:
+            self.corrupted += 1
+            position = self.rng.randrange(size)
+            block = block[:position] + bytes([block[position] ^ 0xff]) + block[position + 1:]
+        writer.write(struct.pack('!IBII', size + 9, 7, index, begin))
+        writer.write(block)
+
+
+class Leecher():
+    """
+    a peer that wants everything. it waits for the client to connect,
+    asks for every block in order keeping `window` requests outstanding
+    and checks each piece against `content` as it completes.
+    """
+
+    def __init__(self, content, piece_length, window=64, block_length=2**14):
+        self.content = content
+        self.piece_length = piece_length
+        self.window = window
+        self.block_length = block_length
+        self.blocks = [(i, begin, min(block_length, len(content) - i - begin))
+                       for i in range(0, len(content), piece_length)
+                       for begin in range(0, min(piece_length, len(content) - i), block_length)]
+        self.received = 0
+        self.bad = 0
+        self.server = None
+        self.done = None
+
+    async def start(self, host='127.0.0.1', port=0):
+        self.done = asyncio.get_event_loop().create_future()
+        self.server = await asyncio.start_server(self._serve, host, port)
+        self.address = self.server.sockets[0].getsockname()[:2]
+        return self.address
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def _serve(self, reader, writer):
+        try:
+            handshake = await reader.readexactly(HANDSHAKE_LENGTH)
+            writer.write(handshake[:48] + make_peer_id('LE'))
+            writer.write(struct.pack('!IB', 1, 2))  # INTERESTED
+            following = 0
+            outstanding = 0
+            while self.received < len(self.blocks):
+                length = struct.unpack('!I', await reader.readexactly(4))[0]
+                if length == 0:
+                    continue
+                message = await reader.readexactly(length)
+                if message[0] == 7:
+                    index, begin = struct.unpack('!II', message[1:9])
+                    start = index * self.piece_length + begin
+                    if message[9:] != self.content[start:start + length - 9]:
+                        self.bad += 1
+                    self.received += 1
+                    outstanding -= 1
+                elif message[0] != 1:  # only UNCHOKE and PIECE matter here
+                    continue
+                requests = []
+                while outstanding < self.window and following < len(self.blocks):
+                    offset, begin, size = self.blocks[following]
+                    requests.append(struct.pack('!IBIII', 13, 6,
+                        offset // self.piece_length, begin, size))
+                    following += 1
+                    outstanding += 1
+                writer.write(b''.join(requests))
+            if not self.done.done():
+                self.done.set_result(None)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
@@ -0,0 +1,164 @@
+import sys
+
+if hasattr(int, 'bit_count'):
+    def _popcount(value):
+        return value.bit_count()
+else:
+    def _popcount(value):
+        return bin(value).count('1')
+
+# positions of the set bits in every byte value, high bit first
+_BITS = [tuple(bit for bit in range(8) if value & (0x80 >> bit)) for value in range(256)]
+# every byte value spread out to a 32 bit count of 0 or 1 per bit, see add_to
+_ONE = (1).to_bytes(4, sys.byteorder)
+_LANES = [b''.join(_ONE if value & (0x80 >> bit) else bytes(4) for bit in range(8))
+          for value in range(256)]
+
+
+class Bitfield():
+    """
+    which pieces of a torrent someone has, laid out like the BITFIELD
+    message: piece 0 is the high bit of the first byte.
+
+    single pieces are looked up and changed in the bytes. comparing whole
+    bitfields goes through their value as one big int, where & and ~ run
+    64 bits at a time in C. the int is made when first needed and kept
+    until the bitfield changes, and the number of pieces is kept up to date
+    as it goes, so parsing a BITFIELD and asking whether a peer has anything
+    we want never loop over pieces in python.
+    """
+
+    __slots__ = ('length', 'bytes', 'count', '_value')
+
+    def __init__(self, length, data=None):
+        self.length = length
+        self.bytes = bytearray((length + 7) // 8) if data is None else data
+        self.count = 0
+        self._value = None
+
+    @classmethod
+    def from_bytes(cls, data, length):
+        """ a BITFIELD payload, raises ValueError if it does not fit `length` pieces """
+
+        if len(data) != (length + 7) // 8:
+            raise ValueError('bitfield of {} bytes for {} pieces'.format(len(data), length))
+        bitfield = cls(length, bytearray(data))
+        spare = len(data) * 8 - length
+        if spare and bitfield.bytes[-1] & ((1 << spare) - 1):
+            # the spare bits at the end should be clear, ignore them if not
+            bitfield.bytes[-1] &= 0xff ^ ((1 << spare) - 1)
+        bitfield.count = _popcount(bitfield.value)
+        return bitfield
+
+    @classmethod
+    def full(cls, length):
+        bitfield = cls(length)
+        bitfield.set_all()
+        return bitfield
+
+    def set_all(self):
+        data = self.bytes
+        data[:] = b'\xff' * len(data)
+        spare = len(data) * 8 - self.length
+        if spare:
+            data[-1] = 0xff ^ ((1 << spare) - 1)
+        self.count = self.length
+        self._value = None
+
+    @property
+    def value(self):
+        if self._value is None:
+            self._value = int.from_bytes(self.bytes, 'big')
+        return self._value
+
+    def set_value(self, value):
+        """ make this the bitfield that `value` is the int of """
+
+        self.bytes[:] = value.to_bytes(len(self.bytes), 'big')
+        self.count = _popcount(value)
+        self._value = value
+
+    def to_bytes(self):
+        return bytes(self.bytes)
+
+    def __contains__(self, index):
+        return 0 <= index < self.length and bool(self.bytes[index >> 3] & (0x80 >> (index & 7)))
+
+    def add(self, index):
+        mask = 0x80 >> (index & 7)
+        if not self.bytes[index >> 3] & mask:
+            self.bytes[index >> 3] |= mask
+            self.count += 1
+            self._value = None
+
+    def discard(self, index):
+        mask = 0x80 >> (index & 7)
+        if self.bytes[index >> 3] & mask:
+            self.bytes[index >> 3] ^= mask
+            self.count -= 1
+            self._value = None
+
+    def __len__(self):
+        return self.count
+
+    def all(self):
+        return self.count == self.length
+
+    def __iter__(self):
+        """ indexes of the pieces, in order """
+
+        bits = _BITS
+        for position, byte in enumerate(self.bytes):
+            if byte:
+                base = position << 3
+                for bit in bits[byte]:
+                    yield base + bit
+
+    def has_any_not_in(self, other):
+        """ whether there is a piece in here that `other` lacks """
+
+        return self.value & ~other.value != 0
+
+    def first_in(self, other, start=0):
+        """ the first piece from `start` on that `other` has too, or None """
+
+        value = self.value & other.value
+        if start:
+            value &= (1 << (len(self.bytes) * 8 - start)) - 1
+        return self.first_of(value)
+
+    def first_of(self, value):
+        """ the first piece in `value`, an int laid out like `self.value`, or None """
+
+        if not value:
+            return None
+        # piece 0 is the highest bit
+        return len(self.bytes) * 8 - value.bit_length()
+
+    def difference(self, other):
+        """ the pieces in here that `other` lacks """
+
+        bitfield = Bitfield(self.length)
+        bitfield.set_value(self.value & ~other.value)
+        return bitfield
+
+    def add_to(self, counts):
+        """
+        add one to counts[i] for every piece i in here, `counts` being an
+        array('I') with a count per piece. the counts are taken as one big
+        int with 32 bits for each, so that they are all added to at once
+        """
+
+        size = 4 * self.length
+        total = int.from_bytes(counts, sys.byteorder) + self._lanes(size)
+        memoryview(counts).cast('B')[:] = total.to_bytes(size, sys.byteorder)
+
+    def subtract_from(self, counts):
+        """ take one from counts[i] for every piece i in here, none of them may be 0 """
+
+        size = 4 * self.length
+        total = int.from_bytes(counts, sys.byteorder) - self._lanes(size)
+        memoryview(counts).cast('B')[:] = total.to_bytes(size, sys.byteorder)
+
+    def _lanes(self, size):
+        return int.from_bytes(b''.join(map(_LANES.__getitem__, self.bytes))[:size], sys.byteorder)
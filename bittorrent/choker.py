@@ -0,0 +1,98 @@
+import time
+import random
+import logging
+from array import array
+
+DEFAULT_UPLOAD_SLOTS = 4
+CHOKE_INTERVAL = 10
+OPTIMISTIC_INTERVAL = 30
+SNUB_TIME = 60
+RATE_WINDOW = 20 # seconds the rolling rates are taken over
+
+
+class RateCounter():
+    """
+    bytes per second over the last `window` seconds, kept in one second
+    buckets of a ring so counting a block allocates nothing
+    """
+
+    def __init__(self, window=RATE_WINDOW, clock=time.monotonic):
+        self.window = window
+        self.clock = clock
+        self.buckets = array('Q', [0]) * window
+        self.second = int(clock())
+        self.total = 0
+
+    def _advance(self, second):
+        if second - self.second >= self.window:
+            for i in range(self.window):
+                self.buckets[i] = 0
+        else:
+            for s in range(self.second + 1, second + 1):
+                self.buckets[s % self.window] = 0
+        self.second = second
+
+    def add(self, nbytes):
+        second = int(self.clock())
+        if second != self.second:
+            self._advance(second)
+        self.buckets[second % self.window] += nbytes
+        self.total += nbytes
+
+    def rate(self):
+        second = int(self.clock())
+        if second != self.second:
+            self._advance(second)
+        return sum(self.buckets) / self.window
+
+
+class Choker():
+    """
+    decides which peers we upload to, tit-for-tat style.
+
+    every round the interested peers are ranked by how fast they send to
+    us, or how fast they take our data once we are seeding, and the best
+    `upload_slots - 1` get unchoked. the last slot goes to a peer picked
+    at random every OPTIMISTIC_INTERVAL, so newcomers get a chance to show
+    what they can do. peers that stopped sending although they unchoked us
+    and have our requests are snubbed and only ever get the optimistic slot.
+
+    everything runs off `clock` and `rng`, pass in fake ones for a
+    reproducible schedule.
+    """
+
+    def __init__(self, upload_slots=DEFAULT_UPLOAD_SLOTS, clock=time.monotonic, rng=None):
+        self.logger = logging.getLogger('main.choker')
+        self.upload_slots = max(1, upload_slots)
+        self.clock = clock
+        self.rng = rng or random.Random()
+        self.optimistic = None
+        self.optimistic_since = None
+
+    def snubbed(self, peer, now):
+        return (not peer.choked and len(peer.window) > 0 and
+                now - peer.last_block > SNUB_TIME)
+
+    def has_free_slot(self, peers):
+        return sum(1 for p in peers if not p.am_choking) < self.upload_slots
+
+    def unchoke_set(self, peers, seeding):
+        """ the peers that should be unchoked from now on """
+
+        now = self.clock()
+        candidates = [p for p in peers if p.interested and not self.snubbed(p, now)]
+        if seeding:
+            candidates.sort(key=lambda p: p.upload_rate.rate(), reverse=True)
+        else:
+            candidates.sort(key=lambda p: p.download_rate.rate(), reverse=True)
+        unchoke = set(candidates[:self.upload_slots - 1])
+
+        if (self.optimistic is None or self.optimistic not in peers or
+                not self.optimistic.interested or self.optimistic in unchoke or
+                now - self.optimistic_since >= OPTIMISTIC_INTERVAL):
+            others = [p for p in peers if p.interested and p not in unchoke]
+            self.optimistic = self.rng.choice(others) if others else None
+            self.optimistic_since = now
+        if self.optimistic is not None:
+            unchoke.add(self.optimistic)
+        return unchoke
@@ -3,266 +3,705 @@ import sys
 import os
 import asyncio
 import time
-from hashlib import sha1
 import socket
 import logging
-import datetime
+from hashlib import sha1
+from functools import partial
+from concurrent.futures.process import BrokenProcessPool
 
 from bcoding import bdecode
 
-from .tracker import Tracker
+from .tracker import Announcer, DEFAULT_PORT
 from .torrent import Torrent
 from .peer import Peer
 from .file_manager import FileManager
-from .utils import Pieces
-
-KEEPALIVE = bytes([0, 0, 0, 0])
-CHOKE = bytes([0, 0, 0, 1]) + bytes([0])
-UNCHOKE = bytes([0, 0, 0, 1]) + bytes([1])
-INTERESTED = bytes([0, 0, 0, 1]) + bytes([2])
-NOT_INTERESTED = bytes([0, 0, 0, 1]) + bytes([3])
+from .utils import Pieces, DEFAULT_BUFFER_BYTES
+from .bitfield import Bitfield
+from .picker import PiecePicker
+from .endgame import EndGame
+from .pipeline import DEFAULT_MAX_WINDOW
+from .verifier import PieceVerifier, DEFAULT_HASH_WORKERS, DEFAULT_MAX_PENDING
+from .resume import ResumeData, recheck, RECHECK_AHEAD
+from .protocol import PeerProtocol
+from .uploader import Uploader, DEFAULT_CACHE_BYTES
+from .streaming import Streamer, DEFAULT_STREAM_WINDOW
+from .choker import Choker, DEFAULT_UPLOAD_SLOTS, CHOKE_INTERVAL
+from .timers import TimerWheel
+from .listener import Listener
+from .ratelimit import TokenBucket, Throttle
+from .metrics import Metrics, MetricsServer, Histogram, RTT_BUCKETS, PIECE_BUCKETS
+from .connections import (ConnectionManager, DEFAULT_MAX_ACTIVE, DEFAULT_MAX_HALF_OPEN,
+                          CONNECT_TIMEOUT, HANDSHAKE_TIMEOUT)
+from . import messages
+from .messages import KEEPALIVE, INTERESTED, NOT_INTERESTED, CHOKE, UNCHOKE, OutboundQueue
+
+PEER_CHECK_INTERVAL = 5
+KEEPALIVE_INTERVAL = 90
+IDLE_TIMEOUT = 180   # drop peers we have not heard anything from in this long
+REQUEST_TIMEOUT = 60 # ask someone else for blocks outstanding this long
+PROGRESS_INTERVAL = 10
+
+MESSAGE_NAMES = {None: 'keep_alive', 0: 'choke', 1: 'unchoke', 2: 'interested',
+                 3: 'not_interested', 4: 'have', 5: 'bitfield', 6: 'request',
+                 7: 'piece', 8: 'cancel'}
 
 
 class TorrentClient():
-
-    def __init__(self, torrent_file, download_destination, loop):
+    """
+    downloads and seeds one torrent. on its own it runs its own timers,
+    hash and disk threads, inside a Session (`session`) it uses the ones
+    the session shares between all of its torrents, and on its own it
+    listens for peers on `port` (None to only make connections) where a
+    session has one port for all.
+
+    rates are in bytes a second, None for no limit. `download_rate` and
+    `upload_rate` cap the torrent, `peer_download_rate` and
+    `peer_upload_rate` every one of its peers, on top of the session's caps.
+
+    `read` serves data from the files while they download, the
+    `stream_window` pieces ahead of every read are fetched first, see
+    Streamer. files can be given a priority or skipped.
+
+    `collect_metrics` reads out the torrent's counters, queue depths and
+    histograms for a metrics.Metrics registry. on its own the client has
+    one in `metrics`, served over http on `metrics_port` if that is given.
+
+    `metadata_cache` is a directory to keep decoded torrent metadata in,
+    which makes loading a big torrent again faster, see Torrent. `torrent`
+    is the Torrent of `torrent_file` if it was loaded already.
+    """
+
+    def __init__(self, torrent_file, download_destination, loop,
+                 max_requests=DEFAULT_MAX_WINDOW, max_buffer_bytes=DEFAULT_BUFFER_BYTES,
+                 storage='pwrite', hash_workers=DEFAULT_HASH_WORKERS, hash_processes=False,
+                 max_pending_pieces=DEFAULT_MAX_PENDING, cache_bytes=DEFAULT_CACHE_BYTES,
+                 upload_slots=DEFAULT_UPLOAD_SLOTS, end_game=True,
+                 max_peers=DEFAULT_MAX_ACTIVE, max_half_open=DEFAULT_MAX_HALF_OPEN,
+                 session=None, download_rate=None, upload_rate=None,
+                 peer_download_rate=None, peer_upload_rate=None, port=DEFAULT_PORT,
+                 stream_window=DEFAULT_STREAM_WINDOW, metrics_port=None, metadata_cache=None,
+                 torrent=None):
         self.logger = logging.getLogger('main.torrent_client')
         self.loop = loop
-        self.torrent = Torrent(torrent_file)
-        self.pieces = Pieces(self.torrent)
+        self.session = session
+        self.torrent = torrent if torrent is not None else Torrent(torrent_file, metadata_cache)
+        self.file_manager = FileManager(self.torrent, download_destination, storage=storage)
+        self.pieces = Pieces(self.torrent, max_buffer_bytes,
+                store_blocks=not self.file_manager.writes_blocks,
+                write_block=self.file_manager.write_block)
+        self.picker = PiecePicker(self.torrent, self.pieces)
+        self.end_game = end_game
+        self.endgame = EndGame()
+        if session is None:
+            self.verifier = PieceVerifier(loop, self.torrent, self.file_manager,
+                    hash_workers, hash_processes, max_pending_pieces)
+        else:
+            self.verifier = PieceVerifier(loop, self.torrent, self.file_manager,
+                    session.hash_workers, session.hash_processes, max_pending_pieces,
+                    hash_executor=session.hash_executor, disk=session.disk)
+        self.uploader = Uploader(loop, self.torrent, self.file_manager, self.picker.done,
+                self.verifier.io_executor, cache_bytes)
+        self.choker = Choker(upload_slots)
+        self.streamer = Streamer(loop, self.torrent, self.file_manager, self.picker,
+                self.verifier.disk.run, self._wake_peers, stream_window)
+        self.download_limit = TokenBucket(loop, download_rate)
+        self.upload_limit = TokenBucket(loop, upload_rate)
+        self.peer_download_rate = peer_download_rate
+        self.peer_upload_rate = peer_upload_rate
         self.pieces_downloaded = []
-        tracker = Tracker(self.torrent)
-        peers_list = tracker.connect()
-        self.peers = [Peer(p['hostname'], p['port'], self.torrent)
-                for p in peers_list]
+        self.resume = ResumeData(self.torrent, self.file_manager, download_destination)
+        self.checking = False # the files are being rechecked, see `_recheck`
+        self._resume()
+        self.max_requests = max_requests
+        self.contributors = {} # piece index -> {block offset: peer that sent it}
+        self.suspects = {}     # piece index -> [(offset, peer, block digest)] of failed attempts
         self.active_peers = []
-        self.file_manager = FileManager(self.torrent, download_destination)
+        self.peer_ids = {} # peer id -> the connected peer with it
+        self.own_peer_id = bytes(self.torrent.peer_id, encoding='utf-8')
+        self.listener = None
+        if session is None and port is not None:
+            self.listener = Listener(loop, self._lookup, port=port)
+        self.timers = TimerWheel(loop) if session is None else session.timers
+        self.connections = ConnectionManager(loop, self.timers, self._connect_to_peer, self._new_peer,
+                self._close_connection, self._score, max_peers, max_half_open,
+                None if session is None else session.budget)
+        self.downloaded = 0 # bytes of good pieces we downloaded in this session
+        self.received = 0   # block payload from peers, good or not
+        self.messages_received = {} # message id, None for keep alives -> how many
+        self.request_rtt = Histogram(RTT_BUCKETS)
+        self.piece_latency = Histogram(PIECE_BUCKETS)
+        self.piece_started = {} # piece index -> loop time of its first request
+        self.reported = None    # pieces we had at the last progress log
+        self.labels = {'torrent': self.torrent.info_hash.hex()}
+        self.metrics = None
+        self.metrics_server = None
+        if session is None:
+            self.metrics = Metrics([self.collect_metrics])
+            if metrics_port is not None:
+                self.metrics_server = MetricsServer(loop, self.metrics, port=metrics_port)
+        self.announcer = Announcer(loop, self.timers, self.torrent, self._transfer_stats,
+                self.connections.add)
+
+    @property
+    def peers(self):
+        return self.connections.peers
+
+    async def read(self, file_index, offset, length):
+        """ `length` bytes at `offset` in a file, waits for them to be downloaded """
+
+        return await self.streamer.read(file_index, offset, length)
+
+    def set_file_priority(self, file_index, priority):
+        """ picker.SKIP to not download the file, higher ones before NORMAL """
+
+        self.streamer.set_file_priority(file_index, priority)
+
+    def _wake_peers(self):
+        """ what we want changed, tell the peers and fill every window that has room """
+
+        for peer in self.active_peers:
+            if peer.outbound is None:
+                continue
+            self._update_interest(peer)
+            if not peer.choked and peer.window.has_room():
+                self._fill_window(peer)
+
+    def collect_metrics(self):
+        """ (name, labels, value) of every metric of the torrent, see metrics.FAMILIES """
+
+        labels = self.labels
+        verifier = self.verifier
+        yield 'bittorrent_downloaded_bytes_total', labels, self.received
+        yield 'bittorrent_uploaded_bytes_total', labels, self.uploader.uploaded
+        yield 'bittorrent_verified_bytes_total', labels, self.downloaded
+        for message_id, count in self.messages_received.items():
+            yield ('bittorrent_messages_received_total',
+                   dict(labels, type=MESSAGE_NAMES.get(message_id, str(message_id))), count)
+        yield 'bittorrent_pieces_verified_total', labels, verifier.verified
+        yield 'bittorrent_hash_failures_total', labels, verifier.failed
+        yield 'bittorrent_pieces', labels, len(self.pieces_downloaded)
+        yield ('bittorrent_pieces_wanted', labels,
+               self.torrent.number_of_pieces - len(self.picker.skipped))
+        yield 'bittorrent_peers', labels, len(self.active_peers)
+        yield 'bittorrent_half_open_connections', labels, self.connections.half_open
+        yield ('bittorrent_outstanding_requests', labels,
+               sum(len(peer.window) for peer in self.active_peers))
+        yield ('bittorrent_upload_queue_depth', labels,
+               sum(len(peer.upload_requests) for peer in self.active_peers))
+        yield 'bittorrent_hash_queue_depth', labels, verifier.pending + verifier.waiting
+        yield 'bittorrent_request_rtt_seconds', labels, self.request_rtt
+        yield 'bittorrent_piece_seconds', labels, self.piece_latency
+        yield 'bittorrent_verify_seconds', labels, verifier.latencies
+        for peer in self.active_peers:
+            peer_labels = dict(labels, peer='{}:{}'.format(peer.address['host'], peer.address['port']))
+            yield 'bittorrent_peer_downloaded_bytes_total', peer_labels, peer.downloaded
+            yield 'bittorrent_peer_uploaded_bytes_total', peer_labels, peer.uploaded
+        if self.session is None:
+            # a session reports the disk and the listener it shares once for all
+            for sample in self.verifier.disk.collect_metrics(labels):
+                yield sample
+            if self.listener is not None:
+                for sample in self.listener.collect_metrics(labels):
+                    yield sample
+
+    def _log_progress(self):
+        done = len(self.pieces_downloaded)
+        if done != self.reported:
+            self.reported = done
+            self.logger.info('downloaded: {}, total: {}'.format(done, self.torrent.number_of_pieces))
+
+    def _transfer_stats(self):
+        return self.uploader.uploaded, self.downloaded, self.torrent.left
+
+    def _new_peer(self, host, port):
+        peer = Peer(host, port, self.torrent, self.max_requests)
+        shared_download = shared_upload = None
+        if self.session is not None:
+            shared_download = self.session.download_limit
+            shared_upload = self.session.upload_limit
+        peer.download_throttle = Throttle(self.loop, [TokenBucket(self.loop, self.peer_download_rate),
+                self.download_limit, shared_download])
+        peer.upload_throttle = Throttle(self.loop, [TokenBucket(self.loop, self.peer_upload_rate),
+                self.upload_limit, shared_upload])
+        peer.fill_window = partial(self._fill_window, peer)
+        peer.window.rtt_histogram = self.request_rtt
+        return peer
+
+    def set_peer_rates(self, download, upload):
+        """ change the per peer limits, for the peers we have and the ones to come """
+
+        self.peer_download_rate = download
+        self.peer_upload_rate = upload
+        for peer in self.peers:
+            if peer.download_throttle is not None:
+                peer.download_throttle.buckets[0].set_rate(download)
+                peer.upload_throttle.buckets[0].set_rate(upload)
+
+    def _score(self, peer):
+        """ how useful a connected peer is to us, 0 or less means not at all """
+
+        if self.choker.snubbed(peer, peer.clock()):
+            return -1
+        return peer.download_rate.rate() + peer.upload_rate.rate()
+
+    def _resume(self):
+        """ pick up the pieces a previous run already verified, or have them rechecked """
+
+        verified = self.resume.load()
+        if verified is None:
+            self.checking = True
+        else:
+            self._mark_verified(verified)
+
+    async def _recheck(self):
+        """
+        hash the data already on disk before anything else happens. the
+        hashing runs on the verifier's threads, the session's in a session,
+        so the event loop and every other torrent on it keep going.
+        """
+
+        verified = await recheck(self.torrent, self.file_manager, self.verifier.hash_stored,
+                                 self.verifier.workers * RECHECK_AHEAD)
+        self.checking = False
+        self._mark_verified(verified)
+
+    def _mark_verified(self, verified):
+        for index in verified:
+            self.pieces.mark_have(index)
+            self.picker.piece_done(index)
+            self.pieces_downloaded.append(index)
+            self.torrent.left -= self.torrent.piece_length(index)
+        if verified:
+            self.logger.info('resuming with {} of {} pieces'.format(
+                len(verified), self.torrent.number_of_pieces))
+
+    async def stop(self):
+        """ tell the tracker we are leaving, then close """
+
+        await self.announcer.stop()
+        # with the writes done already, close has nothing to block the loop on
+        await self.verifier.flush()
+        self.close()
+
+    def close(self):
+        self.connections.stop()
+        if self.listener is not None:
+            self.listener.close()
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+        if self.session is None:
+            self.timers.stop()
+        if self.file_manager.files:
+            self.streamer.close()
+            for peer in list(self.active_peers):
+                self._close_connection(peer)
+            # wait for pending writes, so the saved state matches the files
+            self.verifier.close()
+            self.file_manager.sync()
+            if not self.checking:
+                # the files were not looked at yet, the old state file still holds
+                self.resume.save(self.picker.done)
+            self.file_manager.close()
 
     def _hand_shake(self):
         """ https://wiki.theory.org/BitTorrentSpecification#Handshake """
 
-        pstrlen = 19
-        pstr = 'BitTorrent protocol'
-        reserved = bytes(8)
-
-        # return a long byte string
-        return b''.join([
-            bytes([pstrlen]),
-            bytes(pstr, encoding='utf-8'),
-            reserved,
-            self.torrent.info_hash,
-            bytes(self.torrent.peer_id, encoding='utf-8')
-        ])
+        return messages.handshake(self.torrent.info_hash,
+                bytes(self.torrent.peer_id, encoding='utf-8'))
 
     async def connect_to_peers(self):
-        await asyncio.gather(
-                *[self._connect_to_peer(peer) for peer in self.peers],
-                )
+        if self.checking:
+            await self._recheck()
+        self.timers.start()
+        port = None
+        if self.session is not None:
+            port = self.session.port
+        elif self.listener is not None:
+            try:
+                port = await self.listener.start()
+            except OSError as e:
+                self.logger.error('cannot listen for peers: {}'.format(e))
+        if self.metrics_server is not None:
+            try:
+                await self.metrics_server.start()
+            except OSError as e:
+                self.logger.error('cannot serve metrics: {}'.format(e))
+        self.announcer.start(port)
+        choker = self.timers.every(CHOKE_INTERVAL, self._choke_round)
+        progress = self.timers.every(PROGRESS_INTERVAL, self._log_progress)
+        saver = self.timers.every(self.resume.save_interval, self._save_resume)
+        try:
+            await self.connections.run()
+        finally:
+            choker.cancel()
+            progress.cancel()
+            saver.cancel()
 
-    async def keep_alive(self):
-        await asyncio.gather(
-                *[self._send_keepalive_to_peer(peer) for peer in self.peers],
-                )
+    def _save_resume(self):
+        """ every save_interval, so a crash costs at most that much of the download """
 
-    async def _send_keepalive_to_peer(self, peer):
-        while True:
-            await asyncio.sleep(90)
-            if peer in self.active_peers:
-                if not peer.writer.transport.is_closing():
-                    try:
-                        peer.writer.write(KEEPALIVE)
-                        peer.writer.drain()
-                        self.logger.info('just sent keep alive message to {}'.format(peer.address))
-                    except Exception as e:
-                        self.logger.error('keep live: {}'.format(e))
-                else:
-                    self.logger.debug('connection closed by {}'.format(peer.address))
-                    self._close_connection(peer)
+        try:
+            self.resume.maybe_save(self.picker.done)
+        except OSError as e:
+            self.logger.error('cannot save resume data: {}'.format(e))
+
+    def _check_peer(self, peer):
+        """ keepalives and timeouts, every PEER_CHECK_INTERVAL for every connected peer """
+
+        now = self.loop.time()
+        if peer.writer.closed or now - peer.last_received > IDLE_TIMEOUT:
+            self.logger.info('dropping idle peer {}'.format(peer.address))
+            self._close_connection(peer)
+            return
+        if now - peer.outbound.last_write >= KEEPALIVE_INTERVAL:
+            peer.outbound.add(KEEPALIVE)
+            self.logger.debug('sent keep alive message to {}'.format(peer.address))
+        expired = peer.window.expire(REQUEST_TIMEOUT)
+        if expired:
+            self.logger.info('{} requests to {} timed out'.format(len(expired), peer.address))
+            self._requeue(peer, expired)
+            for p in self.active_peers:
+                if p is not peer:
+                    asyncio.ensure_future(self._request_piece(p))
+
+    def _choke_round(self):
+        seeding = len(self.pieces_downloaded) == self.torrent.number_of_pieces
+        unchoke = self.choker.unchoke_set(self.active_peers, seeding)
+        for peer in self.active_peers:
+            if peer in unchoke and peer.am_choking:
+                peer.am_choking = False
+                peer.outbound.add(UNCHOKE)
+            elif peer not in unchoke and not peer.am_choking:
+                peer.am_choking = True
+                peer.outbound.add(CHOKE)
+                self.uploader.choked(peer)
 
     def _close_connection(self, peer):
-        self.active_peers.remove(peer)
-        peer.writer.close()
+        if peer.check_timer is not None:
+            peer.check_timer.cancel()
+        if peer.download_throttle is not None:
+            peer.download_throttle.close()
+            peer.upload_throttle.close()
+        if peer.peer_id is not None and self.peer_ids.get(peer.peer_id) is peer:
+            del self.peer_ids[peer.peer_id]
+        if peer in self.active_peers:
+            self.active_peers.remove(peer)
+            self._forget_pieces(peer)
+        self._release_requests(peer)
+        self.uploader.choked(peer)
+        if peer.writer is not None:
+            peer.writer.close()
+
+    def _misbehaved(self, peer, what):
+        """ the peer broke the protocol, ban it and let it go """
+
+        self.logger.info('{} {}'.format(peer.address, what))
+        self.connections.misbehaved(peer)
+        self._close_connection(peer)
+
+    def _release_requests(self, peer):
+        """
+        give the blocks we are still waiting for from this peer back to the pool
+        so they can be requested from someone else.
+        """
+
+        self._requeue(peer, peer.window.release())
+
+    def _requeue(self, peer, blocks):
+        for block in blocks:
+            if self.endgame.active and self.endgame.released(peer, block):
+                # another peer may still deliver it
+                continue
+            self.pieces.remove_requested(block)
+            self.picker.block_released(block)
 
     async def _connect_to_peer(self, peer):
 
         try:
-            reader, writer = await asyncio.open_connection(
-                    peer.address['host'], peer.address['port'])
+            _, protocol = await asyncio.wait_for(self.loop.create_connection(
+                    lambda: PeerProtocol(self.loop),
+                    peer.address['host'], peer.address['port']), CONNECT_TIMEOUT)
 
-            peer.reader = reader
-            peer.writer = writer
+            peer.reader = protocol
+            peer.writer = protocol
+            peer.outbound = OutboundQueue(self.loop, protocol)
 
-            await self._connection_handler(peer)
-            await self._receive_data(peer)
+            if await self._connection_handler(peer):
+                await self._receive_data(peer)
         except (ConnectionRefusedError,
                 ConnectionResetError,
                 ConnectionAbortedError,
-                TimeoutError, OSError) as e:
+                asyncio.TimeoutError, TimeoutError, OSError) as e:
             self.logger.error('connect to peer: {}, {}'.format(e, peer.address))
+        finally:
+            # whatever ended the connection, its requests go back to the pool
+            if peer.writer is not None:
+                self._close_connection(peer)
+
+    def _lookup(self, info_hash):
+        return self if info_hash == self.torrent.info_hash else None
+
+    def accept(self, protocol, hand_shake_msg):
+        """ a peer connected to us and sent the handshake for our torrent """
+
+        peername = protocol.transport.get_extra_info('peername')
+        peer_id = hand_shake_msg[48:68]
+        if self.checking:
+            # we do not know yet what we have
+            return False
+        if peername is None or not self._new_peer_id(peer_id):
+            return False
+        if not self.connections.accept(peername[0], peername[1],
+                lambda peer: self._serve_peer(peer, protocol, peer_id)):
+            return False
+        self.peer_ids[peer_id] = None # taken, the connection starts soon
+        return True
+
+    def _new_peer_id(self, peer_id):
+        """ one connection per peer, and none to ourselves """
+
+        return peer_id != self.own_peer_id and peer_id not in self.peer_ids
+
+    async def _serve_peer(self, peer, protocol, peer_id):
+        peer.reader = protocol
+        peer.writer = protocol
+        peer.outbound = OutboundQueue(self.loop, protocol)
+        peer.peer_id = peer_id
+        self.peer_ids[peer_id] = peer
+        self.logger.info('accepted peer {}'.format(peer.address))
+        try:
+            protocol.write(self._hand_shake())
+            await self._start_peer(peer, peer_id)
+            await self._receive_data(peer)
+        except (ConnectionResetError, ConnectionAbortedError, OSError) as e:
+            self.logger.error('serve peer: {}, {}'.format(e, peer.address))
+        finally:
+            self._close_connection(peer)
 
     async def _connection_handler(self, peer):
+        """ handshake with the peer, returns whether it worked """
+
         self.logger.info('connected with peer {}'.format(peer.address))
-        self.active_peers.append(peer)
-        self.timer = datetime.datetime.now()
         try:
             peer.writer.write(self._hand_shake())
             await peer.writer.drain()
         except (IOError, Exception) as e:
             self.logger.error('hand shake: {}'.format(e))
 
-        hand_shake_msg = b''
-        while len(hand_shake_msg) < 68:
         # 68 is the length of hand shake message
+        hand_shake_msg = await asyncio.wait_for(peer.reader.read_handshake(), HANDSHAKE_TIMEOUT)
+        if hand_shake_msg is None:
+            return False
+        info_hash = hand_shake_msg[28:48]
+        peer_id = hand_shake_msg[48:68]
+        if self.torrent.info_hash != info_hash:
+            self.logger.info('read hand shake refused')
+            self._close_connection(peer)
+            return False
+        elif not self._new_peer_id(peer_id):
+            self.logger.info('already connected to {}, or it is us'.format(peer_id))
+            self._close_connection(peer)
+            return False
+        else:
+            await self._start_peer(peer, peer_id)
+            return True
+
+    async def _start_peer(self, peer, peer_id):
+        """ the handshakes are done both ways, the connection is in use from here on """
+
+        peer.peer_id = peer_id
+        self.peer_ids[peer_id] = peer
+        self.active_peers.append(peer)
+        self.connections.connected(peer)
+        peer.last_received = self.loop.time()
+        peer.check_timer = self.timers.every(PEER_CHECK_INTERVAL, self._check_peer, peer)
+        # we say we are interested once its BITFIELD or a HAVE shows we are
+        if self.pieces_downloaded:
             try:
-                chunk = await peer.reader.read(68)
-                hand_shake_msg += chunk
-                if not chunk:
-                    break
-                info_hash = hand_shake_msg[28:48]
-                if self.torrent.info_hash != info_hash:
-                    self.logger.info('read hand shake refused')
-                    self._close_connection(peer)
-                else:
-                    peer.writer.write(INTERESTED)
-                    await peer.writer.drain()
-                    self.logger.info('Sent INTERESTED message to Peer {}'.format(peer.address))
-            except (ConnectionRefusedError, TimeoutError, Exception) as e:
+                # the bitfield has to be the first message after the handshake
+                peer.outbound.add(messages.bitfield(self.picker.have.to_bytes()))
+                await peer.outbound.drain()
+            except (ConnectionResetError, IOError) as e:
                 self.logger.info(e)
-                break
+
+    def _update_interest(self, peer):
+        """ tell the peer whether it has anything we still need, if that changed """
+
+        interested = peer.have.has_any_not_in(self.picker.unwanted)
+        if interested != peer.am_interested:
+            peer.am_interested = interested
+            peer.outbound.add(INTERESTED if interested else NOT_INTERESTED)
+
+    def _forget_pieces(self, peer):
+        """ the peer's pieces no longer count towards availability """
+
+        if peer.seed:
+            peer.seed = False
+            self.picker.seed_left()
+        elif peer.have.count:
+            self.picker.peer_lost(peer.have)
 
     async def _receive_data(self, peer):
         while True:
-            message_body = b''
-            first_4_bytes = b''
-            while len(first_4_bytes) < 4:
-                try:
-                    chunk = await peer.reader.read(4 - len(first_4_bytes))
-                except Exception as e:
-                    self.logger.error('read from peer Exception')
-                    self.logger.error(e)
-                    return
-
-                if not chunk:
-                    return
-                first_4_bytes += chunk
-
-            # self.logger.info('first 4 bytes: {}'.format(first_4_bytes))
-            message_length = struct.unpack('!i', first_4_bytes)[0]
-
-            if message_length == 0:
-                peer.timer = datetime.datetime.now()
-                self.logger.debug('Peer {} sent KEEP ALIVE message'.format(peer.address))
-            else:
-                while len(message_body) < message_length:
-                    try:
-                        message_body_chunk = await peer.reader.read(message_length - len(message_body))
-                    except Exception as e:
-                        self.logger.info('read message body')
-                        self.logger.error(e)
-                        return
-                    if not message_body_chunk:
-                        return
-                    message_body += message_body_chunk
-                # self.logger.info('message body: {}'.format(message_body))
-
-                message_id = message_body[0]
-                payload = message_body[1:]
+            # the payload is a view into the connection's receive buffer,
+            # it is only valid until the next read_message call
+            message = await peer.reader.read_message()
+            if message is None:
+                return
+
+            peer.last_received = self.loop.time()
+            message_id, payload = message
+            counts = self.messages_received
+            counts[message_id] = counts.get(message_id, 0) + 1
+            if message_id is not None:
                 await self._message_handler(peer, message_id, payload)
 
     async def _message_handler(self, peer, msg_id, payload):
         """ identity type of message sent from peer and make action accordingly """
 
         if msg_id == 0:
-            self.logger.debug('Peer {} sent CHOKE message'.format(peer.address))
+            # a choking peer discards our pending requests
+            peer.choked = True
+            self._release_requests(peer)
 
         elif msg_id == 1:
-            self.logger.debug('Peer {} sent UNCHOKE message'.format(peer.address))
             peer.choked = False
+            peer.last_block = peer.clock() # not snubbed before it had a chance to send
             await self._request_piece(peer)
 
         elif msg_id == 2:
-            self.logger.debug('Peer {} sent INTERESTED message'.format(peer.address))
+            peer.interested = True
+            # no need to wait for the next choke round while there is a free slot
+            if peer.am_choking and self.choker.has_free_slot(self.active_peers):
+                peer.am_choking = False
+                peer.outbound.add(UNCHOKE)
 
         elif msg_id == 3:
-            self.logger.debug('Peer {} sent NOT INTERESTED message'.format(peer.address))
+            peer.interested = False
 
         elif msg_id == 4:
             # peer tells what other pieces it has
             # we need to update our record
-            self.logger.debug('Peer {} sent HAVE message'.format(peer.address))
             index = struct.unpack('!i', payload)[0]
-            self.logger.info('{} has piece {}'.format(peer.address['host'], index))
-            no_pieces = len(peer.queue) == 0
-            peer.queue.add(index)
-            if no_pieces:
-                await self._request_piece(peer)
+            if 0 <= index < self.torrent.number_of_pieces and index not in peer.have:
+                peer.have.add(index)
+                self.picker.peer_has(index)
+                if index not in self.picker.unwanted:
+                    if not peer.am_interested:
+                        peer.am_interested = True
+                        peer.outbound.add(INTERESTED)
+                    await self._request_piece(peer)
 
         elif msg_id == 5:
             # message payload is what pieces the peer has, labeled by indexes
             # we need to keep a record of what the peer has
-            self.logger.debug('Peer {} sent BITFIELD message'.format(peer.address))
-            no_pieces = len(peer.queue) == 0
-            # peer.pieces = BitArray(payload)
-            b = bytearray(payload)
-            bitstring = ''.join([bin(x)[2:] for x in b])
-            pieces_indexes = [i for i, x in enumerate(bitstring) if x == '1']
-            for index in pieces_indexes:
-                peer.queue.add(index)
-
-            self.logger.info('{} has {}'.format(peer.address['host'], pieces_indexes))
-            if no_pieces:
-                await self._request_piece(peer)
+            try:
+                have = Bitfield.from_bytes(payload, self.torrent.number_of_pieces)
+            except ValueError as e:
+                self.logger.info('{} sent a bad bitfield: {}'.format(peer.address, e))
+                self._close_connection(peer)
+                return
+            self._forget_pieces(peer)
+            peer.have = have
+            if have.all():
+                peer.seed = True
+                self.picker.seed_joined()
+            else:
+                self.picker.peer_has_pieces(have)
+            self.logger.info('{} has {} of {} pieces'.format(
+                peer.address['host'], len(have), self.torrent.number_of_pieces))
+            self._update_interest(peer)
+            await self._request_piece(peer)
 
         elif msg_id == 6:
-            self.logger.debug('Peer {} sent REQUEST message'.format(peer.address))
+            index, begin_offset, length = struct.unpack('!III', payload)
+            self.uploader.request(peer, index, begin_offset, length)
 
         elif msg_id == 7:
-            # self.logger.debug('Peer {} sent PIECE message'.format(peer.address))
             await self._handle_piece_msg(payload, peer)
 
         elif msg_id == 8:
-            self.logger.debug('Peer {} sent CANCEL message'.format(peer.address))
-
-    def _request_message(self, block):
-        message_id = b'\x06'
-        message_length = bytes([0, 0, 0, 13])
-
-        msg = b''.join([
-            message_length,
-            message_id,
-            struct.pack('!I', block['index']),
-            struct.pack('!I', block['begin_offset']),
-            struct.pack('!I', block['request_length'])
-            ])
-
-        return msg
+            index, begin_offset, length = struct.unpack('!III', payload)
+            self.uploader.cancel(peer, index, begin_offset, length)
 
     async def _request_piece(self, peer):
+        """
+        keep the peer's request window full instead of waiting
+        for every block before asking for the next one
+        """
 
-        if not peer.choked:
-            while len(peer.queue) > 0:
-                index_left = set()
-                for b in peer.queue.queue:
-                    index_left.add(b['index'])
-                # self.logger.info('peer queue {}'.format(index_left))
-                # self.logger.info('{} blocks left to request from {}'.format(len(peer.queue.queue), peer.address['host']))
-                block = peer.queue.pop()
-                if self.pieces.needed(block):
-                    try:
-                        peer.writer.write(self._request_message(block))
-                        await peer.writer.drain()
-                    except Exception as e:
-                        self.logger.error(e)
-                    # self.logger.info('requested {} from {}'.format(block, peer.address['host']))
-                    self.pieces.add_requested(block)
+        if self._fill_window(peer):
+            try:
+                await peer.outbound.drain()
+            except Exception as e:
+                self.logger.error(e)
+
+    def _fill_window(self, peer):
+        """
+        queue requests while the window has room and the rate limits allow,
+        returns how many. if a limit stops us this runs again once it lets up.
+        """
+
+        if peer.choked:
+            return 0
+
+        sent = 0
+        while peer.window.has_room() and peer.download_throttle.ready(peer.fill_window):
+            block = self.picker.pick(peer.have)
+            if block is None:
+                block = self._pick_duplicate(peer)
+                if block is None:
                     break
+            elif self.endgame.active:
+                self.endgame.add(peer, block)
+            peer.window.add(block)
+            if block['index'] not in self.piece_started:
+                self.piece_started[block['index']] = self.loop.time()
+            # goes out together with everything else queued this loop iteration
+            peer.outbound.request(block['index'], block['begin_offset'], block['request_length'])
+            peer.download_throttle.take(block['request_length'])
+            sent += 1
+        return sent
+
+    def _pick_duplicate(self, peer):
+        """ once everything is requested, ask for blocks other peers are slow with """
+
+        if not self.end_game:
+            return None
+        if not self.endgame.active:
+            if not self.picker.everything_requested():
+                return None
+            self.endgame.start(self.active_peers)
+        return self.endgame.pick(peer)
 
     async def _handle_piece_msg(self, message_payload, peer):
         """ save blocks sent from peer """
 
-        index = struct.unpack('!i', message_payload[:4])[0]
-        begin_offset = struct.unpack('!i', message_payload[4:8])[0]
-        payload = message_payload[8:]
+        if len(message_payload) < 8:
+            self._misbehaved(peer, 'sent a PIECE of {} bytes'.format(len(message_payload)))
+            return
+        index, begin_offset = struct.unpack_from('!II', message_payload)
+        payload = memoryview(message_payload)[8:]
+        if not self.pieces.valid_block(index, begin_offset, len(payload)):
+            # checked before anything is stored, in either storage mode
+            self._misbehaved(peer, 'sent {} bytes at {} of piece {}, which is no block of ours'.format(
+                len(payload), begin_offset, index))
+            return
+        peer.window.completed(index, begin_offset, len(payload))
+        if self.endgame.active:
+            for other in self.endgame.received(peer, index, begin_offset):
+                if other.window.cancel(index, begin_offset):
+                    other.outbound.cancel(index, begin_offset, len(payload))
+        peer.download_rate.add(len(payload))
+        peer.downloaded += len(payload)
+        self.received += len(payload)
+        peer.last_block = peer.clock()
+        senders = self.contributors.get(index)
+        if senders is None:
+            self.contributors[index] = {begin_offset: peer}
+        else:
+            # the first copy of a block is the one kept
+            senders.setdefault(begin_offset, peer)
         block = {
             'index': index,
             'begin_offset': begin_offset,
@@ -270,29 +709,95 @@ class TorrentClient():
             'payload': payload
         }
 
-        # self.logger.info('got a block from {}, {}, {}'.format(peer.address, block['index'], block['begin_offset']))
         piece_index, piece = self.pieces.add_received(block)
 
-        if piece is not None:
-            hashed_piece = sha1(piece).digest()
-            # self.logger.info(self.torrent.piece_hash_list[piece_index])
-            # self.logger.info(hashed_piece)
-            if self.torrent.piece_hash_list[piece_index] == hashed_piece:
-                self.pieces_downloaded.append(piece_index)
-
-                self.logger.info('we have piece {}'.format(piece_index))
-                self.logger.info('downloaded: {}, total: {}'.format(len(self.pieces_downloaded), self.torrent.number_of_pieces))
-                try:
-                    self.file_manager.write(piece_index, piece)
-                except IOError as e:
-                    self.logger.error(e)
-                if len(self.pieces_downloaded) == self.torrent.number_of_pieces:
-                    self.logger.info('finished downloading!!!')
-                    return
-                # self.logger.info('percentage {:.2f}%'.format((len(self.pieces_downloaded) * 100) / self.torrent.number_of_pieces))
-            else:
-                self.pieces.discard_piece(piece_index)
-                for p in self.active_peers:
-                    p.queue.add(piece_index)
+        if piece_index is not None:
+            # waits here while the hash and disk queue is full,
+            # so we stop reading from this peer until it drains
+            await self.verifier.acquire()
+            asyncio.ensure_future(self._finish_piece(piece_index, piece))
 
         await self._request_piece(peer)
+
+    async def _finish_piece(self, piece_index, piece):
+        """ verify a complete piece, write it out and let the picker know """
+
+        try:
+            good = await self.verifier.verify(piece_index, piece)
+        except (IOError, RuntimeError, BrokenProcessPool) as e:
+            # a failed write or a shut down or broken executor, not the
+            # peers' fault. the piece is fetched again and nobody is blamed
+            self.logger.error('could not verify piece {}: {!r}'.format(piece_index, e))
+            good = None
+
+        senders = self.contributors.pop(piece_index, {})
+        started = self.piece_started.pop(piece_index, None)
+        if good:
+            if started is not None:
+                self.piece_latency.observe(self.loop.time() - started)
+            self.pieces_downloaded.append(piece_index)
+            self.torrent.left -= self.torrent.piece_length(piece_index)
+            self.downloaded += self.torrent.piece_length(piece_index)
+            self.picker.piece_done(piece_index)
+            guilty = self._guilty(piece_index, piece)
+            self.pieces.release_piece(piece_index)
+            self.streamer.piece_done(piece_index)
+            for p in self.active_peers:
+                if p.outbound is None:
+                    continue
+                if piece_index not in p.have:
+                    p.outbound.have(piece_index)
+                elif p.am_interested:
+                    # that may have been the last piece we wanted from it
+                    self._update_interest(p)
+            # only once the piece is dealt with, a ban closes connections
+            for peer in guilty:
+                self.connections.hash_failed(peer)
+
+            if len(self.pieces_downloaded) == self.torrent.number_of_pieces:
+                self._log_progress()
+                self.logger.info('finished downloading!!!')
+                self.announcer.completed()
+                return
+            if self.picker.finished():
+                self.logger.info('finished the files we want')
+                return
+        elif good is None:
+            self.pieces.discard_piece(piece_index)
+            self.picker.piece_failed(piece_index)
+        else:
+            guilty = self._suspect(piece_index, piece, senders)
+            self.pieces.discard_piece(piece_index)
+            self.picker.piece_failed(piece_index)
+            for peer in guilty:
+                self.connections.hash_failed(peer)
+
+        # a buffer was freed, peers that ran out of work can start a new piece
+        for p in self.active_peers:
+            if len(p.window) == 0:
+                await self._request_piece(p)
+
+    def _suspect(self, piece_index, piece, senders):
+        """
+        a piece failed the hash check, returns the peers to blame. a peer
+        that sent all of it is, when several did we remember what each one
+        sent and find the bad blocks once the piece comes in good.
+        """
+
+        peers = set(senders.values())
+        if len(peers) <= 1 or piece is None:
+            return peers
+        suspects = self.suspects.setdefault(piece_index, [])
+        for begin, peer in senders.items():
+            block = piece[begin:begin + self.torrent.REQUEST_LENGTH]
+            suspects.append((begin, peer, sha1(block).digest()))
+        return ()
+
+    def _guilty(self, piece_index, piece):
+        """ the piece is good, the peers that sent other blocks of it before """
+
+        guilty = set()
+        for begin, peer, digest in self.suspects.pop(piece_index, ()):
+            if sha1(piece[begin:begin + self.torrent.REQUEST_LENGTH]).digest() != digest:
+                guilty.add(peer)
+        return guilty
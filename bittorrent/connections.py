@@ -0,0 +1,321 @@
+import heapq
+import logging
+
+DEFAULT_MAX_ACTIVE = 50
+DEFAULT_MAX_HALF_OPEN = 8
+CONNECT_TIMEOUT = 10
+HANDSHAKE_TIMEOUT = 10
+BACKOFF_BASE = 5
+MAX_BACKOFF = 30 * 60
+MAX_FAILURES = 8      # attempts in a row before a candidate is forgotten
+MAX_HASH_FAILURES = 3 # bad pieces a peer may be blamed for before it is banned
+EVICT_INTERVAL = 30
+MIN_CONNECTED_TIME = 60 # how long a peer gets to prove itself before it can be evicted
+EVICT_BACKOFF = 5 * 60  # first wait before an evicted peer gets another chance
+
+
+class Candidate():
+    """ an address we know about, connected or not """
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.peer = None # Peer of the latest connection
+        self.failures = 0
+        self.hash_failures = 0
+        self.banned = False
+        self.connected_at = None
+        self.inbound = False # it connected to us, the port is not one to call back
+        self.evictions = 0   # times it was dropped to make room, kept across connections
+        self.evicted = False # the current connection is being dropped to make room
+        self.not_before = 0  # loop time until which it is not let back in
+
+
+class ConnectionBudget():
+    """
+    connection limits shared by the connection managers of a session, on
+    top of their own. when a slot frees up the managers are woken in turn,
+    so a torrent with candidates waiting can use it.
+    """
+
+    def __init__(self, max_active, max_half_open):
+        self.max_active = max_active
+        self.max_half_open = max_half_open
+        self.active = 0
+        self.half_open = 0
+        self.managers = []
+
+    def has_room(self, outbound=True):
+        if outbound and self.half_open >= self.max_half_open:
+            return False
+        return self.active + self.half_open < self.max_active
+
+    def opening(self):
+        self.half_open += 1
+
+    def opened(self):
+        self.half_open -= 1
+        self.active += 1
+        self._wake()
+
+    def closed(self, was_active):
+        if was_active:
+            self.active -= 1
+        else:
+            self.half_open -= 1
+        self._wake()
+
+    def _wake(self):
+        if self.managers:
+            # take turns at who gets the first go at the free slot
+            self.managers.append(self.managers.pop(0))
+            for manager in list(self.managers):
+                manager.fill()
+
+
+class ConnectionManager():
+    """
+    decides which of the known peers we are connected to.
+
+    candidates wait in a heap ordered by when they may be tried next, and
+    only the connections actually being made or in use have a coroutine,
+    so thousands of candidates cost a few objects each. at most
+    `max_half_open` connections are being opened at once and at most
+    `max_active` are open in total.
+
+    failed attempts are retried with exponential backoff. every
+    EVICT_INTERVAL, if we are full and someone is waiting, the connected
+    peer with the worst score is dropped to make room, and peers that sent
+    us bad pieces too often are banned. an evicted peer, outbound or
+    inbound, is kept out for EVICT_BACKOFF, doubling every time it is
+    evicted again.
+
+    `connect(peer)` is the coroutine that runs a whole connection,
+    `new_peer(host, port)` makes the Peer for it, `close(peer)` drops one
+    and `score(peer)` rates a connected peer, 0 or less meaning useless.
+    retries and evictions run off the `timers` wheel. in a session the
+    limits of the shared `budget` apply as well.
+    """
+
+    def __init__(self, loop, timers, connect, new_peer, close, score,
+                 max_active=DEFAULT_MAX_ACTIVE, max_half_open=DEFAULT_MAX_HALF_OPEN,
+                 budget=None):
+        self.logger = logging.getLogger('main.connection_manager')
+        self.loop = loop
+        self.timers = timers
+        self.connect = connect
+        self.new_peer = new_peer
+        self.close = close
+        self.score = score
+        self.max_active = max_active
+        self.max_half_open = max_half_open
+        self.budget = budget
+        self.candidates = {} # (host, port) -> Candidate
+        self.waiting = []    # heap of (time of next attempt, sequence, candidate)
+        self.sequence = 0
+        self.tasks = {}      # Candidate -> task running its connection
+        self.active = set()  # candidates that completed the handshake
+        self.timer = None
+        self.wake_time = None
+        self.evict_timer = None
+        self.running = False
+        self._closed = None
+
+    @property
+    def half_open(self):
+        return len(self.tasks) - len(self.active)
+
+    @property
+    def peers(self):
+        return [c.peer for c in self.candidates.values() if c.peer is not None]
+
+    def add(self, peers):
+        """ new candidates from a tracker, as dicts with hostname and port """
+
+        now = self.loop.time()
+        for p in peers or []:
+            key = (p['hostname'], p['port'])
+            if key not in self.candidates:
+                candidate = Candidate(*key)
+                self.candidates[key] = candidate
+                self._push(candidate, now)
+        self.fill()
+
+    def _push(self, candidate, when):
+        self.sequence += 1
+        heapq.heappush(self.waiting, (when, self.sequence, candidate))
+
+    def fill(self):
+        """ start connecting to waiting candidates while there is room """
+
+        if not self.running:
+            return
+        now = self.loop.time()
+        while (self.waiting and self.half_open < self.max_half_open and
+                len(self.tasks) < self.max_active and
+                (self.budget is None or self.budget.has_room())):
+            when, _, candidate = self.waiting[0]
+            if when > now:
+                self._wake_at(when)
+                break
+            heapq.heappop(self.waiting)
+            if candidate.banned or candidate in self.tasks:
+                continue
+            self._start(candidate, self.connect)
+
+    def accept(self, host, port, serve):
+        """
+        take a connection the peer opened, `serve(peer)` runs it. returns
+        False when there is no room for it or the address is banned.
+        """
+
+        if not self.running or len(self.tasks) >= self.max_active:
+            return False
+        if self.budget is not None and not self.budget.has_room(outbound=False):
+            return False
+        candidate = self.candidates.get((host, port))
+        if candidate is None:
+            candidate = Candidate(host, port)
+            candidate.inbound = True
+            self.candidates[(host, port)] = candidate
+        elif (candidate.banned or candidate in self.tasks or
+                self.loop.time() < candidate.not_before):
+            return False
+        self._start(candidate, serve)
+        return True
+
+    def _start(self, candidate, connect):
+        if self.budget is not None:
+            self.budget.opening()
+        self.tasks[candidate] = self.loop.create_task(self._run(candidate, connect))
+
+    def _wake_at(self, when):
+        if self.timer is not None:
+            if self.wake_time <= when:
+                return
+            self.timer.cancel()
+        self.wake_time = when
+        self.timer = self.timers.call_later(when - self.loop.time(), self._wake)
+
+    def _wake(self):
+        self.timer = None
+        self.fill()
+
+    async def _run(self, candidate, connect):
+        peer = self.new_peer(candidate.host, candidate.port)
+        candidate.peer = peer
+        peer.candidate = candidate
+        try:
+            await connect(peer)
+        finally:
+            self._finished(candidate)
+
+    def connected(self, peer):
+        """ the handshake went through """
+
+        candidate = peer.candidate
+        candidate.failures = 0
+        candidate.connected_at = self.loop.time()
+        self.active.add(candidate)
+        if self.budget is not None:
+            self.budget.opened()
+        self.fill()
+
+    def _finished(self, candidate):
+        self.tasks.pop(candidate, None)
+        was_active = candidate in self.active
+        self.active.discard(candidate)
+        if self.budget is not None:
+            self.budget.closed(was_active)
+        if not self.running:
+            return
+        if candidate.banned:
+            self.logger.info('banned {}:{}'.format(candidate.host, candidate.port))
+        elif candidate.evicted:
+            # a working connection we had no use for, trying again soon
+            # would only get it evicted again
+            candidate.evicted = False
+            delay = min(EVICT_BACKOFF * 2 ** (candidate.evictions - 1), MAX_BACKOFF)
+            candidate.not_before = self.loop.time() + delay
+            if not candidate.inbound:
+                self._push(candidate, candidate.not_before)
+        elif candidate.inbound:
+            del self.candidates[(candidate.host, candidate.port)]
+        else:
+            candidate.failures += 1
+            if candidate.failures > MAX_FAILURES:
+                del self.candidates[(candidate.host, candidate.port)]
+            else:
+                delay = min(BACKOFF_BASE * 2 ** (candidate.failures - 1), MAX_BACKOFF)
+                self._push(candidate, self.loop.time() + delay)
+        self.fill()
+
+    def hash_failed(self, peer):
+        """ `peer` sent blocks of a piece that failed the hash check """
+
+        candidate = getattr(peer, 'candidate', None)
+        if candidate is None:
+            return
+        candidate.hash_failures += 1
+        if candidate.hash_failures >= MAX_HASH_FAILURES and not candidate.banned:
+            candidate.banned = True
+            # `peer` may be an earlier connection, the blame can come late
+            if candidate in self.active:
+                self.close(candidate.peer)
+            elif candidate in self.tasks:
+                # still connecting, there is no connection to close yet
+                self.tasks[candidate].cancel()
+
+    def misbehaved(self, peer):
+        """
+        `peer` sent something no working client sends, like a block that is
+        not one of ours. it is banned, the caller closes the connection.
+        """
+
+        candidate = getattr(peer, 'candidate', None)
+        if candidate is not None:
+            candidate.banned = True
+
+    def _evict(self):
+        now = self.loop.time()
+        if (len(self.active) < self.max_active or not self.waiting or
+                self.waiting[0][0] > now):
+            return
+        settled = [c for c in self.active if now - c.connected_at >= MIN_CONNECTED_TIME]
+        if not settled:
+            return
+        worst = min(settled, key=lambda c: self.score(c.peer))
+        if self.score(worst.peer) <= 0:
+            self.logger.info('evicting {}:{}'.format(worst.host, worst.port))
+            worst.evictions += 1
+            worst.evicted = True
+            self.close(worst.peer)
+
+    async def run(self):
+        """ keep connections going until `stop` is called """
+
+        self.running = True
+        if self.budget is not None:
+            self.budget.managers.append(self)
+        self._closed = self.loop.create_future()
+        self.evict_timer = self.timers.every(EVICT_INTERVAL, self._evict)
+        self.fill()
+        try:
+            await self._closed
+        finally:
+            self.stop()
+
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        if self.budget is not None and self in self.budget.managers:
+            self.budget.managers.remove(self)
+        for timer in (self.timer, self.evict_timer):
+            if timer is not None:
+                timer.cancel()
+        self.timer = None
+        for task in list(self.tasks.values()):
+            task.cancel()
+        if self._closed is not None and not self._closed.done():
+            self._closed.set_result(None)
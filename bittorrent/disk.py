@@ -0,0 +1,133 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait
+
+IO_WORKERS = 2
+
+
+class DiskScheduler():
+    """
+    one set of disk threads for every torrent of a session.
+
+    pieces to write are queued and handed to the threads in batches, at
+    most one batch per thread at a time. whatever piles up while the threads
+    are busy goes out as the next batch, sorted by file and offset, so a
+    busy disk sees fewer, more sequential writes and one torrent cannot
+    keep the others waiting behind a long queue of its own.
+
+    reads and other blocking storage calls go through `run`, on the same
+    threads.
+    """
+
+    def __init__(self, loop, workers=IO_WORKERS):
+        self.logger = logging.getLogger('main.disk_scheduler')
+        self.loop = loop
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(workers)
+        self.queue = []       # (file_manager, piece index, data, future)
+        self.busy = 0         # batches handed to the threads
+        self.in_flight = set() # their concurrent futures, for `drain`
+        self.unwritten = {}    # future of every write not on disk yet -> its file_manager
+        self.batches = 0
+        self.writes = 0
+
+    def write(self, file_manager, piece_index, data):
+        """ write a piece, the returned future is done once it is on disk """
+
+        future = self.loop.create_future()
+        self.queue.append((file_manager, piece_index, data, future))
+        self.unwritten[future] = file_manager
+        future.add_done_callback(self._written)
+        if self.busy < self.workers:
+            self._dispatch()
+        return future
+
+    def _written(self, future):
+        del self.unwritten[future]
+
+    def run(self, func, *args):
+        return self.loop.run_in_executor(self.executor, func, *args)
+
+    def _dispatch(self):
+        batch = self._take()
+        self.busy += 1
+        job = self.executor.submit(self._write_batch, batch)
+        self.in_flight.add(job)
+        job.add_done_callback(self._batch_done)
+
+    def _take(self):
+        batch, self.queue = self.queue, []
+        batch.sort(key=lambda job: (id(job[0]), job[1]))
+        self.batches += 1
+        self.writes += len(batch)
+        return batch
+
+    def _write_batch(self, batch):
+        """ runs on a disk thread """
+
+        results = []
+        for file_manager, piece_index, data, future in batch:
+            try:
+                file_manager.write(piece_index, data)
+                results.append((future, None))
+            except Exception as e:
+                results.append((future, e))
+        return results
+
+    def _batch_done(self, job):
+        """ runs on the disk thread that finished `job` """
+
+        try:
+            self.loop.call_soon_threadsafe(self._resolve, job)
+        except RuntimeError:
+            # the loop is closed, nobody is waiting anymore
+            pass
+
+    def _resolve(self, job):
+        self.busy -= 1
+        self.in_flight.discard(job)
+        self._settle(job.result())
+        if self.queue and self.busy < self.workers:
+            self._dispatch()
+
+    def _settle(self, results):
+        for future, error in results:
+            if future.done():
+                continue
+            if error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(error)
+
+    def collect_metrics(self, labels):
+        yield 'bittorrent_disk_queue_depth', labels, len(self.queue)
+        yield 'bittorrent_disk_busy_threads', labels, self.busy
+        yield 'bittorrent_disk_writes_total', labels, self.writes
+        yield 'bittorrent_disk_batches_total', labels, self.batches
+
+    async def flush(self, file_manager=None):
+        """
+        wait until the writes handed in so far, only those of `file_manager`
+        if given, are on disk. unlike `drain` the loop keeps running.
+        """
+
+        futures = [future for future, owner in self.unwritten.items()
+                   if file_manager is None or owner is file_manager]
+        if futures:
+            await asyncio.wait(futures)
+
+    def drain(self):
+        """ block until every write handed in so far is on disk """
+
+        job = None
+        if self.queue:
+            job = self.executor.submit(self._write_batch, self._take())
+            self.in_flight.add(job)
+        wait(list(self.in_flight))
+        if job is not None:
+            self.in_flight.discard(job)
+            self._settle(job.result())
+
+    def close(self):
+        self.drain()
+        self.executor.shutdown(wait=True)
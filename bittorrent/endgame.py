@@ -0,0 +1,97 @@
+import logging
+
+DEFAULT_MAX_COPIES = 2
+DEFAULT_MAX_DUPLICATES = 256
+
+
+class EndGame():
+    """
+    the last blocks of a download tend to sit in the window of the slowest
+    peer. once every missing block has been requested, peers with room in
+    their window ask for blocks that are already in flight elsewhere, and
+    whoever delivers first wins, the others get a CANCEL.
+
+    a block is requested from at most `max_copies` peers, and at most
+    `max_duplicates` extra requests are outstanding at any time, so the
+    duplicate traffic stays bounded.
+    """
+
+    def __init__(self, max_copies=DEFAULT_MAX_COPIES, max_duplicates=DEFAULT_MAX_DUPLICATES):
+        self.logger = logging.getLogger('main.end_game')
+        self.max_copies = max_copies
+        self.max_duplicates = max_duplicates
+        self.active = False
+        self.requesters = {} # (index, begin_offset) -> peers the block is requested from
+        self.blocks = {}     # (index, begin_offset) -> block
+        self.duplicates = 0  # outstanding requests beyond the first of each block
+        self.cancels = 0
+
+    def start(self, peers):
+        self.active = True
+        for peer in peers:
+            for block, _ in peer.window.outstanding.values():
+                self.add(peer, block)
+        self.logger.info('end game with {} blocks in flight'.format(len(self.blocks)))
+
+    def add(self, peer, block):
+        """ `block` was requested from `peer` """
+
+        key = (block['index'], block['begin_offset'])
+        peers = self.requesters.get(key)
+        if peers is None:
+            self.requesters[key] = [peer]
+            self.blocks[key] = block
+        elif peer not in peers:
+            peers.append(peer)
+            self.duplicates += 1
+
+    def pick(self, peer):
+        """ a block in flight elsewhere that `peer` could send us too, or None """
+
+        if self.duplicates >= self.max_duplicates:
+            return None
+        best = None
+        fewest = self.max_copies
+        # oldest requests first, they are the likeliest to be stuck
+        for key, peers in self.requesters.items():
+            if len(peers) < fewest and key[0] in peer.have and peer not in peers:
+                best = key
+                fewest = len(peers)
+                if fewest == 1:
+                    break
+        if best is None:
+            return None
+        block = self.blocks[best]
+        self.add(peer, block)
+        return block
+
+    def received(self, peer, index, begin_offset):
+        """ the block arrived from `peer`, returns the peers to cancel it with """
+
+        key = (index, begin_offset)
+        peers = self.requesters.pop(key, None)
+        if peers is None:
+            return []
+        del self.blocks[key]
+        self.duplicates -= len(peers) - 1
+        others = [p for p in peers if p is not peer]
+        self.cancels += len(others)
+        return others
+
+    def released(self, peer, block):
+        """
+        `peer` will not send the block after all. returns True if it is
+        still requested from someone else.
+        """
+
+        key = (block['index'], block['begin_offset'])
+        peers = self.requesters.get(key)
+        if peers is None or peer not in peers:
+            return False
+        peers.remove(peer)
+        if peers:
+            self.duplicates -= 1
+            return True
+        del self.requesters[key]
+        del self.blocks[key]
+        return False
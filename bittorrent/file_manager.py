@@ -1,132 +1,253 @@
 import os
+import mmap
 import logging
+from hashlib import sha1
+from bisect import bisect_right
+
+
+class PositionalStorage():
+    """ reads and writes files with pread/pwrite """
+
+    # pieces are assembled in memory and written once verified
+    writes_blocks = False
+
+    def __init__(self, files):
+        self.files = files
+
+    def write(self, f, file_offset, data):
+        while data:
+            written = os.pwrite(f['descriptor'], data, file_offset)
+            data = data[written:]
+            file_offset += written
+
+    def read(self, f, file_offset, length):
+        return os.pread(f['descriptor'], length, file_offset)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class MmapStorage():
+    """
+    maps every file into memory. blocks are copied straight from the
+    received message into the mapping and pieces are hashed in place.
+    """
+
+    writes_blocks = True
+
+    def __init__(self, files):
+        self.files = files
+        for f in files:
+            if f['length'] > 0:
+                f['map'] = mmap.mmap(f['descriptor'], f['length'])
+
+    def write(self, f, file_offset, data):
+        f['map'][file_offset:file_offset + len(data)] = data
+
+    def read(self, f, file_offset, length):
+        return memoryview(f['map'])[file_offset:file_offset + length]
+
+    def flush(self):
+        for f in self.files:
+            if 'map' in f:
+                f['map'].flush()
+
+    def close(self):
+        for f in self.files:
+            if 'map' in f:
+                f['map'].flush()
+                f['map'].close()
+        self.files = []
+
+
+# pwrite is the default, it is the faster one. mmap assembles no pieces in
+# memory, for big pieces downloaded many at a time. see benchmarks/bench_mmap.py
+STORAGE = {
+    'pwrite': PositionalStorage,
+    'mmap': MmapStorage,
+}
+
 
 class FileManager():
+    """
+    writes pieces straight into the destination files.
+
+    the torrent's files are laid end to end, `file_offsets` holds where each
+    one starts, so the files a piece covers can be found with a bisect.
+    the actual reading and writing is done by one of the STORAGE backends.
+    """
 
-    def __init__(self, torrent, destination):
+    def __init__(self, torrent, destination, preallocate=False, storage='pwrite'):
         self.logger = logging.getLogger('main.file_manager')
         self.torrent = torrent
         self.destination = destination
+        self.preallocate = preallocate
+        self.piece_length = self.torrent.standard_piece_length
         info_dict = self.get_files_info()
         self.create_dir_file(info_dict)
+        self.storage = STORAGE[storage](self.files)
 
+    @property
+    def writes_blocks(self):
+        """ whether blocks go to storage as they arrive instead of whole pieces """
+        return self.storage.writes_blocks
 
-    def get_files_info(self):
 
-        if 'length' in self.torrent.info:
+    def get_files_info(self):
 
-            length = self.torrent.info['length']
-            name = self.torrent.info['name']
-            mode = 'single'
+        if not self.torrent.multi_file:
+            (name,), length = self.torrent.files[0]
             return {
                 'length': length,
                 'name': name,
-                'mode': mode
+                'mode': 'single'
             }
 
         else:
-            multi_files = self.torrent.info['files']
             files = []
 
-            for f in multi_files:
+            for path, length in self.torrent.files:
                 files.append({
-                    'name': f['path'][0],
-                    'length': f['length'],
+                    'name': os.path.join(*path),
+                    'length': length,
                     'length_written': 0,
                 })
 
             files_info = {}
-            files_info['dirname'] = self.torrent.info['name']
+            files_info['dirname'] = self.torrent.name
             files_info['files'] = files
             files_info['mode'] = 'multiple'
             return files_info
 
     def create_dir_file(self, info_dict):
 
-        self.files = []
+        destination = os.path.expanduser(self.destination)
         if info_dict['mode'] == 'multiple':
-            file_list = info_dict['files']
-            dir_path = os.path.join(
-                    os.path.expanduser(self.destination), info_dict['dirname'])
-
-            if not os.path.exists(dir_path):
-                os.makedirs(dir_path)
-
-            tmp_file_path = os.path.join(dir_path, 'tmp.tmp')
-            self.tmp_file_path = tmp_file_path
-            if not os.path.isfile(tmp_file_path):
-                self.tmp_file = open(tmp_file_path, 'wb')
-                self.tmp_file.close()
-
-            self.tmp_file = open(tmp_file_path, 'r+b')
-            self.tmp_file.truncate()
-            self.tmp_file_length = 0
-
-            for f in file_list:
-                file_path = os.path.join(dir_path, f['name'])
-
-                if os.path.isfile(file_path):
-                    os.remove(file_path)
-
-                fd = open(file_path, 'wb')
-                # fd.close()
-                self.files.append({
-                    'descriptor': fd,
-                    'length_to_write': f['length'],
-                })
+            dir_path = os.path.join(destination, info_dict['dirname'])
+            file_list = [(os.path.join(dir_path, f['name']), f['length'])
+                         for f in info_dict['files']]
         else:
-            file_path = os.path.join(
-                    os.path.expanduser(self.destination), info_dict['name'])
-
-            if os.path.isfile(file_path):
-                os.remove(file_path)
-                fd = open(file_path, 'wb')
-                # fd.close()
-                self.files.append({
-                    'descriptor': fd,
-                    'length_to_write': f['length'],
-                })
-            else:
-                raise IOError('file already exists.')
+            file_list = [(os.path.join(destination, info_dict['name']), info_dict['length'])]
 
-    def write(self, piece_index, data):
+        self.files = []
+        self.file_offsets = []
+        offset = 0
+        made = set()
+        for file_path, length in file_list:
+            dir_path = os.path.dirname(file_path)
+            if dir_path and dir_path not in made:
+                os.makedirs(dir_path, exist_ok=True)
+                made.add(dir_path)
+
+            # existing files are kept so an interrupted download can resume
+            fd = os.open(file_path, os.O_RDWR | os.O_CREAT, 0o644)
+            size = os.fstat(fd).st_size
+            if size == 0:
+                self._allocate(fd, length)
+            elif size != length:
+                os.ftruncate(fd, length)
+            self.files.append({
+                'path': file_path,
+                'descriptor': fd,
+                'length': length,
+                'existed': size > 0,
+            })
+            self.file_offsets.append(offset)
+            offset += length
+
+    def _allocate(self, fd, length):
+        """ give the file its final size, sparse unless asked to preallocate """
+
+        if length == 0:
+            return
+        if self.preallocate and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(fd, 0, length)
+                return
+            except OSError as e:
+                self.logger.debug('fallocate: {}'.format(e))
+        os.ftruncate(fd, length)
+
+    def spans(self, piece_index, length, begin=0):
         """
-        because pieces dont come in in order,
-        we need to put pieces in order in a temporary file first.
-        once we have all the pieces in order in the temporary file,
-        write to actual files in order
+        yield (file, offset in file, start, end) for every file the `length`
+        bytes at `begin` within the piece cover, start and end being
+        positions relative to `begin`
         """
 
-        offset = piece_index * len(data)
-        self.tmp_file.seek(offset)
-        self.tmp_file.write(data)
-        self.tmp_file_length += len(data)
-        # self.tmp_file_length = os.path.getsize(self.tmp_file_path)
-        total_file_length = self.torrent.file_length()
-        self.logger.debug('writing to tmp file: {}, total length: {}'.format(os.path.getsize(self.tmp_file_path), total_file_length))
-        if self.tmp_file_length == total_file_length:
-            # close tmp file for writing
-            self.tmp_file.close()
-            # open for reading
-            with open(self.tmp_file_path, 'r+b') as fd:
-                content = fd.read()
-                self.logger.debug(len(content))
-                self.write_to_file(content)
-
-    def write_to_file(self, content):
-
-        self.logger.debug('start writing to actual files')
+        offset = piece_index * self.piece_length + begin
+        i = bisect_right(self.file_offsets, offset) - 1
+        start = 0
+        while start < length and i < len(self.files):
+            f = self.files[i]
+            file_offset = offset + start - self.file_offsets[i]
+            end = min(length, start + f['length'] - file_offset)
+            if end > start:
+                yield f, file_offset, start, end
+                start = end
+            i += 1
+
+    def file_pieces(self, file_index):
+        """ indexes of the pieces that hold part of the file """
+
+        offset = self.file_offsets[file_index]
+        length = self.files[file_index]['length']
+        if length == 0:
+            return range(0)
+        return range(offset // self.piece_length, (offset + length - 1) // self.piece_length + 1)
+
+    def has_existing_data(self, piece_index):
+        """ whether the piece lies entirely in files that were there before we started """
+
+        length = self.torrent.piece_length(piece_index)
+        return all(f['existed'] for f, _, _, _ in self.spans(piece_index, length))
+
+    def file_stats(self):
+        """ current (size, mtime) of every file """
+
+        stats = []
         for f in self.files:
-            fd = f['descriptor']
-            length_to_write = f['length_to_write']
-            fd.seek(0)
-            fd.write(content[:length_to_write])
-            content = content[length_to_write:]
-
-            self.logger.debug('at pos {}'.format(fd.tell()))
-            self.logger.debug('length to write {}'.format(length_to_write))
-            self.logger.debug('wrote length: {}'.format(len(content[:length_to_write])))
-            self.logger.debug('finished writing to {}'.format(fd.name))
-            self.logger.debug('remaining content length: {}'.format(len(content[length_to_write:])))
-
-            fd.close()
+            stat = os.fstat(f['descriptor'])
+            stats.append((stat.st_size, stat.st_mtime_ns))
+        return stats
+
+    def advise_sequential(self):
+        if hasattr(os, 'posix_fadvise'):
+            for f in self.files:
+                os.posix_fadvise(f['descriptor'], 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+    def sync(self):
+        self.storage.flush()
+        for f in self.files:
+            os.fsync(f['descriptor'])
+
+    def write(self, piece_index, data, begin=0):
+        data = memoryview(data)
+        for f, file_offset, start, end in self.spans(piece_index, len(data), begin):
+            self.storage.write(f, file_offset, data[start:end])
+
+    def write_block(self, piece_index, begin, data):
+        self.write(piece_index, data, begin)
+
+    def read(self, piece_index, begin, length):
+        """ returns a list of buffers that together hold the data """
+
+        return [self.storage.read(f, file_offset, end - start)
+                for f, file_offset, start, end in self.spans(piece_index, length, begin)]
+
+    def hash_piece(self, piece_index):
+        """ sha1 of the piece as it is in storage """
+
+        h = sha1()
+        for chunk in self.read(piece_index, 0, self.torrent.piece_length(piece_index)):
+            h.update(chunk)
+        return h.digest()
+
+    def close(self):
+        self.storage.close()
+        for f in self.files:
+            os.close(f['descriptor'])
+        self.files = []
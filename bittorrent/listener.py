@@ -0,0 +1,83 @@
+import errno
+import asyncio
+import logging
+
+from .protocol import PeerProtocol
+from .messages import PSTR
+from .connections import HANDSHAKE_TIMEOUT
+
+PORT_RANGE = 9          # 6881 taken, try up to 6889
+MAX_HANDSHAKING = 64    # connections that have not told us their torrent yet
+
+
+class Listener():
+    """
+    accepts peer connections on one port for any number of torrents. the
+    info hash in the peer's handshake picks the torrent, `lookup(info_hash)`
+    returns its client or None, and the client's `accept(protocol,
+    handshake)` says whether it takes the connection.
+
+    if `port` is taken the next few are tried, port 0 picks any free one.
+    """
+
+    def __init__(self, loop, lookup, host='0.0.0.0', port=0,
+                 max_handshaking=MAX_HANDSHAKING):
+        self.logger = logging.getLogger('main.listener')
+        self.loop = loop
+        self.lookup = lookup
+        self.host = host
+        self.port = port
+        self.max_handshaking = max_handshaking
+        self.server = None
+        self.handshaking = set()
+        self.accepted = 0
+        self.refused = 0
+
+    async def start(self):
+        ports = range(self.port, self.port + PORT_RANGE) if self.port else [0]
+        for port in ports:
+            try:
+                self.server = await self.loop.create_server(
+                        lambda: PeerProtocol(self.loop, on_connect=self._connected), self.host, port)
+                break
+            except OSError as e:
+                if e.errno != errno.EADDRINUSE or port == ports[-1]:
+                    raise
+                self.logger.info('port {} is taken'.format(port))
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.logger.info('listening on port {}'.format(self.port))
+        return self.port
+
+    def _connected(self, protocol):
+        if len(self.handshaking) >= self.max_handshaking:
+            self.refused += 1
+            protocol.close()
+            return
+        task = self.loop.create_task(self._handshake(protocol))
+        self.handshaking.add(task)
+        task.add_done_callback(self.handshaking.discard)
+
+    async def _handshake(self, protocol):
+        try:
+            handshake = await asyncio.wait_for(protocol.read_handshake(), HANDSHAKE_TIMEOUT)
+        except (asyncio.TimeoutError, TimeoutError, OSError):
+            handshake = None
+        client = None
+        if handshake is not None and handshake[1:20] == PSTR:
+            client = self.lookup(bytes(handshake[28:48]))
+        if client is not None and client.accept(protocol, handshake):
+            self.accepted += 1
+        else:
+            self.refused += 1
+            protocol.close()
+
+    def collect_metrics(self, labels):
+        yield 'bittorrent_inbound_accepted_total', labels, self.accepted
+        yield 'bittorrent_inbound_refused_total', labels, self.refused
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+        for task in list(self.handshaking):
+            task.cancel()
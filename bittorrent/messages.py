@@ -0,0 +1,135 @@
+"""
+encoding of peer wire protocol messages
+https://wiki.theory.org/BitTorrentSpecification#Messages
+"""
+
+import struct
+import logging
+
+CHOKE_ID = 0
+UNCHOKE_ID = 1
+INTERESTED_ID = 2
+NOT_INTERESTED_ID = 3
+HAVE_ID = 4
+BITFIELD_ID = 5
+REQUEST_ID = 6
+PIECE_ID = 7
+CANCEL_ID = 8
+
+KEEPALIVE = bytes([0, 0, 0, 0])
+CHOKE = bytes([0, 0, 0, 1]) + bytes([CHOKE_ID])
+UNCHOKE = bytes([0, 0, 0, 1]) + bytes([UNCHOKE_ID])
+INTERESTED = bytes([0, 0, 0, 1]) + bytes([INTERESTED_ID])
+NOT_INTERESTED = bytes([0, 0, 0, 1]) + bytes([NOT_INTERESTED_ID])
+
+PSTR = b'BitTorrent protocol'
+
+HEADER = struct.Struct('!IB')
+HAVE = struct.Struct('!IBI')
+BLOCK = struct.Struct('!IBIII') # REQUEST and CANCEL
+PIECE_HEADER = struct.Struct('!IBII')
+
+INITIAL_BUFFER = 4096
+
+
+def handshake(info_hash, peer_id):
+    return b''.join([bytes([len(PSTR)]), PSTR, bytes(8), info_hash, peer_id])
+
+
+def request(index, begin_offset, length):
+    return BLOCK.pack(13, REQUEST_ID, index, begin_offset, length)
+
+
+def cancel(index, begin_offset, length):
+    return BLOCK.pack(13, CANCEL_ID, index, begin_offset, length)
+
+
+def have(index):
+    return HAVE.pack(5, HAVE_ID, index)
+
+
+def bitfield(field):
+    return HEADER.pack(len(field) + 1, BITFIELD_ID) + field
+
+
+class OutboundQueue():
+    """
+    collects the messages for one peer and sends them together once per
+    loop iteration, so a burst of REQUESTs is one write instead of one
+    each. small messages are packed straight into a reusable buffer.
+    """
+
+    def __init__(self, loop, writer):
+        self.logger = logging.getLogger('main.outbound_queue')
+        self.loop = loop
+        self.writer = writer
+        self.buffer = bytearray(INITIAL_BUFFER)
+        self.size = 0
+        self.chunks = [] # already encoded data waiting in front of the buffer
+        self.scheduled = False
+        self.writes = 0
+        self.messages = 0
+        self.last_write = loop.time()
+
+    def _reserve(self, length):
+        if self.size + length > len(self.buffer):
+            self.buffer.extend(bytes(max(length, len(self.buffer))))
+        if not self.scheduled:
+            self.scheduled = True
+            self.loop.call_soon(self.flush)
+        self.messages += 1
+        offset = self.size
+        self.size += length
+        return offset
+
+    def request(self, index, begin_offset, length):
+        BLOCK.pack_into(self.buffer, self._reserve(BLOCK.size),
+                13, REQUEST_ID, index, begin_offset, length)
+
+    def cancel(self, index, begin_offset, length):
+        BLOCK.pack_into(self.buffer, self._reserve(BLOCK.size),
+                13, CANCEL_ID, index, begin_offset, length)
+
+    def have(self, index):
+        HAVE.pack_into(self.buffer, self._reserve(HAVE.size), 5, HAVE_ID, index)
+
+    def add(self, data):
+        """ queue an already encoded message """
+
+        if len(data) <= len(self.buffer) - self.size:
+            offset = self._reserve(len(data))
+            self.buffer[offset:offset + len(data)] = data
+        else:
+            self._seal()
+            self._reserve(0)
+            self.chunks.append(data)
+
+    def piece(self, index, begin_offset, data):
+        self._seal()
+        self._reserve(0)
+        self.chunks.append(PIECE_HEADER.pack(9 + len(data), PIECE_ID, index, begin_offset))
+        self.chunks.append(data)
+
+    def _seal(self):
+        # the transport may hold on to what we give it, so hand over a copy
+        if self.size:
+            self.chunks.append(bytes(memoryview(self.buffer)[:self.size]))
+            self.size = 0
+
+    def flush(self):
+        self.scheduled = False
+        self._seal()
+        if not self.chunks:
+            return
+        chunks, self.chunks = self.chunks, []
+        try:
+            self.writer.writelines(chunks)
+            self.writes += 1
+            self.last_write = self.loop.time()
+        except (ConnectionError, RuntimeError, AttributeError) as e:
+            self.logger.debug('flush: {}'.format(e))
+
+    async def drain(self):
+        """ wait while the connection has more buffered than it wants """
+
+        await self.writer.drain()
@@ -0,0 +1,230 @@
+import os
+import gc
+import marshal
+import logging
+from hashlib import sha1
+
+CACHE_VERSION = 1
+HASH_LENGTH = 20
+
+logger = logging.getLogger('main.metainfo')
+
+
+def _decode(data, i):
+    """ the value bencoded at `i` and where it ends """
+
+    c = data[i]
+    if c == 100: # d
+        i += 1
+        value = {}
+        while data[i] != 101:
+            key, i = _decode_string(data, i)
+            value[key], i = _decode(data, i)
+        return value, i + 1
+    if c == 108: # l
+        i += 1
+        value = []
+        while data[i] != 101:
+            item, i = _decode(data, i)
+            value.append(item)
+        return value, i + 1
+    if c == 105: # i
+        end = data.index(b'e', i)
+        return int(data[i + 1:end]), end + 1
+    return _decode_string(data, i)
+
+
+def _decode_string(data, i):
+    colon = data.index(b':', i)
+    end = colon + 1 + int(data[i:colon])
+    if end > len(data):
+        raise ValueError('string runs past the end')
+    value = data[colon + 1:end]
+    try:
+        # like bcoding, str for whatever is valid utf-8
+        return value.decode(), end
+    except UnicodeDecodeError:
+        return value, end
+
+
+def _skip(data, i):
+    """ where the value bencoded at `i` ends, without decoding it """
+
+    c = data[i]
+    if c == 100 or c == 108: # d, l
+        i += 1
+        while data[i] != 101:
+            i = _skip(data, i)
+        return i + 1
+    if c == 105: # i
+        return data.index(b'e', i) + 1
+    colon = data.index(b':', i)
+    end = colon + 1 + int(data[i:colon])
+    if end > len(data):
+        raise ValueError('string runs past the end')
+    return end
+
+
+def decode(data):
+    try:
+        value, end = _decode(data, 0)
+    except (IndexError, ValueError) as e:
+        raise ValueError('bad bencoding: {}'.format(e))
+    return value
+
+
+def load(data, cache_dir=None):
+    """
+    (the top level of a .torrent without its info dict, the info dict
+    without its file list, the files as (path, length) tuples or None for a
+    single file torrent, the info hash) from the bytes of the file.
+
+    the info hash is the sha1 of the info dict's bytes exactly as they are
+    in `data`, re-encoding the decoded dict would change it for any torrent
+    not encoded the canonical way. with `cache_dir` the decoded info dict is
+    saved there under its info hash and read back instead of decoded.
+    """
+
+    collecting = gc.isenabled()
+    # nothing decoded here can be part of a cycle, there is no point in the
+    # collector walking the growing heap of new dicts and lists over and over
+    gc.disable()
+    try:
+        return _load(data, cache_dir)
+    except (IndexError, ValueError) as e:
+        raise ValueError('bad metainfo: {}'.format(e))
+    finally:
+        if collecting:
+            gc.enable()
+
+
+def _load(data, cache_dir):
+    metainfo, start = _read_until_info(data)
+    view = memoryview(data)
+    if cache_dir is not None and data[-1] == 101:
+        # the info dict is nearly always the last key, then it ends right
+        # before the e that ends the file. a cache entry for the hash of
+        # those bytes means they are exactly an info dict we decoded before
+        info_hash = sha1(view[start:-1]).digest()
+        cached = load_cached(cache_dir, info_hash, data, start)
+        if cached is not None:
+            return (metainfo,) + cached + (info_hash,)
+    end = _skip(data, start)
+    i = end
+    while data[i] != 101:
+        key, i = _decode_string(data, i)
+        metainfo[key], i = _decode(data, i)
+    info_hash = sha1(view[start:end]).digest()
+    if cache_dir is not None and end != len(data) - 1:
+        cached = load_cached(cache_dir, info_hash, data, start)
+        if cached is not None:
+            return (metainfo,) + cached + (info_hash,)
+    info, files, pieces = decode_info(data, start, end)
+    if cache_dir is not None:
+        save_cached(cache_dir, info_hash, info, files, pieces)
+    return metainfo, info, files, info_hash
+
+
+def _read_until_info(data):
+    """ the keys of the top level dict up to info, and where the info dict starts """
+
+    if data[0] != 100:
+        raise ValueError('not a dictionary')
+    metainfo = {}
+    i = 1
+    while data[i] != 101:
+        key, i = _decode_string(data, i)
+        if key == 'info':
+            if data[i] != 100:
+                raise ValueError('info is not a dictionary')
+            return metainfo, i
+        metainfo[key], i = _decode(data, i)
+    raise ValueError('no info dictionary')
+
+
+def decode_info(data, start, end):
+    """
+    the info dict at data[start:end] and its files, see `load`, and where
+    its pieces are relative to `start`. the pieces are left a view into
+    `data`, they are only ever sliced into hashes.
+    """
+
+    info = {}
+    pieces = None
+    i = start + 1
+    while i < end and data[i] != 101:
+        key, i = _decode_string(data, i)
+        if key == 'pieces':
+            colon = data.index(b':', i)
+            pieces_end = _skip(data, i)
+            pieces = (colon + 1 - start, pieces_end - start)
+            info[key] = memoryview(data)[colon + 1:pieces_end]
+            i = pieces_end
+        else:
+            info[key], i = _decode(data, i)
+    if pieces is None:
+        raise ValueError('info dictionary without pieces')
+    files = None
+    if 'files' in info:
+        files = [(tuple(f['path']), f['length']) for f in info.pop('files')]
+    return info, files, pieces
+
+
+def cache_path(cache_dir, info_hash):
+    return os.path.join(os.path.expanduser(cache_dir), info_hash.hex() + '.info')
+
+
+def load_cached(cache_dir, info_hash, data, start):
+    """
+    (info dict, files) saved for `info_hash`, the pieces pointing back into
+    `data`, or None. the info hash covers the bytes it was decoded from, so
+    a hit is always the same info dict.
+    """
+
+    try:
+        with open(cache_path(cache_dir, info_hash), 'rb') as f:
+            version, info, files, pieces_start, pieces_end = marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError) as e:
+        logger.debug('no cached metadata: {}'.format(e))
+        return None
+    if version != CACHE_VERSION:
+        return None
+    info['pieces'] = memoryview(data)[start + pieces_start:start + pieces_end]
+    return info, files
+
+
+def save_cached(cache_dir, info_hash, info, files, pieces):
+    """ save what decode_info made of an info dict, its pieces as where they are """
+
+    entry = dict(info)
+    del entry['pieces']
+    path = cache_path(cache_dir, info_hash)
+    temporary = path + '.tmp'
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(temporary, 'wb') as f:
+            marshal.dump((CACHE_VERSION, entry, files) + tuple(pieces), f)
+        os.replace(temporary, path)
+    except (OSError, ValueError) as e:
+        logger.debug('cannot cache metadata: {}'.format(e))
+
+
+class PieceHashes():
+    """ the `pieces` string as a sequence of 20 byte hashes, no copies made """
+
+    __slots__ = ('view',)
+
+    def __init__(self, pieces):
+        if len(pieces) % HASH_LENGTH:
+            raise ValueError('pieces is {} bytes, not a multiple of {}'.format(
+                len(pieces), HASH_LENGTH))
+        self.view = memoryview(pieces)
+
+    def __len__(self):
+        return len(self.view) // HASH_LENGTH
+
+    def __getitem__(self, index):
+        if not 0 <= index < len(self.view) // HASH_LENGTH:
+            raise IndexError(index)
+        start = index * HASH_LENGTH
+        return self.view[start:start + HASH_LENGTH]
@@ -0,0 +1,209 @@
+import json
+import asyncio
+import logging
+from bisect import bisect_left
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+# every metric there is: name -> (type, help)
+FAMILIES = {
+    'bittorrent_downloaded_bytes_total': (COUNTER, 'block payload received from peers'),
+    'bittorrent_uploaded_bytes_total': (COUNTER, 'block payload sent to peers'),
+    'bittorrent_verified_bytes_total': (COUNTER, 'bytes of pieces downloaded that passed the hash check'),
+    'bittorrent_peer_downloaded_bytes_total': (COUNTER, 'block payload received from a connected peer'),
+    'bittorrent_peer_uploaded_bytes_total': (COUNTER, 'block payload sent to a connected peer'),
+    'bittorrent_messages_received_total': (COUNTER, 'peer wire messages received, by type'),
+    'bittorrent_pieces_verified_total': (COUNTER, 'pieces that passed the hash check'),
+    'bittorrent_hash_failures_total': (COUNTER, 'pieces that failed the hash check'),
+    'bittorrent_pieces': (GAUGE, 'pieces we have'),
+    'bittorrent_pieces_wanted': (GAUGE, 'pieces of the torrent, less the skipped ones'),
+    'bittorrent_peers': (GAUGE, 'peers past the handshake'),
+    'bittorrent_half_open_connections': (GAUGE, 'connections being made'),
+    'bittorrent_outstanding_requests': (GAUGE, 'block requests sent and not answered yet'),
+    'bittorrent_upload_queue_depth': (GAUGE, 'block requests from peers waiting to be served'),
+    'bittorrent_hash_queue_depth': (GAUGE, 'complete pieces waiting for or in the hash check'),
+    'bittorrent_disk_queue_depth': (GAUGE, 'piece writes not handed to a disk thread yet'),
+    'bittorrent_disk_busy_threads': (GAUGE, 'disk threads writing a batch'),
+    'bittorrent_disk_writes_total': (COUNTER, 'pieces handed to the disk threads'),
+    'bittorrent_disk_batches_total': (COUNTER, 'batches the piece writes went out in'),
+    'bittorrent_inbound_accepted_total': (COUNTER, 'inbound connections handed to a torrent'),
+    'bittorrent_inbound_refused_total': (COUNTER, 'inbound connections turned away'),
+    'bittorrent_request_rtt_seconds': (HISTOGRAM, 'time from sending a block request to the block arriving'),
+    'bittorrent_piece_seconds': (HISTOGRAM, 'time from the first request for a piece to it being verified'),
+    'bittorrent_verify_seconds': (HISTOGRAM, 'time a piece spent in the hash check and disk write'),
+}
+
+RTT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+PIECE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+VERIFY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+
+class Histogram():
+    """
+    counts of observed values by the bucket they fall in, bucket i holding
+    the values up to `bounds[i]` and the last one everything bigger.
+    """
+
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """ (upper bound, values up to it) for every bucket, the last bound being inf """
+
+        total = 0
+        buckets = []
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            total += count
+            buckets.append((bound, total))
+        return buckets
+
+
+class Metrics():
+    """
+    the registry the metrics endpoint reads.
+
+    nothing is counted through the registry itself: the clients keep
+    plain int attributes and Histograms that the hot paths bump, and the
+    sources registered here read them out as (name, labels, value) tuples
+    when someone asks for a snapshot. queue depths and the like are looked
+    at then as well, so they cost nothing in between.
+    """
+
+    def __init__(self, sources=()):
+        self.logger = logging.getLogger('main.metrics')
+        self.sources = list(sources)
+
+    def register(self, source):
+        self.sources.append(source)
+
+    def unregister(self, source):
+        self.sources.remove(source)
+
+    def collect(self):
+        """ name -> [(labels, value)], in the order of FAMILIES """
+
+        samples = {name: [] for name in FAMILIES}
+        for source in self.sources:
+            for name, labels, value in source():
+                samples[name].append((labels, value))
+        return samples
+
+    def snapshot(self):
+        """ everything as something json.dumps takes """
+
+        snapshot = {}
+        for name, samples in self.collect().items():
+            if not samples:
+                continue
+            values = []
+            for labels, value in samples:
+                if isinstance(value, Histogram):
+                    value = {
+                        'buckets': [['+Inf' if bound == float('inf') else bound, count]
+                                    for bound, count in value.cumulative()],
+                        'sum': value.sum,
+                        'count': value.count,
+                    }
+                values.append({'labels': labels, 'value': value})
+            snapshot[name] = values
+        return snapshot
+
+    def prometheus(self):
+        """ everything in the prometheus text format """
+
+        lines = []
+        for name, samples in self.collect().items():
+            if not samples:
+                continue
+            kind, description = FAMILIES[name]
+            lines.append('# HELP {} {}'.format(name, description))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for labels, value in samples:
+                if isinstance(value, Histogram):
+                    for bound, count in value.cumulative():
+                        le = '+Inf' if bound == float('inf') else repr(float(bound))
+                        lines.append('{}_bucket{} {}'.format(name, _labels(labels, le=le), count))
+                    lines.append('{}_sum{} {!r}'.format(name, _labels(labels), float(value.sum)))
+                    lines.append('{}_count{} {}'.format(name, _labels(labels), value.count))
+                else:
+                    lines.append('{}{} {}'.format(name, _labels(labels), value))
+        lines.append('')
+        return '\n'.join(lines)
+
+
+def _labels(labels, **extra):
+    labels = dict(labels, **extra)
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, _escape(value))
+                          for key, value in labels.items()) + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class MetricsServer():
+    """
+    serves the metrics over http on a local port: /metrics in the
+    prometheus text format and /metrics.json as a json snapshot.
+    """
+
+    TIMEOUT = 5
+
+    def __init__(self, loop, metrics, host='127.0.0.1', port=0):
+        self.logger = logging.getLogger('main.metrics_server')
+        self.loop = loop
+        self.metrics = metrics
+        self.host = host
+        self.port = port
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.logger.info('metrics on http://{}:{}/metrics'.format(self.host, self.port))
+        return self.port
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), self.TIMEOUT)
+            while True:
+                # the headers, nothing in them matters to us
+                line = await asyncio.wait_for(reader.readline(), self.TIMEOUT)
+                if line in (b'\r\n', b'\n', b''):
+                    break
+            parts = request.split()
+            path = parts[1].split(b'?')[0] if len(parts) > 1 else b''
+            if path == b'/metrics':
+                status, content_type = '200 OK', 'text/plain; version=0.0.4'
+                body = self.metrics.prometheus().encode()
+            elif path == b'/metrics.json':
+                status, content_type = '200 OK', 'application/json'
+                body = json.dumps(self.metrics.snapshot()).encode()
+            else:
+                status, content_type, body = '404 Not Found', 'text/plain', b'not found\n'
+            writer.write('HTTP/1.0 {}\r\nContent-Type: {}\r\nContent-Length: {}\r\n\r\n'.format(
+                status, content_type, len(body)).encode() + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError) as e:
+            self.logger.debug('metrics request: {}'.format(e))
+        finally:
+            writer.close()
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+            self.server = None
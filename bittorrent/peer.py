@@ -5,26 +5,42 @@ import asyncio
 import random
 import struct
 import logging
+from collections import deque
 
-from bitstring import BitArray
-from .utils import PieceQueue
-
-KEEPALIVE = bytes([0, 0, 0, 0])
-CHOKE = bytes([0, 0, 0, 1]) + bytes([0])
-UNCHOKE = bytes([0, 0, 0, 1]) + bytes([1])
-INTERESTED = bytes([0, 0, 0, 1]) + bytes([2])
-NOT_INTERESTED = bytes([0, 0, 0, 1]) + bytes([3])
+from .pipeline import RequestWindow, DEFAULT_MAX_WINDOW
+from .choker import RateCounter
+from .bitfield import Bitfield
 
 
 class Peer():
 
-    def __init__(self, host, port, torrent):
+    def __init__(self, host, port, torrent, max_requests=DEFAULT_MAX_WINDOW, clock=time.monotonic):
         self._reader = None
         self._writer = None
-        self.choked = True
+        self.outbound = None # OutboundQueue once connected
+        self.choked = True        # the peer is choking us
+        self.am_choking = True    # we are choking the peer
+        self.interested = False   # the peer wants something we have
+        self.am_interested = False # we want something the peer has
+        self.upload_requests = deque() # (index, begin, length) it asked us for
+        self.uploading = False
+        self.uploaded = 0
+        self.downloaded = 0 # block payload it sent us
+        self.last_uploaded_piece = -1
         self.address = {'host': host, 'port': port}
-        self.queue = PieceQueue(torrent) # store blocks to be requested
-        self.timer = datetime.datetime.now()
+        self.peer_id = None # from its handshake
+        self.have = Bitfield(torrent.number_of_pieces) # the pieces the peer has
+        self.seed = False # has everything, counted in the picker's seeds
+        self.window = RequestWindow(max_requests, torrent.REQUEST_LENGTH, clock) # requests in flight
+        self.download_rate = RateCounter(clock=clock)
+        self.upload_rate = RateCounter(clock=clock)
+        self.last_block = clock() # when the peer last sent us a block
+        self.clock = clock
+        self.last_received = None # loop time of the last message from the peer
+        self.check_timer = None
+        self.download_throttle = None # Throttle for the requests we send
+        self.upload_throttle = None   # and for the blocks we send
+        self.fill_window = None # asks for more blocks once the download throttle lets up
 
     @property
     def reader(self):
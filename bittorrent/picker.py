@@ -0,0 +1,290 @@
+import random
+import logging
+from array import array
+
+from .bitfield import Bitfield
+
+RANDOM_FIRST = 4
+
+SKIP = 0    # piece priorities, higher ones are started first
+NORMAL = 1
+
+
+class PiecePicker():
+    """
+    decides which block to request next from a peer.
+
+    keeps a count of how many connected peers have each piece. the pieces
+    nobody started on are sorted into buckets by that count, `buckets[a]`
+    being a Bitfield of the unstarted pieces that `a` peers have. the
+    rarest piece a peer has is the first one of the lowest bucket it shares
+    any with, which takes an & of two big ints per bucket rather than a
+    look at every piece. a peer that sends its BITFIELD or goes away moves
+    its pieces one bucket up or down the same way, a few big int operations
+    per bucket and one addition for all the counts, so a peer with 100k
+    pieces costs about as much as one with ten. pieces that are partly
+    requested are always finished before a new one is started, and the
+    first few pieces are picked at random so we have something to share early.
+
+    peers that have every piece are only counted in `seeds`. they add the
+    same to every piece, which leaves the buckets as they are, so a seed
+    coming or going costs nothing however many pieces there are.
+
+    on top of that pieces have a priority and may have a deadline. pieces
+    with a deadline come first, earliest first, then the ones already
+    started, then those with a priority above NORMAL and then the rest.
+    SKIP pieces are taken out of the unstarted ones and never started.
+    """
+
+    def __init__(self, torrent, pieces, random_first=RANDOM_FIRST):
+        self.logger = logging.getLogger('main.piece_picker')
+        self.torrent = torrent
+        self.pieces = pieces
+        self.random_first = random_first
+        self.number_of_pieces = n = torrent.number_of_pieces
+        self.availability = array('I', bytes(4 * n))
+        self.fresh = Bitfield.full(n) # the unstarted pieces
+        self.buckets = [Bitfield.full(n)]
+        self.partial = set()  # started, but with blocks left to request
+        self.seeds = 0
+        self.done = bytearray(n)
+        self.done_count = 0
+        self.have = Bitfield(n) # the same as `done`, as a bitfield
+        self.priority = array('B', [NORMAL]) * n
+        self.prioritized = {}    # priority above NORMAL -> Bitfield of its unfinished pieces
+        self.skipped = set()     # unfinished pieces at SKIP
+        self.unwanted = Bitfield(n) # done or skipped, what we are not interested in
+        self.deadlines = {}      # piece index -> when we need it
+
+    def _fresh(self, index):
+        return index in self.fresh
+
+    def peer_has(self, index):
+        if 0 <= index < self.number_of_pieces:
+            availability = self.availability[index]
+            if index in self.fresh:
+                buckets = self.buckets
+                if availability + 1 == len(buckets):
+                    buckets.append(Bitfield(self.number_of_pieces))
+                buckets[availability].discard(index)
+                buckets[availability + 1].add(index)
+            self.availability[index] = availability + 1
+
+    def peer_has_pieces(self, have):
+        """ a peer that is not a seed sent the Bitfield of its pieces """
+
+        have.add_to(self.availability)
+        self._move_up(have.value & self.fresh.value)
+
+    def seed_joined(self):
+        self.seeds += 1
+
+    def seed_left(self):
+        self.seeds -= 1
+
+    def peer_lost(self, have):
+        """ a peer went away, it no longer counts towards availability """
+
+        have.subtract_from(self.availability)
+        self._move_down(have.value & self.fresh.value)
+
+    def _move_up(self, moving):
+        """ the unstarted pieces in `moving`, an int like Bitfield.value, go one bucket up """
+
+        buckets = self.buckets
+        arriving = 0
+        for bucket in buckets:
+            value = bucket.value
+            leaving = value & moving
+            if leaving or arriving:
+                bucket.set_value(value ^ leaving | arriving)
+            arriving = leaving
+        if arriving:
+            buckets.append(Bitfield(self.number_of_pieces))
+            buckets[-1].set_value(arriving)
+
+    def _move_down(self, moving):
+        """ the same, one bucket down """
+
+        buckets = self.buckets
+        arriving = 0
+        for a in range(len(buckets) - 1, 0, -1):
+            value = buckets[a].value
+            leaving = value & moving
+            if leaving or arriving:
+                buckets[a].set_value(value ^ leaving | arriving)
+            arriving = leaving
+        if arriving:
+            buckets[0].set_value(buckets[0].value | arriving)
+        while len(buckets) > 1 and not buckets[-1].count:
+            buckets.pop()
+
+    def set_priority(self, index, priority):
+        old = self.priority[index]
+        self.priority[index] = priority
+        if self.done[index]:
+            return
+        if old != priority:
+            self._unprioritize(index, old)
+            if priority > NORMAL:
+                if priority not in self.prioritized:
+                    self.prioritized[priority] = Bitfield(self.number_of_pieces)
+                self.prioritized[priority].add(index)
+        if priority == SKIP:
+            self.skipped.add(index)
+            self.unwanted.add(index)
+            # a piece that is already under way gets finished
+            self._remove_fresh(index)
+        elif old == SKIP:
+            self.skipped.discard(index)
+            self.unwanted.discard(index)
+            if self.pieces.requested[index] == 0 and index not in self.partial:
+                self._add_fresh(index)
+
+    def _unprioritize(self, index, priority):
+        raised = self.prioritized.get(priority)
+        if raised is not None:
+            raised.discard(index)
+            if not raised.count:
+                del self.prioritized[priority]
+
+    def set_deadline(self, index, deadline):
+        if not self.done[index]:
+            self.deadlines[index] = deadline
+
+    def clear_deadline(self, index):
+        self.deadlines.pop(index, None)
+
+    def finished(self):
+        """ every piece we want is done """
+
+        return self.done_count + len(self.skipped) == self.number_of_pieces
+
+    def pick(self, peer_has):
+        """
+        return the next block to request from a peer that has `peer_has`
+        and mark it as requested, or None if the peer has nothing we need
+        """
+
+        index = None
+        if self.deadlines:
+            index = self._pick_deadline(peer_has)
+        if index is None:
+            index = self._pick_partial(peer_has)
+        if index is None or self._fresh(index):
+            if not self.pieces.can_reserve():
+                # every assembly buffer is taken, finish what we started first
+                return None
+            if index is None and self.prioritized:
+                index = self._pick_prioritized(peer_has)
+            if index is None:
+                if self.done_count < self.random_first:
+                    index = self._pick_random(peer_has)
+                else:
+                    index = self._pick_rarest(peer_has)
+            if index is None:
+                return None
+            self.pieces.reserve(index)
+            self._remove_fresh(index)
+            self.partial.add(index)
+
+        block = self.pieces.next_block(index)
+        if block is None:
+            # the blocks we gave up on came in anyway, unasked, from the
+            # peer we had asked first. nothing is left to request of it
+            self.partial.discard(index)
+            return self.pick(peer_has)
+        self.pieces.add_requested(block)
+        if self.pieces.all_requested(index):
+            self.partial.discard(index)
+        return block
+
+    def _pick_deadline(self, peer_has):
+        best = None
+        for index, deadline in self.deadlines.items():
+            if (index in peer_has and (index in self.partial or self._fresh(index)) and
+                    (best is None or deadline < best_deadline)):
+                best, best_deadline = index, deadline
+        return best
+
+    def _pick_prioritized(self, peer_has):
+        """ the rarest unstarted piece the peer has of the highest priority it has any of """
+
+        wanted = peer_has.value & self.fresh.value
+        for priority in sorted(self.prioritized, reverse=True):
+            candidates = self.prioritized[priority].value & wanted
+            if candidates:
+                for bucket in self.buckets:
+                    index = self.fresh.first_of(bucket.value & candidates)
+                    if index is not None:
+                        return index
+        return None
+
+    def _pick_partial(self, peer_has):
+        candidates = [i for i in self.partial if i in peer_has]
+        if not candidates:
+            return None
+        return min(candidates, key=self.availability.__getitem__)
+
+    def _pick_random(self, peer_has):
+        # the first one it has from a random place on
+        index = peer_has.first_in(self.fresh, random.randrange(self.number_of_pieces))
+        if index is None:
+            index = peer_has.first_in(self.fresh)
+        return index
+
+    def _pick_rarest(self, peer_has):
+        # only a seed has pieces that no counted peer has
+        for bucket in self.buckets[0 if self.seeds else 1:]:
+            if bucket.count:
+                index = peer_has.first_in(bucket)
+                if index is not None:
+                    return index
+        return None
+
+    def _remove_fresh(self, index):
+        if not self._fresh(index):
+            return
+        self.fresh.discard(index)
+        self.buckets[self.availability[index]].discard(index)
+
+    def _add_fresh(self, index):
+        if self._fresh(index):
+            return
+        self.fresh.add(index)
+        buckets = self.buckets
+        availability = self.availability[index]
+        while len(buckets) <= availability:
+            buckets.append(Bitfield(self.number_of_pieces))
+        buckets[availability].add(index)
+
+    def everything_requested(self):
+        """ no piece is left to start and every started one is fully requested """
+
+        return not self.fresh.count and not self.partial
+
+    def block_released(self, block):
+        """ a requested block will not arrive, request it again later """
+
+        index = block['index']
+        if not self.done[index] and not self._fresh(index):
+            self.partial.add(index)
+
+    def piece_failed(self, index):
+        """ piece did not pass the hash check, start it over """
+
+        self.partial.discard(index)
+        if not self.done[index] and self.priority[index] != SKIP:
+            self._add_fresh(index)
+
+    def piece_done(self, index):
+        self.partial.discard(index)
+        self._remove_fresh(index)
+        self.deadlines.pop(index, None)
+        self._unprioritize(index, self.priority[index])
+        self.skipped.discard(index)
+        if not self.done[index]:
+            self.done[index] = 1
+            self.done_count += 1
+            self.have.add(index)
+            self.unwanted.add(index)
@@ -0,0 +1,136 @@
+import math
+import time
+import logging
+
+MIN_WINDOW = 2
+INITIAL_WINDOW = 4
+DEFAULT_MAX_WINDOW = 128
+RATE_INTERVAL = 1.0
+PROBE_GAIN = 1.25
+
+
+class RequestWindow():
+    """
+    keeps track of the REQUEST messages in flight to a single peer
+    and how many of them we are allowed to have outstanding at once.
+
+    the window starts small and grows by one block for every block received
+    (slow start) until we have a throughput and round trip time estimate.
+    after that the window follows the bandwidth delay product of the peer,
+    which means it shrinks again when the peer slows down or requests start
+    queueing up on its side.
+    """
+
+    def __init__(self, max_size=DEFAULT_MAX_WINDOW, block_length=2**14, clock=time.monotonic):
+        self.logger = logging.getLogger('main.request_window')
+        self.max_size = max(MIN_WINDOW, max_size)
+        self.size = min(INITIAL_WINDOW, self.max_size)
+        self.block_length = block_length
+        self.clock = clock
+        self.outstanding = {}  # (index, begin_offset) -> (block, time requested)
+        self.rtt = None
+        self.min_rtt = None
+        self.rate = None
+        self._rate_bytes = 0
+        self._rate_started = None
+        self.rtt_histogram = None # a metrics.Histogram every round trip goes into
+
+    def __len__(self):
+        return len(self.outstanding)
+
+    def __contains__(self, key):
+        return key in self.outstanding
+
+    def has_room(self):
+        return len(self.outstanding) < self.size
+
+    def add(self, block):
+        key = (block['index'], block['begin_offset'])
+        now = self.clock()
+        self.outstanding[key] = (block, now)
+        if self._rate_started is None:
+            self._rate_started = now
+
+    def completed(self, index, begin_offset, length):
+        """
+        called when a PIECE message arrives. returns the block
+        if we asked this peer for it, otherwise None.
+        """
+
+        entry = self.outstanding.pop((index, begin_offset), None)
+        if entry is None:
+            return None
+
+        block, requested_at = entry
+        now = self.clock()
+        self._update_rtt(now - requested_at)
+        if self.rtt_histogram is not None:
+            self.rtt_histogram.observe(now - requested_at)
+        self._update_rate(now, length)
+        self._resize()
+        return block
+
+    def expire(self, timeout):
+        """
+        drop and return the requests that have been outstanding for longer
+        than `timeout` seconds
+        """
+
+        deadline = self.clock() - timeout
+        expired = []
+        # requests are kept in the order they were made
+        for key, (block, requested_at) in self.outstanding.items():
+            if requested_at > deadline:
+                break
+            expired.append(key)
+        return [self.outstanding.pop(key)[0] for key in expired]
+
+    def cancel(self, index, begin_offset):
+        """ drop a request that is not needed any more, True if it was outstanding """
+
+        return self.outstanding.pop((index, begin_offset), None) is not None
+
+    def release(self):
+        """
+        forget every outstanding request and hand the blocks back,
+        used when the peer chokes us or the connection goes away.
+        """
+
+        blocks = [block for block, _ in self.outstanding.values()]
+        self.outstanding = {}
+        self._rate_bytes = 0
+        self._rate_started = None
+        return blocks
+
+    def _update_rtt(self, sample):
+        if self.min_rtt is None or sample < self.min_rtt:
+            self.min_rtt = sample
+        if self.rtt is None:
+            self.rtt = sample
+        else:
+            self.rtt += (sample - self.rtt) / 8
+
+    def _update_rate(self, now, length):
+        self._rate_bytes += length
+        elapsed = now - self._rate_started
+        if elapsed >= RATE_INTERVAL:
+            sample = self._rate_bytes / elapsed
+            if self.rate is None:
+                self.rate = sample
+            else:
+                self.rate += (sample - self.rate) / 4
+            self._rate_bytes = 0
+            self._rate_started = now
+
+    def _resize(self):
+        if self.rate is None or not self.min_rtt:
+            # slow start
+            size = self.size + 1
+        else:
+            # enough requests to cover the bandwidth delay product, scaled up a little
+            # so the window keeps probing for more bandwidth. the smoothed rtt includes
+            # the time requests spend queued at the peer, using it here would make
+            # the window feed its own growth.
+            bdp = self.rate * self.min_rtt / self.block_length
+            size = math.ceil(bdp * PROBE_GAIN) + MIN_WINDOW
+        self.size = max(MIN_WINDOW, min(size, self.max_size))
@@ -0,0 +1,207 @@
+import struct
+import asyncio
+import logging
+from collections import deque
+
+HANDSHAKE_LENGTH = 68
+DEFAULT_BUFFER_SIZE = 2**18
+MIN_FREE = 2**15
+MAX_MESSAGE_LENGTH = 2**24
+MAX_QUEUED_MESSAGES = 1024
+
+unpack_length = struct.Struct('!I').unpack_from
+
+
+class PeerProtocol(asyncio.BufferedProtocol):
+    """
+    peer wire protocol connection that reads straight into one reusable
+    buffer and splits it into messages as data comes in, however many
+    arrive in one go.
+
+    messages are handed out by `read_message` as (message id, payload)
+    with the payload a memoryview into the receive buffer, keep alives come
+    out as (None, None). a payload is only valid until the next call to
+    `read_message`, copy it if it has to live longer.
+
+    also does the writing side, with `write`, `drain` and `close` like a
+    StreamWriter.
+    """
+
+    def __init__(self, loop, buffer_size=DEFAULT_BUFFER_SIZE, on_connect=None):
+        self.logger = logging.getLogger('main.peer_protocol')
+        self.loop = loop
+        self.on_connect = on_connect # called with the protocol once connected
+        self.transport = None
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.spare = None   # buffer to switch to next time we need a fresh one
+        self.retired = None # buffer a handed out payload may still point into
+        self.parsed = 0     # everything before this is split into messages
+        self.end = 0        # end of the data received so far
+        self.need = 0       # length of the message being received, header included
+        self.frames = deque() # (message id, payload start, payload end)
+        self.live = False   # whether a payload handed out may still point into `buffer`
+        self.handshake = None
+        self.closed = False
+        self.reading_paused = False
+        self.write_paused = False
+        self._read_waiter = None
+        self._drain_waiter = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if self.on_connect is not None:
+            self.on_connect(self)
+
+    def connection_lost(self, exc):
+        self.closed = True
+        self._wake_reader()
+        if self._drain_waiter is not None and not self._drain_waiter.done():
+            self._drain_waiter.set_result(None)
+
+    def get_buffer(self, sizehint):
+        if len(self.buffer) - self.end < MIN_FREE:
+            self._make_room()
+        return self.view[self.end:]
+
+    def _make_room(self):
+        """ move the data nobody consumed yet to the front of a buffer """
+
+        first = self.frames[0][1] if self.frames else self.parsed
+        pending = self.end - first
+        size = len(self.buffer)
+        wanted = pending + max(MIN_FREE, self.need - (self.end - self.parsed))
+        while size < wanted:
+            size *= 2
+
+        if self.live or size != len(self.buffer):
+            # a payload we handed out points into the current buffer,
+            # so the data has to go somewhere else
+            if self.spare is not None and len(self.spare) == size:
+                buffer = self.spare
+            else:
+                buffer = bytearray(size)
+            self.spare = None
+            view = memoryview(buffer)
+            view[:pending] = self.view[first:self.end]
+            if self.live:
+                self.retired = self.buffer
+                self.live = False
+            self.buffer, self.view = buffer, view
+        else:
+            self.view[:pending] = self.view[first:self.end]
+
+        self.frames = deque((message_id, start - first, stop - first)
+                            for message_id, start, stop in self.frames)
+        self.parsed -= first
+        self.end -= first
+
+    def buffer_updated(self, nbytes):
+        self.end += nbytes
+        if self.handshake is None:
+            if self.end - self.parsed < HANDSHAKE_LENGTH:
+                return
+            self.handshake = bytes(self.view[self.parsed:self.parsed + HANDSHAKE_LENGTH])
+            self.parsed += HANDSHAKE_LENGTH
+            # someone may be waiting for just the handshake
+            self._wake_reader()
+
+        buffer = self.buffer
+        parsed = self.parsed
+        end = self.end
+        frames = self.frames
+        while end - parsed >= 4:
+            length = unpack_length(buffer, parsed)[0]
+            if length > MAX_MESSAGE_LENGTH:
+                self.logger.error('message of {} bytes, dropping connection'.format(length))
+                self.transport.close()
+                break
+            if end - parsed - 4 < length:
+                self.need = length + 4
+                break
+            if length == 0:
+                frames.append((None, parsed + 4, parsed + 4))
+            else:
+                frames.append((buffer[parsed + 4], parsed + 5, parsed + 4 + length))
+            parsed += 4 + length
+        else:
+            self.need = 0
+        self.parsed = parsed
+
+        if frames:
+            self._wake_reader()
+            if len(frames) > MAX_QUEUED_MESSAGES and not self.reading_paused:
+                self.reading_paused = True
+                self.transport.pause_reading()
+
+    def eof_received(self):
+        return False
+
+    def _wake_reader(self):
+        if self._read_waiter is not None and not self._read_waiter.done():
+            self._read_waiter.set_result(None)
+
+    async def read_handshake(self):
+        while self.handshake is None:
+            if self.closed:
+                return None
+            self._read_waiter = self.loop.create_future()
+            await self._read_waiter
+        return self.handshake
+
+    def next_message(self):
+        """ next message if one is complete, otherwise None """
+
+        # whatever we handed out before is done with
+        self.live = False
+        if self.retired is not None:
+            self.spare = self.retired
+            self.retired = None
+
+        if not self.frames:
+            return None
+        message_id, start, stop = self.frames.popleft()
+        if self.reading_paused and len(self.frames) < MAX_QUEUED_MESSAGES // 2:
+            self.reading_paused = False
+            self.transport.resume_reading()
+        if message_id is None:
+            return (None, None)
+        self.live = True
+        return (message_id, self.view[start:stop])
+
+    async def read_message(self):
+        """ wait for the next message, None once the connection is gone """
+
+        while True:
+            message = self.next_message()
+            if message is not None:
+                return message
+            if self.closed:
+                return None
+            self._read_waiter = self.loop.create_future()
+            await self._read_waiter
+
+    def pause_writing(self):
+        self.write_paused = True
+
+    def resume_writing(self):
+        self.write_paused = False
+        if self._drain_waiter is not None and not self._drain_waiter.done():
+            self._drain_waiter.set_result(None)
+
+    def write(self, data):
+        self.transport.write(data)
+
+    def writelines(self, data):
+        self.transport.writelines(data)
+
+    async def drain(self):
+        if self.closed:
+            raise ConnectionResetError('Connection lost')
+        if self.write_paused:
+            self._drain_waiter = self.loop.create_future()
+            await self._drain_waiter
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
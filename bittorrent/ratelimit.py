@@ -0,0 +1,166 @@
+import logging
+from collections import deque
+
+MIN_BURST = 2**14      # a bucket can always save up at least one block
+BURST_SECONDS = 0.1    # and otherwise this much of its rate
+WAKE_SLACK = 0.001     # the loop may run a timer a little early
+
+
+class TokenBucket():
+    """
+    lets `rate` bytes a second through, saving up to `burst` bytes for
+    when nothing went out for a while. a rate of None means no limit.
+
+    a message goes through whole as long as the bucket is not in debt, and
+    takes the bucket below zero if it is bigger than what is saved up. so
+    messages never have to be split or wait for a bucket larger than
+    themselves, and on average the rate is still kept.
+
+    throttles that found the bucket in debt queue up, and are woken one
+    after the other once it is paid off, so peers sharing the bucket take
+    turns. time comes from `loop.time()` and the wakeup from
+    `loop.call_later`, anything providing those two does as a clock.
+    """
+
+    def __init__(self, loop, rate=None, burst=None):
+        self.loop = loop
+        self.rate = None
+        self.burst = 0
+        self.tokens = 0
+        self.last = loop.time()
+        self.waiters = deque() # throttles waiting for the debt to be paid off
+        self.waking = False
+        self.handle = None
+        self.taken = 0
+        self.set_rate(rate, burst)
+        self.tokens = self.burst
+
+    def set_rate(self, rate, burst=None):
+        """ change the limit, takes effect right away """
+
+        self.refill(self.loop.time())
+        self.rate = rate or None
+        if self.rate is None:
+            self.burst = 0
+            self.tokens = 0
+        else:
+            self.burst = burst or max(MIN_BURST, self.rate * BURST_SECONDS)
+            self.tokens = min(self.tokens, self.burst)
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        if self.waiters:
+            self._wake()
+
+    def refill(self, now):
+        if self.rate is not None and now > self.last:
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        return self.tokens
+
+    def take(self, nbytes):
+        self.taken += nbytes
+        if self.rate is not None:
+            self.tokens -= nbytes
+
+    def blocks(self, now):
+        """ whether a throttle has to wait for this bucket """
+
+        if self.rate is None:
+            return False
+        # nobody gets ahead of the ones already waiting
+        return (self.waiters and not self.waking) or self.refill(now) < 0
+
+    def wait(self, throttle):
+        self.waiters.append(throttle)
+        if self.handle is None and not self.waking:
+            self._schedule()
+
+    def _schedule(self):
+        delay = max(0, -self.tokens / self.rate) + WAKE_SLACK
+        self.handle = self.loop.call_later(delay, self._wake)
+
+    def _wake(self):
+        self.handle = None
+        self.waking = True
+        try:
+            while self.waiters and (self.rate is None or self.refill(self.loop.time()) >= 0):
+                self.waiters.popleft().woken()
+        finally:
+            self.waking = False
+        if self.waiters:
+            self._schedule()
+
+
+class Throttle():
+    """
+    the buckets one direction of one peer has to get through: its own,
+    the torrent's and the session's. a transfer goes ahead once none of
+    them is in debt and is taken from all of them.
+
+    once the connection is gone `close` makes a waiting `acquire`, and any
+    later one, raise ConnectionAbortedError.
+    """
+
+    def __init__(self, loop, buckets):
+        self.logger = logging.getLogger('main.throttle')
+        self.loop = loop
+        self.buckets = [bucket for bucket in buckets if bucket is not None]
+        self.callback = None # what to call once we may send again
+        self.waiting = None  # future of the acquire waiting to be let through
+        self.closed = False
+
+    def ready(self, callback):
+        """
+        whether we may send now. if not, `callback` is called once we may,
+        and until then the answer stays no.
+        """
+
+        if self.callback is not None:
+            self.callback = callback
+            return False
+        now = self.loop.time()
+        for bucket in self.buckets:
+            if bucket.blocks(now):
+                self.callback = callback
+                bucket.wait(self)
+                return False
+        return True
+
+    def take(self, nbytes):
+        for bucket in self.buckets:
+            bucket.take(nbytes)
+
+    async def acquire(self, nbytes):
+        """ wait until `nbytes` may go out, and take them """
+
+        if self.closed:
+            raise ConnectionAbortedError('throttle closed')
+        future = self.loop.create_future()
+
+        def go():
+            # taken right away, so the next waiter in line sees the debt
+            self.take(nbytes)
+            if not future.done():
+                future.set_result(None)
+
+        if self.ready(go):
+            self.take(nbytes)
+            return
+        self.waiting = future
+        try:
+            await future
+        finally:
+            self.waiting = None
+
+    def woken(self):
+        callback, self.callback = self.callback, None
+        if callback is not None and self.ready(callback):
+            callback()
+
+    def close(self):
+        # still in the queues of the buckets, but has nothing left to do when woken
+        self.callback = None
+        self.closed = True
+        if self.waiting is not None and not self.waiting.done():
+            self.waiting.set_exception(ConnectionAbortedError('throttle closed'))
@@ -0,0 +1,122 @@
+import os
+import asyncio
+import logging
+from collections import deque
+
+from bcoding import bdecode, bencode
+
+from .verifier import DEFAULT_HASH_WORKERS
+from .utils import to_bitfield, from_bitfield
+
+SAVE_INTERVAL = 30
+RECHECK_AHEAD = 4 # pieces read ahead per worker
+
+
+def _as_bytes(value):
+    # bdecode hands back str for anything that happens to be valid utf-8
+    if isinstance(value, str):
+        return value.encode('utf-8')
+    return value
+
+
+class ResumeData():
+    """
+    remembers which pieces were verified, next to the downloaded files.
+
+    the state file holds a bitfield of verified pieces plus the size and
+    mtime of every file when it was saved. it is only trusted when the
+    files still look exactly like that, anything else means a recheck.
+
+    the client calls `maybe_save` every `save_interval` seconds off its
+    timer wheel, and `save` once more on the way out.
+    """
+
+    def __init__(self, torrent, file_manager, destination, save_interval=SAVE_INTERVAL):
+        self.logger = logging.getLogger('main.resume')
+        self.torrent = torrent
+        self.file_manager = file_manager
+        self.save_interval = save_interval
+        self.path = os.path.join(os.path.expanduser(destination),
+                '.{}.resume'.format(torrent.info_hash.hex()))
+        self.saved_pieces = None # how many pieces were verified at the last save
+
+    def load(self):
+        """ verified piece indexes from the state file, or None if it can't be trusted """
+
+        number_of_pieces = self.torrent.number_of_pieces
+        try:
+            with open(self.path, 'rb') as f:
+                state = bdecode(f.read())
+            # a damaged or foreign file fails somewhere in here, which means a recheck
+            info_hash = _as_bytes(state['info_hash'])
+            files = [(size, mtime) for size, mtime in state['files']]
+            field = _as_bytes(state['bitfield'])
+            if not isinstance(field, bytes) or len(field) != (number_of_pieces + 7) // 8:
+                raise ValueError('bitfield does not fit {} pieces'.format(number_of_pieces))
+        except (IOError, ValueError, TypeError, KeyError) as e:
+            self.logger.debug('no usable resume data: {}'.format(e))
+            return None
+
+        if info_hash != self.torrent.info_hash:
+            return None
+        if files != self.file_manager.file_stats():
+            self.logger.info('files changed since resume data was saved')
+            return None
+        return from_bitfield(field, number_of_pieces)
+
+    def save(self, verified):
+        """ `verified` holds one byte per piece, non zero when the piece is good """
+
+        state = {
+            'info_hash': self.torrent.info_hash,
+            'bitfield': to_bitfield(verified),
+            'files': [list(stat) for stat in self.file_manager.file_stats()],
+        }
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(bencode(state))
+        os.replace(tmp_path, self.path)
+        self.saved_pieces = len(verified) - verified.count(0)
+
+    def maybe_save(self, verified):
+        """ save unless no piece was verified since the last save """
+
+        if len(verified) - verified.count(0) != self.saved_pieces:
+            self.save(verified)
+
+
+async def recheck(torrent, file_manager, hash_piece, ahead=DEFAULT_HASH_WORKERS * RECHECK_AHEAD):
+    """
+    hash every piece that lies in files which were already on disk and
+    return the indexes of the good ones. `hash_piece(index)` hashes one off
+    the event loop. pieces are handed in in order with `ahead` of them in
+    flight, so the files are read sequentially.
+    """
+
+    logger = logging.getLogger('main.resume')
+    candidates = [index for index in range(torrent.number_of_pieces)
+                  if file_manager.has_existing_data(index)]
+    if not candidates:
+        return []
+
+    logger.info('rechecking {} pieces'.format(len(candidates)))
+    file_manager.advise_sequential()
+    good = []
+    in_flight = deque()
+    try:
+        for index in candidates:
+            in_flight.append((index, asyncio.ensure_future(hash_piece(index))))
+            if len(in_flight) >= ahead:
+                await _collect(torrent, in_flight.popleft(), good)
+        while in_flight:
+            await _collect(torrent, in_flight.popleft(), good)
+    finally:
+        for _, future in in_flight:
+            future.cancel()
+    return good
+
+
+async def _collect(torrent, job, good):
+    index, future = job
+    if await future == torrent.piece_hash_list[index]:
+        good.append(index)
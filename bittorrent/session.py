@@ -0,0 +1,114 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from .client import TorrentClient
+from .torrent import Torrent
+from .timers import TimerWheel
+from .disk import DiskScheduler, IO_WORKERS
+from .listener import Listener
+from .connections import ConnectionBudget
+from .ratelimit import TokenBucket
+from .verifier import DEFAULT_HASH_WORKERS
+from .tracker import DEFAULT_PORT
+from .metrics import Metrics, MetricsServer
+
+DEFAULT_SESSION_PEERS = 500
+DEFAULT_SESSION_HALF_OPEN = 32
+
+
+class Session():
+    """
+    runs any number of torrents on one event loop.
+
+    the torrents share one timer wheel, one listening port, one set of
+    hash and disk threads and one connection budget, so each extra torrent
+    costs its own state and connections but no threads. every torrent keeps
+    its own connection and rate limits inside the session wide ones,
+    `download_rate` and `upload_rate` in bytes a second, None for no limit.
+
+    `metrics` covers the session and all of its torrents, labelled by info
+    hash, and is served over http on `metrics_port` if that is given.
+    """
+
+    def __init__(self, loop, port=DEFAULT_PORT, max_peers=DEFAULT_SESSION_PEERS,
+                 max_half_open=DEFAULT_SESSION_HALF_OPEN, hash_workers=DEFAULT_HASH_WORKERS,
+                 hash_processes=False, io_workers=IO_WORKERS,
+                 download_rate=None, upload_rate=None, metrics_port=None):
+        self.logger = logging.getLogger('main.session')
+        self.loop = loop
+        self.port = port
+        self.timers = TimerWheel(loop)
+        self.budget = ConnectionBudget(max_peers, max_half_open)
+        self.download_limit = TokenBucket(loop, download_rate)
+        self.upload_limit = TokenBucket(loop, upload_rate)
+        self.hash_workers = hash_workers
+        self.hash_processes = hash_processes
+        if hash_processes:
+            self.hash_executor = ProcessPoolExecutor(hash_workers)
+        else:
+            self.hash_executor = ThreadPoolExecutor(hash_workers)
+        self.disk = DiskScheduler(loop, io_workers)
+        self.torrents = {} # info hash -> TorrentClient
+        self.tasks = {}    # TorrentClient -> task running it
+        self.listener = Listener(loop, self.torrents.get, port=port)
+        self.running = False
+        self.labels = {}
+        self.metrics = Metrics([self.collect_metrics])
+        self.metrics_server = None
+        if metrics_port is not None:
+            self.metrics_server = MetricsServer(loop, self.metrics, port=metrics_port)
+
+    def collect_metrics(self):
+        for sample in self.disk.collect_metrics(self.labels):
+            yield sample
+        for sample in self.listener.collect_metrics(self.labels):
+            yield sample
+        for client in list(self.torrents.values()):
+            for sample in client.collect_metrics():
+                yield sample
+
+    async def start(self):
+        self.port = await self.listener.start()
+        if self.metrics_server is not None:
+            await self.metrics_server.start()
+        self.timers.start()
+        self.running = True
+        for client in self.torrents.values():
+            self._run(client)
+
+    def add_torrent(self, torrent_file, download_destination, **options):
+        """ add a torrent, it starts right away if the session is running """
+
+        # before the client opens the files and the resume data of one we already run
+        torrent = Torrent(torrent_file, options.get('metadata_cache'))
+        if torrent.info_hash in self.torrents:
+            raise ValueError('torrent {} is already in the session'.format(torrent.info_hash.hex()))
+        client = TorrentClient(torrent_file, download_destination, self.loop,
+                               session=self, torrent=torrent, **options)
+        self.torrents[torrent.info_hash] = client
+        if self.running:
+            self._run(client)
+        return client
+
+    def _run(self, client):
+        self.tasks[client] = self.loop.create_task(client.connect_to_peers())
+
+    async def remove_torrent(self, client):
+        del self.torrents[client.torrent.info_hash]
+        await client.stop()
+        task = self.tasks.pop(client, None)
+        if task is not None:
+            task.cancel()
+
+    async def stop(self):
+        self.running = False
+        self.listener.close()
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+        await asyncio.gather(*[self.remove_torrent(client)
+                               for client in list(self.torrents.values())])
+        self.timers.stop()
+        await self.disk.flush()
+        self.disk.close()
+        self.hash_executor.shutdown(wait=False)
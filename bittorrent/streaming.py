@@ -0,0 +1,113 @@
+import asyncio
+import logging
+from bisect import bisect_right
+
+from .picker import SKIP, NORMAL
+
+DEFAULT_STREAM_WINDOW = 16 # pieces ahead of a reader that get a deadline
+DEADLINE_STEP = 0.5        # seconds between the deadlines of neighbouring pieces
+
+
+class Streamer():
+    """
+    reads from the torrent's files while they are still downloading.
+
+    `read` waits until the pieces it covers are verified. it also moves
+    that file's playhead: the `window` pieces from where it reads on get
+    deadlines, the nearest first, so the picker fetches them ahead of
+    everything else and in order, and the deadlines left over from where
+    the reader was before are dropped. a window of 0 reads without
+    deadlines.
+
+    file priorities map onto the pieces of the file, a piece shared by two
+    files gets the higher of the two.
+    """
+
+    def __init__(self, loop, torrent, file_manager, picker, run, wake,
+                 window=DEFAULT_STREAM_WINDOW):
+        self.logger = logging.getLogger('main.streamer')
+        self.loop = loop
+        self.torrent = torrent
+        self.file_manager = file_manager
+        self.picker = picker
+        self.run = run     # runs a blocking storage call off the loop
+        self.wake = wake   # called when what we want from peers changed
+        self.window = window
+        self.file_priorities = [NORMAL] * len(file_manager.files)
+        self.playheads = {} # file index -> pieces that have a deadline for it
+        self.waiters = {}   # piece index -> futures of reads waiting for it
+
+    def set_file_priority(self, file_index, priority):
+        self.file_priorities[file_index] = priority
+        pieces = self.file_manager.file_pieces(file_index)
+        for index in pieces:
+            self.picker.set_priority(index, self._piece_priority(index))
+        self.wake()
+
+    def _piece_priority(self, index):
+        offsets = self.file_manager.file_offsets
+        files = self.file_manager.files
+        start = index * self.file_manager.piece_length
+        end = start + self.torrent.piece_length(index)
+        priority = SKIP
+        i = bisect_right(offsets, start) - 1
+        while i < len(offsets) and offsets[i] < end:
+            if files[i]['length']:
+                priority = max(priority, self.file_priorities[i])
+            i += 1
+        return priority
+
+    async def read(self, file_index, offset, length):
+        """ `length` bytes at `offset` in the file, once they are downloaded and verified """
+
+        f = self.file_manager.files[file_index]
+        length = max(0, min(length, f['length'] - offset))
+        if length == 0:
+            return b''
+        start = self.file_manager.file_offsets[file_index] + offset
+        piece_length = self.file_manager.piece_length
+        first = start // piece_length
+        last = (start + length - 1) // piece_length
+
+        self._move_playhead(file_index, first, last)
+        for index in range(first, last + 1):
+            if self.picker.priority[index] == SKIP:
+                # reading it means we want it after all
+                self.picker.set_priority(index, NORMAL)
+        missing = [index for index in range(first, last + 1) if not self.picker.done[index]]
+        if missing:
+            self.wake()
+            await asyncio.gather(*[self._wait_for(index) for index in missing])
+
+        piece_index, begin = divmod(start, piece_length)
+        chunks = await self.run(self.file_manager.read, piece_index, begin, length)
+        return b''.join(chunks)
+
+    def _move_playhead(self, file_index, first, last):
+        if not self.window:
+            return
+        end = max(last + 1, min(first + self.window, self.file_manager.file_pieces(file_index).stop))
+        ahead = set(range(first, end))
+        for index in self.playheads.get(file_index, set()) - ahead:
+            self.picker.clear_deadline(index)
+        now = self.loop.time()
+        for index in ahead:
+            self.picker.set_deadline(index, now + (index - first) * DEADLINE_STEP)
+        self.playheads[file_index] = ahead
+
+    def _wait_for(self, index):
+        future = self.loop.create_future()
+        self.waiters.setdefault(index, []).append(future)
+        return future
+
+    def piece_done(self, index):
+        for future in self.waiters.pop(index, ()):
+            if not future.done():
+                future.set_result(None)
+
+    def close(self):
+        for futures in self.waiters.values():
+            for future in futures:
+                if not future.done():
+                    future.set_exception(IOError('torrent closed'))
+        self.waiters = {}
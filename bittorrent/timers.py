@@ -0,0 +1,93 @@
+import math
+import logging
+
+TICK = 1.0
+SLOTS = 256
+
+
+class Timer():
+
+    def __init__(self, callback, args, interval=None):
+        self.callback = callback
+        self.args = args
+        self.interval = interval # set for timers that repeat
+        self.rounds = 0
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerWheel():
+    """
+    hashed timer wheel, the one clock behind every keepalive, timeout and
+    periodic job so they do not need a sleeping coroutine each.
+
+    timers go into one of `slots` lists by when they are due, a whole turn
+    of the wheel being `slots * tick` seconds. once a tick the current slot
+    is walked, timers with turns left stay and the others fire. adding and
+    cancelling are O(1), a cancelled timer is dropped when its slot comes
+    around. the resolution is one tick.
+    """
+
+    def __init__(self, loop, tick=TICK, slots=SLOTS):
+        self.logger = logging.getLogger('main.timer_wheel')
+        self.loop = loop
+        self.tick = tick
+        self.wheel = [[] for _ in range(slots)]
+        self.position = 0 # slot handled on the next tick
+        self.handle = None
+        self.next_tick = None
+
+    def call_later(self, delay, callback, *args):
+        timer = Timer(callback, args)
+        self._insert(timer, delay)
+        return timer
+
+    def every(self, interval, callback, *args):
+        """ call `callback` every `interval` seconds until the timer is cancelled """
+
+        timer = Timer(callback, args, interval)
+        self._insert(timer, interval)
+        return timer
+
+    def _insert(self, timer, delay):
+        ticks = max(1, math.ceil(delay / self.tick))
+        slots = len(self.wheel)
+        timer.rounds = (ticks - 1) // slots
+        self.wheel[(self.position + ticks - 1) % slots].append(timer)
+
+    def start(self):
+        if self.handle is None:
+            self.next_tick = self.loop.time() + self.tick
+            self.handle = self.loop.call_at(self.next_tick, self._run)
+
+    def stop(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+    def _run(self):
+        self.next_tick += self.tick
+        self.handle = self.loop.call_at(self.next_tick, self._run)
+        self.advance()
+
+    def advance(self):
+        """ move the wheel on by one tick and fire whatever is due """
+
+        slot = self.wheel[self.position]
+        self.wheel[self.position] = waiting = []
+        self.position = (self.position + 1) % len(self.wheel)
+        for timer in slot:
+            if timer.cancelled:
+                continue
+            if timer.rounds:
+                timer.rounds -= 1
+                waiting.append(timer)
+                continue
+            try:
+                timer.callback(*timer.args)
+            except Exception as e:
+                self.logger.exception('timer {}: {}'.format(timer.callback, e))
+            if timer.interval is not None and not timer.cancelled:
+                self._insert(timer, timer.interval)
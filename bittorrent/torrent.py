@@ -3,32 +3,71 @@ import time
 import logging
 from random import choice
 from string import digits, ascii_letters
-from hashlib import sha1
-from bcoding import bdecode, bencode
+
+from . import metainfo
 
 
 class Torrent():
+    """
+    the metadata of a torrent, read once and laid out for lookups.
+
+    the info hash is the sha1 of the info dict's bytes as they are in the
+    file. the piece hashes stay one view into the file's bytes. the files
+    are kept as (path, length) tuples in `files`, not in `info`, and the
+    total length, the last piece's length and where every file starts are
+    worked out up front, so the per block lookups are O(1). with
+    `cache_dir` the decoded info dict is saved there under its info hash,
+    and loading the torrent again does not decode it.
+    """
 
-    def __init__(self, torrent_file):
+    def __init__(self, torrent_file, cache_dir=None):
         self.logger = logging.getLogger('main.torrent')
-        self.metainfo = self.read_torrent_file(torrent_file)
-        self.announce_url = self.metainfo['announce']
-        self.info = self.metainfo['info']
-        self.logger.info(self.info['files'])
-        pieces_hash = self.info['pieces']
-        self.piece_hash_list = []
-        while len(pieces_hash) > 0:
-            self.piece_hash_list.append(pieces_hash[0:20])
-            pieces_hash = pieces_hash[20:]
-        self.info_hash = sha1(bencode(self.info)).digest()
+        data = self.read_torrent_file(torrent_file)
+        self.metainfo, self.info, files, self.info_hash = metainfo.load(data, cache_dir)
+        self.metainfo['info'] = self.info
+        self.announce_tiers = self.get_announce_tiers()
+        self.announce_url = self.announce_tiers[0][0] if self.announce_tiers else None
+        self.piece_hash_list = metainfo.PieceHashes(self.info['pieces'])
         self.peer_id = self.generate_peer_id()
-        self.left = self.file_length()
         self.REQUEST_LENGTH = 2**14
         self.number_of_pieces = self.get_number_of_pieces()
+        self._layout(files)
+        self.left = self.total_length
 
     def read_torrent_file(self, torrent_file):
         with open(torrent_file, 'rb') as f:
-            return bdecode(f.read())
+            return f.read()
+
+    def _layout(self, files):
+        """ the lengths and offsets every lookup after this uses """
+
+        self.name = self.info['name']
+        self.multi_file = files is not None
+        if files is None:
+            files = [((self.name,), self.info['length'])]
+        self.files = files
+        self.file_offsets = []
+        offset = 0
+        for _, length in self.files:
+            self.file_offsets.append(offset)
+            offset += length
+        self.total_length = offset
+        self.standard_piece_length = self.info['piece length']
+        if self.number_of_pieces != math.ceil(self.total_length / self.standard_piece_length):
+            raise ValueError('{} piece hashes for {} bytes in pieces of {}'.format(
+                self.number_of_pieces, self.total_length, self.standard_piece_length))
+        self.last_piece_length = (self.total_length -
+                (self.number_of_pieces - 1) * self.standard_piece_length)
+
+    def get_announce_tiers(self):
+        """ tiers of tracker urls, from announce-list if there is one (BEP 12) """
+
+        tiers = [[url for url in tier if url]
+                 for tier in self.metainfo.get('announce-list', []) if isinstance(tier, list)]
+        tiers = [tier for tier in tiers if tier]
+        if not tiers and self.metainfo.get('announce'):
+            tiers = [[self.metainfo['announce']]]
+        return tiers
 
     def generate_peer_id(self):
         client_id = 'AS'
@@ -43,27 +82,12 @@ class Torrent():
         return math.ceil(self.piece_length(piece_index) / self.REQUEST_LENGTH)
 
     def file_length(self):
-        length = 0
-
-        if 'length' in self.info:
-            length = self.info['length']
-        else:
-            files = self.info['files']
-            for file_dict in files:
-                length += file_dict['length']
-
-        return length
+        return self.total_length
 
     def piece_length(self, piece_index):
-        total_length = self.file_length()
-        piece_length = self.info['piece length']
-        last_piece_index = math.floor(total_length / piece_length)
-        last_piece_length = total_length % piece_length
-
-        if piece_index == last_piece_index:
-            return last_piece_length
-        else:
-            return piece_length
+        if piece_index == self.number_of_pieces - 1:
+            return self.last_piece_length
+        return self.standard_piece_length
 
     def block_length(self, piece_index, block_index):
         piece_length = self.piece_length(piece_index)
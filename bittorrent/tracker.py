@@ -1,92 +1,206 @@
 import socket
-import logging
-import os
+import random
 import struct
-import time
-from random import randint
+import asyncio
+import logging
 from urllib.parse import urlparse, urlencode
-from urllib.request import urlopen
 
 from bcoding import bdecode
 
 CONNECT = 0
 ANNOUNCE = 1
+ERROR = 3
 DEFAULT_CONNECTION_ID = 0x41727101980
+EVENTS = {None: 0, 'completed': 1, 'started': 2, 'stopped': 3}
+
+DEFAULT_PORT = 6881
+DEFAULT_INTERVAL = 1800
+UDP_TIMEOUT = 15 # BEP 15: the n-th attempt waits 15 * 2**n seconds
+UDP_RETRIES = 8
+TIER_UDP_RETRIES = 0 # when the tier has other trackers to fall back on
+CONNECTION_ID_LIFETIME = 60
+HTTP_TIMEOUT = 30
+RETRY_DELAY = 30 # first retry after a failed announce, doubling up to the interval
+STOP_TIMEOUT = 5
+
+CONNECT_RESPONSE = struct.Struct('!IIQ')
+ANNOUNCE_REQUEST = struct.Struct('!QII20s20sQQQIIIiH')
+ANNOUNCE_RESPONSE = struct.Struct('!IIIII')
+
+
+class TrackerError(Exception):
+    pass
+
+
+def decode_peers(bin_peers):
+    """
+    The first 4 bytes contain the 32-bit ipv4 address.
+    The remaining two bytes contain the port number.
+    Both address and port use network-byte order.
+    """
+
+    peers = []
+    for offset in range(0, len(bin_peers) - len(bin_peers) % 6, 6):
+        hostname = socket.inet_ntoa(bin_peers[offset:offset + 4])
+        port = struct.unpack_from('!H', bin_peers, offset + 4)[0]
+        peers.append({'hostname': hostname, 'port': port})
+    return peers
+
+
+async def http_get(url):
+    """ body of a plain GET, without blocking the loop """
+
+    u = urlparse(url)
+    https = u.scheme == 'https'
+    reader, writer = await asyncio.open_connection(
+            u.hostname, u.port or (443 if https else 80), ssl=True if https else None)
+    try:
+        path = u.path or '/'
+        if u.query:
+            path += '?' + u.query
+        writer.write('GET {} HTTP/1.0\r\nHost: {}\r\nConnection: close\r\n\r\n'.format(
+            path, u.netloc).encode('ascii'))
+        response = await reader.read()
+    finally:
+        writer.close()
+    head, _, body = response.partition(b'\r\n\r\n')
+    status = head.split(b'\r\n', 1)[0].split()
+    if len(status) < 2 or status[1] != b'200':
+        raise TrackerError('{} answered {}'.format(u.netloc, b' '.join(status[1:]).decode(errors='replace')))
+    return body
+
+
+class UdpTrackerProtocol(asyncio.DatagramProtocol):
+    """ matches the answers of a udp tracker to the requests by transaction id """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.transport = None
+        self.waiting = {} # transaction id -> future
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if len(data) < 8:
+            return
+        transaction_id = struct.unpack_from('!I', data, 4)[0]
+        future = self.waiting.pop(transaction_id, None)
+        if future is not None and not future.done():
+            future.set_result(data)
+
+    def error_received(self, exc):
+        self._fail(exc)
+
+    def connection_lost(self, exc):
+        self._fail(exc or ConnectionResetError('tracker socket closed'))
+
+    def _fail(self, exc):
+        waiting, self.waiting = self.waiting, {}
+        for future in waiting.values():
+            if not future.done():
+                future.set_exception(exc)
+
+    async def request(self, transaction_id, message, timeout):
+        future = self.loop.create_future()
+        self.waiting[transaction_id] = future
+        self.transport.sendto(message)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self.waiting.pop(transaction_id, None)
+
 
 class Tracker():
+    """
+    announces to one tracker over udp (BEP 15) or http, returning the
+    re-announce interval and the peers it handed out
+    """
 
-    def __init__(self, torrent):
+    def __init__(self, torrent, loop, url=None, port=DEFAULT_PORT,
+                 udp_timeout=UDP_TIMEOUT, udp_retries=UDP_RETRIES):
         self.logger = logging.getLogger('main.tracker')
         self.torrent = torrent
-        self.url = self.torrent.announce_url
+        self.loop = loop
+        self.url = url or self.torrent.announce_url
         u = urlparse(self.url)
         self.scheme = u.scheme
         self.hostname = u.hostname
         self.port = u.port
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.timeout = 2
-        self.connection_id = DEFAULT_CONNECTION_ID
+        self.listen_port = port
+        self.udp_timeout = udp_timeout
+        self.udp_retries = udp_retries
+        self.key = random.getrandbits(32)
+        self.transport = None
+        self.protocol = None
+        self.connection_id = None
+        self.connection_time = None
+        self.tracker_id = None
+        # health, kept up to date by TrackerTier
+        self.announced = False # the tracker knows about us
+        self.failures = 0      # failed announces in a row
+        self.latency = None
 
-    def connect(self):
+    async def announce(self, event=None, uploaded=0, downloaded=0, left=0):
         if self.scheme == 'udp':
-            return self._connect_via_udp()
-        elif self.scheme == 'http':
-            return self._connect_via_http()
-        else:
-            self.logger.error('client couldnt understand tracker announce url')
-
-    def _connect_via_udp(self):
-        connect_response = self._connect_request()
-        action, transition_id, connection_id = struct.unpack('!LLQ', connect_response)
-        self.connection_id = connection_id
-        self.transition_id = transition_id
-        if action == CONNECT:
-            announce_response = self._announce_request(transition_id)
-            # self.logger.info(len(announce_response))
-            action, transition_id, interval = struct.unpack('!3I', announce_response[:12])
-            if transition_id == self.transition_id:
-                bin_peers = announce_response[20:]
-                return self._decode_peers(bin_peers)
-        else:
-            self.logger.error('Error sending request to tracker via udp')
-
-    def _announce_request(self, transition_id):
-        message = b''.join([
-            struct.pack('!Q', self.connection_id),
-            struct.pack('!I',  ANNOUNCE),
-            struct.pack('!I', transition_id),
-            struct.pack('!20s', self.torrent.info_hash),
-            struct.pack('!20s', str.encode(self.torrent.peer_id)),
-            struct.pack('!Q', 0),
-            struct.pack('!Q', self.torrent.left),
-            struct.pack('!Q', 0),
-            struct.pack('!I', 2),
-            struct.pack('!I', 0),
-            struct.pack('!i', -1),
-            struct.pack('!I', randint(0, 2**32 -1)),
-            struct.pack('!H', 6881)
-        ])
-        return self._send_message(message)
-
-
-    def _connect_request(self):
-        action = CONNECT
-        transition_id = randint(0, 2**32 -1)
-        message = struct.pack('!QLL', self.connection_id, action, transition_id)
-        # self.logger.info(transition_id)
-        return self._send_message(message)
-
-    def _send_message(self, message):
-        self.sock.sendto(message, (self.hostname, self.port))
-        self.sock.settimeout(self.timeout)
-        try:
-            response = self.sock.recv(1024)
-        except socket.timeout:
-            self.logger.error('socket timeout')
+            return await self._announce_via_udp(event, uploaded, downloaded, left)
+        elif self.scheme in ('http', 'https'):
+            return await self._announce_via_http(event, uploaded, downloaded, left)
+        raise TrackerError('client couldnt understand tracker announce url {}'.format(self.url))
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+
+    async def _udp_request(self, build, expected_action, size, timeout):
+        """ the answer to a request, at least `size` bytes of the expected action """
 
-        return response
+        transaction_id = random.getrandbits(32)
+        data = await self.protocol.request(transaction_id, build(transaction_id), timeout)
+        # the protocol only hands over answers of 8 bytes or more with our transaction id
+        action = struct.unpack_from('!I', data)[0]
+        if action == ERROR:
+            # maybe our connection id went stale, get a new one next time
+            self.connection_id = None
+            raise TrackerError(data[8:].decode(errors='replace'))
+        if action != expected_action:
+            raise TrackerError('unexpected action {} from {}'.format(action, self.url))
+        if len(data) < size:
+            raise TrackerError('short answer of {} bytes from {}'.format(len(data), self.url))
+        return data
 
-    def _connect_via_http(self):
+    async def _announce_via_udp(self, event, uploaded, downloaded, left):
+        if self.transport is None:
+            self.transport, self.protocol = await self.loop.create_datagram_endpoint(
+                    lambda: UdpTrackerProtocol(self.loop), remote_addr=(self.hostname, self.port))
+
+        for n in range(self.udp_retries + 1):
+            timeout = self.udp_timeout * 2**n
+            try:
+                if (self.connection_id is None or
+                        self.loop.time() - self.connection_time > CONNECTION_ID_LIFETIME):
+                    data = await self._udp_request(
+                            lambda t: struct.pack('!QII', DEFAULT_CONNECTION_ID, CONNECT, t),
+                            CONNECT, CONNECT_RESPONSE.size, timeout)
+                    self.connection_id = CONNECT_RESPONSE.unpack_from(data)[2]
+                    self.connection_time = self.loop.time()
+
+                data = await self._udp_request(lambda t: ANNOUNCE_REQUEST.pack(
+                        self.connection_id, ANNOUNCE, t,
+                        self.torrent.info_hash, self.torrent.peer_id.encode(),
+                        downloaded, left, uploaded, EVENTS[event],
+                        0, self.key, -1, self.listen_port), ANNOUNCE, ANNOUNCE_RESPONSE.size, timeout)
+            except asyncio.TimeoutError:
+                self.logger.debug('{} did not answer within {}s'.format(self.url, timeout))
+                continue
+
+            _, _, interval, leechers, seeders = ANNOUNCE_RESPONSE.unpack_from(data)
+            return interval, decode_peers(data[ANNOUNCE_RESPONSE.size:])
+
+        raise TrackerError('no answer from {}'.format(self.url))
+
+    async def _announce_via_http(self, event, uploaded, downloaded, left):
         """
         https://wiki.theory.org/BitTorrentSpecification#Tracker_Request_Parameters
         make a request to tracker which is an HTTP(S) service
@@ -96,38 +210,181 @@ class Tracker():
         params = {
             'info_hash': self.torrent.info_hash,
             'peer_id': self.torrent.peer_id,
-            'left': self.torrent.left,
-            'downloaded': 0,
-            'uploaded': 0,
-            'port': 6881,
+            'left': left,
+            'downloaded': downloaded,
+            'uploaded': uploaded,
+            'port': self.listen_port,
             'compact': 1,
-            'event': 'started'
+            'key': self.key,
         }
+        if event is not None:
+            params['event'] = event
+        if self.tracker_id is not None:
+            params['trackerid'] = self.tracker_id
+
+        url = self.url + ('&' if '?' in self.url else '?') + urlencode(params)
+        body = await asyncio.wait_for(http_get(url), HTTP_TIMEOUT)
+        try:
+            response = bdecode(body)
+        except (TypeError, ValueError) as e:
+            raise TrackerError('bad response from {}: {}'.format(self.url, e))
+        if not isinstance(response, dict):
+            raise TrackerError('bad response from {}'.format(self.url))
+        if 'failure reason' in response:
+            raise TrackerError(response['failure reason'])
+        if 'tracker id' in response:
+            self.tracker_id = response['tracker id']
 
-        url = self.url + '?' + urlencode(params)
-        r = urlopen(url)
-        response = bdecode(r.read())
-        if 'failure reason' not in response:
-            return self._decode_peers(response['peers'])
+        interval = response.get('interval', DEFAULT_INTERVAL)
+        peers = response.get('peers', b'')
+        if isinstance(peers, str):
+            # bdecode hands back str for anything that happens to be valid utf-8
+            peers = peers.encode('utf-8')
+        if not isinstance(interval, int) or not isinstance(peers, (bytes, list)):
+            raise TrackerError('bad response from {}'.format(self.url))
+        if isinstance(peers, bytes):
+            peers = decode_peers(peers)
+        elif not all(isinstance(p, dict) and 'ip' in p and 'port' in p for p in peers):
+            raise TrackerError('bad peer list from {}'.format(self.url))
         else:
-            time.sleep(response['interval'])
+            peers = [{'hostname': p['ip'], 'port': p['port']} for p in peers]
+        return interval, peers
 
-    def _decode_peers(self, bin_peers):
-        """
-        The first 4 bytes contain the 32-bit ipv4 address.
-        The remaining two bytes contain the port number.
-        Both address and port use network-byte order.
-        """
-        offset = 0
-        peers = []
-        # Length of bin_peers should be multiple of 6
-        while offset != len(bin_peers):
-            bin_ip = struct.unpack_from('!i', bin_peers, offset)[0]
-            hostname = socket.inet_ntoa(struct.pack('!i', bin_ip))
-            offset += 4
-            port = struct.unpack_from('!H', bin_peers, offset)[0]
-            offset += 2
-            peer = {'hostname': hostname, 'port': port}
-            peers.append(peer)
-
-        return peers
+
+class TrackerTier():
+    """
+    the trackers of one announce-list tier (BEP 12). an announce goes to
+    the first one in the list and falls through to the next if it fails.
+    the list is kept sorted by health, trackers that failed most recently
+    go last and among the working ones the faster ones go first.
+    """
+
+    def __init__(self, announcer, trackers):
+        self.logger = logging.getLogger('main.tracker_tier')
+        self.announcer = announcer
+        self.trackers = trackers
+        self.interval = DEFAULT_INTERVAL
+        self.failures = 0
+        self.timer = None
+        self.task = None
+
+    def announce_soon(self, event=None):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+        self.task = asyncio.ensure_future(self._announce(event))
+
+    def _schedule(self, delay, event=None):
+        if self.announcer.running:
+            self.timer = self.announcer.timers.call_later(delay, self.announce_soon, event)
+
+    def _health(self, tracker):
+        return (tracker.failures, tracker.latency is None, tracker.latency or 0)
+
+    async def _announce(self, event):
+        loop = self.announcer.loop
+        uploaded, downloaded, left = self.announcer.stats()
+        for tracker in list(self.trackers):
+            # a tracker that never heard of us has to get `started` first
+            sent = event if tracker.announced else 'started'
+            start = loop.time()
+            try:
+                interval, peers = await tracker.announce(sent, uploaded, downloaded, left)
+            except (TrackerError, OSError, asyncio.TimeoutError, ValueError, KeyError) as e:
+                tracker.failures += 1
+                self.logger.error('announce to {} failed: {}'.format(tracker.url, e))
+                continue
+
+            tracker.failures = 0
+            tracker.announced = True
+            elapsed = loop.time() - start
+            if tracker.latency is None:
+                tracker.latency = elapsed
+            else:
+                tracker.latency += (elapsed - tracker.latency) / 4
+            self.trackers.sort(key=self._health)
+            self.failures = 0
+            self.interval = interval or DEFAULT_INTERVAL
+            self.logger.info('tracker {} gave us {} peers'.format(tracker.url, len(peers)))
+            self.announcer.on_peers(peers)
+            self._schedule(self.interval)
+            return
+
+        self.trackers.sort(key=self._health)
+        self.failures += 1
+        delay = min(RETRY_DELAY * 2 ** (self.failures - 1), self.interval)
+        self.logger.error('no tracker of the tier answered, retrying in {}s'.format(delay))
+        # the event has not been seen yet, so it goes out with the retry
+        self._schedule(delay, event)
+
+    async def stop(self):
+        if self.timer is not None:
+            self.timer.cancel()
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+        uploaded, downloaded, left = self.announcer.stats()
+        for tracker in self.trackers:
+            if tracker.announced:
+                try:
+                    await asyncio.wait_for(
+                            tracker.announce('stopped', uploaded, downloaded, left), STOP_TIMEOUT)
+                except (TrackerError, OSError, asyncio.TimeoutError, ValueError, KeyError) as e:
+                    self.logger.info('stopped announce to {}: {}'.format(tracker.url, e))
+            tracker.close()
+
+
+class Announcer():
+    """
+    keeps the trackers up to date in the background: `started` when we
+    begin, a plain announce every interval the tracker asks for,
+    `completed` once the download finishes and `stopped` on the way out.
+    every announce reports what `stats()` returns as (uploaded, downloaded,
+    left), and the peers that come back go to `on_peers`.
+
+    the tiers of the announce-list are announced to side by side, each one
+    on its own schedule. within a tier the trackers are shuffled once and
+    then tried in order, see TrackerTier.
+    """
+
+    def __init__(self, loop, timers, torrent, stats, on_peers, port=DEFAULT_PORT):
+        self.logger = logging.getLogger('main.announcer')
+        self.loop = loop
+        self.timers = timers
+        self.stats = stats
+        self.on_peers = on_peers
+        self.running = False
+        self.tiers = []
+        for urls in torrent.announce_tiers:
+            urls = list(urls)
+            random.shuffle(urls)
+            retries = UDP_RETRIES if len(urls) == 1 else TIER_UDP_RETRIES
+            self.tiers.append(TrackerTier(self, [Tracker(torrent, loop, url, port, udp_retries=retries)
+                                                 for url in urls]))
+
+    @property
+    def trackers(self):
+        return [tracker for tier in self.tiers for tracker in tier.trackers]
+
+    def start(self, port=None):
+        """ `port` is the one we listen on, if it is only known now """
+
+        if port is not None:
+            for tracker in self.trackers:
+                tracker.listen_port = port
+        if not self.running:
+            self.running = True
+            for tier in self.tiers:
+                tier.announce_soon('started')
+
+    def completed(self):
+        if self.running:
+            for tier in self.tiers:
+                tier.announce_soon('completed')
+
+    async def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        await asyncio.gather(*[tier.stop() for tier in self.tiers])
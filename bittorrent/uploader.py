@@ -0,0 +1,160 @@
+import asyncio
+import logging
+from collections import OrderedDict
+
+DEFAULT_CACHE_BYTES = 64 * 2**20
+MAX_REQUEST_LENGTH = 2**17 # bigger requests are refused, like most clients do
+
+
+class PieceCache():
+    """ least recently used whole pieces, at most `max_bytes` of them """
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.pieces = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, piece_index):
+        return piece_index in self.pieces
+
+    def get(self, piece_index):
+        data = self.pieces.get(piece_index)
+        if data is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.pieces.move_to_end(piece_index)
+        return data
+
+    def put(self, piece_index, data):
+        if len(data) > self.max_bytes or piece_index in self.pieces:
+            return
+        self.pieces[piece_index] = data
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            _, old = self.pieces.popitem(last=False)
+            self.size -= len(old)
+
+
+class Uploader():
+    """
+    answers REQUEST messages with verified data from disk.
+
+    each peer's requests are served one after the other in the order they
+    came in, the next one only once the connection took the previous block,
+    so a CANCEL can still catch whatever is queued. pieces are read whole
+    into a shared cache: leechers asking for the same hot pieces cost one
+    read, and the piece after the one a peer is reading straight through
+    is loaded before it asks for it.
+    """
+
+    def __init__(self, loop, torrent, file_manager, done, executor,
+                 cache_bytes=DEFAULT_CACHE_BYTES):
+        self.logger = logging.getLogger('main.uploader')
+        self.loop = loop
+        self.torrent = torrent
+        self.file_manager = file_manager
+        self.done = done # one byte per piece, set once the piece is verified
+        self.executor = executor
+        self.cache = PieceCache(cache_bytes)
+        self.loading = {} # piece index -> future of a read in progress
+        self.uploaded = 0
+        self.disk_reads = 0
+
+    def request(self, peer, index, begin_offset, length):
+        """ queue a request from `peer`, invalid ones are dropped """
+
+        if peer.am_choking:
+            return
+        if not (0 <= index < self.torrent.number_of_pieces and self.done[index]):
+            self.logger.debug('{} asked for piece {} we do not have'.format(peer.address, index))
+            return
+        if (length <= 0 or length > MAX_REQUEST_LENGTH or begin_offset < 0 or
+                begin_offset + length > self.torrent.piece_length(index)):
+            self.logger.debug('{} sent a bad request {} {} {}'.format(
+                peer.address, index, begin_offset, length))
+            return
+
+        peer.upload_requests.append((index, begin_offset, length))
+        if not peer.uploading:
+            peer.uploading = True
+            asyncio.ensure_future(self._serve(peer))
+
+    def cancel(self, peer, index, begin_offset, length):
+        try:
+            peer.upload_requests.remove((index, begin_offset, length))
+        except ValueError:
+            pass
+
+    def choked(self, peer):
+        """ a choked peer's pending requests are dropped, it has to ask again """
+
+        peer.upload_requests.clear()
+
+    async def _serve(self, peer):
+        try:
+            while peer.upload_requests:
+                index, begin_offset, length = peer.upload_requests[0]
+                if peer.upload_throttle is not None:
+                    await peer.upload_throttle.acquire(length)
+                data = await self.read_piece(index)
+                # a CANCEL or CHOKE may have come in during the read
+                if not peer.upload_requests or peer.upload_requests[0] != (index, begin_offset, length):
+                    continue
+                peer.upload_requests.popleft()
+                peer.outbound.piece(index, begin_offset,
+                        memoryview(data)[begin_offset:begin_offset + length])
+                peer.uploaded += length
+                peer.upload_rate.add(length)
+                self.uploaded += length
+                self._read_ahead(peer, index)
+                await peer.outbound.drain()
+        except (ConnectionError, IOError) as e:
+            self.logger.debug('upload to {}: {}'.format(peer.address, e))
+            peer.upload_requests.clear()
+        finally:
+            peer.uploading = False
+
+    async def read_piece(self, piece_index):
+        data = self.cache.get(piece_index)
+        if data is not None:
+            return data
+        if piece_index not in self.loading:
+            self.loading[piece_index] = asyncio.ensure_future(self._load(piece_index))
+        # other requesters may be waiting for the same read
+        return await asyncio.shield(self.loading[piece_index])
+
+    async def _load(self, piece_index):
+        try:
+            data = await self.loop.run_in_executor(self.executor, self._read, piece_index)
+            self.cache.put(piece_index, data)
+            return data
+        finally:
+            del self.loading[piece_index]
+
+    def _read(self, piece_index):
+        self.disk_reads += 1
+        chunks = self.file_manager.read(piece_index, 0, self.torrent.piece_length(piece_index))
+        if len(chunks) == 1 and isinstance(chunks[0], bytes):
+            return chunks[0]
+        # views into a mapping must not outlive it, so those get copied too
+        return b''.join(chunks)
+
+    def _read_ahead(self, peer, index):
+        if index == peer.last_uploaded_piece:
+            return
+        sequential = index == peer.last_uploaded_piece + 1
+        peer.last_uploaded_piece = index
+        following = index + 1
+        if (sequential and following < self.torrent.number_of_pieces and
+                self.done[following] and following not in self.cache and
+                following not in self.loading):
+            future = asyncio.ensure_future(self._load(following))
+            future.add_done_callback(self._read_ahead_done)
+            self.loading[following] = future
+
+    def _read_ahead_done(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            self.logger.error('read ahead: {}'.format(future.exception()))
@@ -1,77 +1,233 @@
 import time
 import math
 import logging
+from array import array
 
+# block states
+MISSING = 0
+REQUESTED = 1
+RECEIVED = 2
+MISSING_BYTE = bytes([MISSING])
 
-class Pieces():
+DEFAULT_BUFFER_BYTES = 64 * 2**20
+
+
+def to_bitfield(flags):
+    """ one byte per piece to a BITFIELD style bit string, high bit first """
+
+    field = bytearray((len(flags) + 7) // 8)
+    for index, flag in enumerate(flags):
+        if flag:
+            field[index >> 3] |= 0x80 >> (index & 7)
+    return bytes(field)
+
+
+def from_bitfield(field, number_of_pieces):
+    return [index for index in range(number_of_pieces)
+            if field[index >> 3] & (0x80 >> (index & 7))]
+
+
+class BufferPool():
+    """
+    piece sized buffers for assembling pieces, at most `max_bytes` worth of them.
+    released buffers go on a free list and get handed out again.
+    """
 
-    def __init__(self, torrent):
+    def __init__(self, buffer_length, max_bytes=DEFAULT_BUFFER_BYTES):
+        self.buffer_length = buffer_length
+        # always allow one piece, otherwise nothing could ever be downloaded
+        self.capacity = max(1, max_bytes // buffer_length)
+        self.free = []
+        self.in_use = 0
+
+    def has_free(self):
+        return self.in_use < self.capacity
+
+    def acquire(self):
+        if not self.has_free():
+            return None
+        self.in_use += 1
+        if self.free:
+            return self.free.pop()
+        return bytearray(self.buffer_length)
+
+    def release(self, buffer):
+        self.in_use -= 1
+        self.free.append(buffer)
+
+
+class Pieces():
+    """
+    block level download state for the whole torrent, shared by all peers.
+
+    every block has one byte of flags in `state`, addressed by
+    piece_index * blocks_per_piece + block_index, and every piece has a count
+    of requested (or received) and received blocks. block dicts are only built
+    on demand.
+
+    pieces are assembled in buffers from a bounded pool, a piece has to
+    reserve one before any of its blocks are requested. with `store_blocks`
+    off the blocks go straight to storage through `write_block(index, begin,
+    data)` and only the bookkeeping is done here.
+    """
+
+    def __init__(self, torrent, max_buffer_bytes=DEFAULT_BUFFER_BYTES, store_blocks=True,
+                 write_block=None):
         self.logger = logging.getLogger('main.pieces')
         self.torrent = torrent
-        self.received = {index: set() for index in range(torrent.number_of_pieces)}
-        self.requested = {index: set() for index in range(torrent.number_of_pieces)}
-        self.temp_piece_holder = {index: bytearray(self.torrent.piece_length(index)) for index in range(torrent.number_of_pieces)}
-        self.end_game_mode = False
+        number_of_pieces = torrent.number_of_pieces
+        self.blocks_per_piece = torrent.blocks_per_piece(0)
+        self.last_piece_blocks = torrent.blocks_per_piece(number_of_pieces - 1)
+        self.state = bytearray(number_of_pieces * self.blocks_per_piece)
+        self.requested = array('I', bytes(4 * number_of_pieces))
+        self.received = array('I', bytes(4 * number_of_pieces))
+        self.store_blocks = store_blocks
+        self.write_block = write_block
+        self.pool = BufferPool(torrent.piece_length(0), max_buffer_bytes)
+        self.temp_piece_holder = {} # piece index -> buffer from the pool
         self.total_pieces_requested = 0
+        self.total_blocks_received = 0
+
+    def _blocks(self, index):
+        if index == self.torrent.number_of_pieces - 1:
+            return self.last_piece_blocks
+        return self.blocks_per_piece
+
+    def _position(self, block):
+        return (block['index'] * self.blocks_per_piece
+                + block['begin_offset'] // self.torrent.REQUEST_LENGTH)
+
+    def valid_block(self, index, begin, length):
+        """ whether `begin` and `length` are those of one of the piece's blocks """
+
+        if not 0 <= index < self.torrent.number_of_pieces:
+            return False
+        block, offset = divmod(begin, self.torrent.REQUEST_LENGTH)
+        return (offset == 0 and 0 <= block < self._blocks(index) and
+                length == self.torrent.block_length(index, block))
 
     def add_received(self, block):
         begin = block['begin_offset']
         index = block['index']
-        self.received[index].add(begin)
-        self.temp_piece_holder[index][begin:len(block['payload'])+begin] = block['payload']
+        if not self.valid_block(index, begin, len(block['payload'])):
+            # anything else would be written over its neighbours
+            return (None, None)
+        position = self._position(block)
+        if self.state[position] & RECEIVED:
+            return (None, None)
+        if not self.in_progress(index) or not self.reserve(index):
+            # a piece we never started, taking it would let any peer fill the pool
+            return (None, None)
+
+        if not self.store_blocks and self.write_block is not None:
+            # only blocks we do not have yet, a repeated one must not overwrite
+            # a piece that is verified or being hashed in storage
+            self.write_block(index, begin, block['payload'])
+        if not self.state[position]:
+            # arrived without us asking for it
+            self.add_requested(block)
+        self.state[position] |= RECEIVED
+        self.received[index] += 1
+        self.total_blocks_received += 1
+        if self.store_blocks:
+            # assigning through a memoryview avoids a temporary copy of the payload
+            memoryview(self.temp_piece_holder[index])[begin:len(block['payload'])+begin] = block['payload']
 
         # self.logger.info(self.temp_piece_holder[index])
-        if len(self.received[index]) == self.torrent.blocks_per_piece(index):
-            whole_piece = self.temp_piece_holder[index]
-            self.temp_piece_holder[index] = bytearray()
+        if self.received[index] == self._blocks(index):
+            if not self.store_blocks:
+                return (index, None)
+            # the buffer stays reserved until release_piece is called
+            whole_piece = memoryview(self.temp_piece_holder[index])[:self.torrent.piece_length(index)]
             return (index, whole_piece)
         return (None, None)
 
-    def discard_piece(self, index):
-        self.received[index] = set()
-        self.requested[index] = set()
+    def in_progress(self, index):
+        """ blocks of the piece were asked for, or it has a buffer waiting """
 
-    def add_requested(self, block):
-        self.requested[block['index']].add(block['begin_offset'])
-        if len(self.requested[block['index']]) == self.torrent.blocks_per_piece(block['index']):
-            self.total_pieces_requested += 1
+        return self.requested[index] > 0 or index in self.temp_piece_holder
 
-    def needed(self, block):
-        # in case there are some pieces never received.
-        # copy received list to requested, so can request missing pieces
-        if self.total_pieces_requested == self.torrent.number_of_pieces:
-            self.requested = self.received.copy()
+    def can_reserve(self):
+        return not self.store_blocks or self.pool.has_free()
 
-        # self.logger.debug(self.requested[block['index']])
-        # self.logger.info('index {}: {}'.format(index, len(self.requested[index])))
-        return block['begin_offset'] not in self.requested[block['index']]
+    def reserve(self, index):
+        """ make sure the piece has a buffer to be assembled in """
 
-    def __len__(self):
-        length = 0
-        for key, value in self.received.items():
-            length += len(value)
+        if not self.store_blocks or index in self.temp_piece_holder:
+            return True
+        buffer = self.pool.acquire()
+        if buffer is None:
+            return False
+        self.temp_piece_holder[index] = buffer
+        return True
 
-        return length
+    def release_piece(self, index):
+        """ piece was written out or thrown away, recycle its buffer """
 
-class PieceQueue():
+        buffer = self.temp_piece_holder.pop(index, None)
+        if buffer is not None:
+            self.pool.release(buffer)
 
-    def __init__(self, torrent):
-        self.logger = logging.getLogger('main.piece_queue')
-        self.queue = []
-        self.torrent = torrent
+    def discard_piece(self, index):
+        start = index * self.blocks_per_piece
+        end = start + self._blocks(index)
+        self.total_blocks_received -= self.received[index]
+        if self.requested[index] == self._blocks(index):
+            self.total_pieces_requested -= 1
+        self.state[start:end] = bytes(end - start)
+        self.received[index] = 0
+        self.requested[index] = 0
+        self.release_piece(index)
+
+    def mark_have(self, index):
+        """ piece is already on disk and verified """
+
+        start = index * self.blocks_per_piece
+        blocks = self._blocks(index)
+        if self.requested[index] != blocks:
+            self.total_pieces_requested += 1
+        self.total_blocks_received += blocks - self.received[index]
+        self.state[start:start + blocks] = bytes([REQUESTED | RECEIVED]) * blocks
+        self.requested[index] = blocks
+        self.received[index] = blocks
+
+    def remove_requested(self, block):
+        # block was requested but never arrived, make it available again
+        index = block['index']
+        position = self._position(block)
+        if self.state[position] != REQUESTED:
+            return
+        if self.requested[index] == self._blocks(index):
+            self.total_pieces_requested -= 1
+        self.state[position] = MISSING
+        self.requested[index] -= 1
+
+    def add_requested(self, block):
+        index = block['index']
+        position = self._position(block)
+        if self.state[position]:
+            return
+        self.state[position] = REQUESTED
+        self.requested[index] += 1
+        if self.requested[index] == self._blocks(index):
+            self.total_pieces_requested += 1
+
+    def next_block(self, index):
+        """ first block of the piece that has not been requested yet """
 
-    def add(self, index):
-        piece_length = self.torrent.info['piece length']
-        for i in range(self.torrent.blocks_per_piece(index)):
-            block = {
-                'index': index,
-                'begin_offset': i * self.torrent.REQUEST_LENGTH,
-                'request_length': self.torrent.block_length(index, i)
-            }
-            self.queue.append(block)
+        start = index * self.blocks_per_piece
+        position = self.state.find(MISSING_BYTE, start, start + self._blocks(index))
+        if position == -1:
+            return None
+        i = position - start
+        return {
+            'index': index,
+            'begin_offset': i * self.torrent.REQUEST_LENGTH,
+            'request_length': self.torrent.block_length(index, i)
+        }
 
-    def pop(self):
-        return self.queue.pop(0)
+    def all_requested(self, index):
+        return self.requested[index] == self._blocks(index)
 
     def __len__(self):
-        return len(self.queue)
+        return self.total_blocks_received
@@ -0,0 +1,139 @@
+import os
+import time
+import asyncio
+import logging
+from hashlib import sha1
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from .disk import DiskScheduler
+from .metrics import Histogram, VERIFY_BUCKETS
+
+DEFAULT_HASH_WORKERS = os.cpu_count() or 2
+DEFAULT_MAX_PENDING = 8
+
+
+def _sha1(data):
+    return sha1(data).digest()
+
+
+class PieceVerifier():
+    """
+    hashes finished pieces and writes the good ones to disk, both off the
+    event loop. hashlib releases the GIL, so a thread pool already uses every
+    core, a process pool is available for when that is not enough.
+
+    at most `max_pending` pieces sit between receive and disk at once. once
+    that many are queued `acquire` blocks, which stops reading from the peer
+    handing in the next piece until the cpu or the disk caught up.
+
+    a session passes in the `hash_executor` and `disk` scheduler every
+    torrent shares, otherwise the verifier makes and owns its own.
+    """
+
+    def __init__(self, loop, torrent, file_manager, workers=DEFAULT_HASH_WORKERS,
+                 processes=False, max_pending=DEFAULT_MAX_PENDING,
+                 hash_executor=None, disk=None):
+        self.logger = logging.getLogger('main.piece_verifier')
+        self.loop = loop
+        self.torrent = torrent
+        self.file_manager = file_manager
+        self.processes = processes
+        self.workers = workers
+        self.shared = hash_executor is not None
+        if self.shared:
+            self.hash_executor = hash_executor
+            self.disk = disk
+        else:
+            if processes:
+                self.hash_executor = ProcessPoolExecutor(workers)
+            else:
+                self.hash_executor = ThreadPoolExecutor(workers)
+            self.disk = DiskScheduler(loop)
+        self.io_executor = self.disk.executor
+        self.slots = asyncio.Semaphore(max_pending)
+        self.pending = 0
+        self.waiting = 0
+        self.verified = 0
+        self.failed = 0
+        self.latency = None
+        self.max_latency = 0
+        self.latencies = Histogram(VERIFY_BUCKETS)
+
+    async def acquire(self):
+        """ wait for room in the queue before handing in a piece """
+
+        self.waiting += 1
+        try:
+            await self.slots.acquire()
+        finally:
+            self.waiting -= 1
+        self.pending += 1
+
+    async def verify(self, piece_index, piece):
+        """
+        hash the piece and write it out if it is good, `piece` is None when
+        the storage already holds the blocks. must be preceded by `acquire`.
+        """
+
+        start = time.monotonic()
+        try:
+            digest = await self._hash(piece_index, piece)
+            good = digest == self.torrent.piece_hash_list[piece_index]
+            if good and piece is not None:
+                await self.disk.write(self.file_manager, piece_index, piece)
+        finally:
+            self.pending -= 1
+            self.slots.release()
+
+        self._record(time.monotonic() - start, good)
+        return good
+
+    def hash_stored(self, piece_index):
+        """ sha1 of the piece as it is in storage, off the event loop """
+
+        if self.processes:
+            # a worker process could not reach the files
+            return self.disk.run(self.file_manager.hash_piece, piece_index)
+        return self.loop.run_in_executor(self.hash_executor, self.file_manager.hash_piece, piece_index)
+
+    def _hash(self, piece_index, piece):
+        if piece is None:
+            # the data is in storage, a worker process could not reach it
+            return self.disk.run(self.file_manager.hash_piece, piece_index)
+        if self.processes:
+            piece = bytes(piece)
+        return self.loop.run_in_executor(self.hash_executor, _sha1, piece)
+
+    def _record(self, latency, good):
+        if good:
+            self.verified += 1
+        else:
+            self.failed += 1
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += (latency - self.latency) / 8
+        self.max_latency = max(self.max_latency, latency)
+        self.latencies.observe(latency)
+
+    def stats(self):
+        return {
+            'hash_queue_depth': self.pending + self.waiting,
+            'verified': self.verified,
+            'hash_failures': self.failed,
+            'verify_latency': self.latency,
+            'verify_latency_max': self.max_latency,
+        }
+
+    async def flush(self):
+        """ wait for our pieces queued for the disk, without blocking the loop """
+
+        await self.disk.flush(self.file_manager)
+
+    def close(self):
+        if self.shared:
+            # the executors live on, only wait for what is queued for the disk
+            self.disk.drain()
+            return
+        self.hash_executor.shutdown(wait=False)
+        self.disk.close()
@@ -18,18 +18,18 @@ ch.setFormatter(formatter)
 logger.addHandler(fh)
 logger.addHandler(ch)
 
-def main(torrent_file, destination):
+def main(torrent_file, destination, metrics_port=None):
     loop = asyncio.get_event_loop()
-    client = TorrentClient(torrent_file, destination, loop)
+    client = TorrentClient(torrent_file, destination, loop, metrics_port=metrics_port)
 
     asyncio.ensure_future(client.connect_to_peers())
-    asyncio.ensure_future(client.keep_alive())
 
     try:
         loop.run_forever()
     except KeyboardInterrupt:
         pass
     finally:
+        loop.run_until_complete(client.stop())
         loop.close()
 
 
@@ -37,6 +37,8 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='CLI BitTorrent Client')
     parser.add_argument('source', help='locaiton of the torrent file')
     parser.add_argument('destination', help='specify location of downloaded files')
+    parser.add_argument('--metrics-port', type=int,
+                        help='serve metrics on http://127.0.0.1:PORT/metrics')
     args = parser.parse_args()
 
-    main(args.source, args.destination)
+    main(args.source, args.destination, args.metrics_port)
@@ -0,0 +1,30 @@
+from array import array
+
+from bittorrent.bitfield import Bitfield
+
+
+def bitfield(length, indexes):
+    bitfield = Bitfield(length)
+    for index in indexes:
+        bitfield.add(index)
+    return bitfield
+
+
+def test_first_in():
+    ours = bitfield(21, [0, 3, 9, 17, 20])
+    theirs = bitfield(21, [3, 9, 20])
+    assert ours.first_in(theirs) == 3
+    assert ours.first_in(theirs, 4) == 9
+    assert ours.first_in(theirs, 10) == 20
+    assert ours.first_in(theirs, 20) == 20
+    assert bitfield(21, [0, 17]).first_in(theirs) is None
+
+
+def test_counts_for_every_piece():
+    counts = array('I', [0, 5, 2**32 - 2, 7, 1, 0, 0, 3, 9, 4])
+    have = bitfield(10, [1, 2, 4, 9])
+    have.add_to(counts)
+    assert list(counts) == [0, 6, 2**32 - 1, 7, 2, 0, 0, 3, 9, 5]
+    have.subtract_from(counts)
+    have.subtract_from(counts)
+    assert list(counts) == [0, 4, 2**32 - 3, 7, 0, 0, 0, 3, 9, 3]
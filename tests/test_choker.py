@@ -0,0 +1,166 @@
+from bittorrent.choker import Choker, RateCounter, RATE_WINDOW, OPTIMISTIC_INTERVAL, SNUB_TIME
+from bittorrent.peer import Peer
+from benchmarks.swarm import SyntheticTorrent
+
+BLOCK = 2**14
+
+
+class Clock():
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TakeTurns():
+    """ stands in for random.Random, `choice` goes through the candidates in turn """
+
+    def __init__(self):
+        self.calls = 0
+
+    def choice(self, seq):
+        self.calls += 1
+        return seq[(self.calls - 1) % len(seq)]
+
+
+def new_peers(clock, rates, seeding=False):
+    """ interested peers sending us (or taking from us) `rates` bytes per second """
+
+    torrent = SyntheticTorrent(total_length=2**20, piece_length=2**16, files=1)
+    peers = []
+    for i, rate in enumerate(rates):
+        peer = Peer('127.0.0.{}'.format(i + 1), 6881, torrent, clock=clock)
+        peer.interested = True
+        counter = peer.upload_rate if seeding else peer.download_rate
+        counter.add(rate * RATE_WINDOW)
+        peers.append(peer)
+    return peers
+
+
+def test_rate_counter_forgets_what_left_the_window():
+    clock = Clock()
+    counter = RateCounter(window=4, clock=clock)
+    counter.add(400)
+    assert counter.rate() == 100
+    clock.now = 2
+    counter.add(400)
+    assert counter.rate() == 200
+    clock.now = 4
+    assert counter.rate() == 100
+    clock.now = 100
+    assert counter.rate() == 0
+    assert counter.total == 800
+
+
+def test_fastest_peers_get_the_regular_slots():
+    clock = Clock()
+    peers = new_peers(clock, [10, 50, 30, 40, 20, 0])
+    choker = Choker(upload_slots=4, clock=clock, rng=TakeTurns())
+    unchoke = choker.unchoke_set(peers, seeding=False)
+    regular = {peers[1], peers[3], peers[2]}
+    assert regular < unchoke and len(unchoke) == 4
+    assert choker.optimistic in unchoke - regular
+
+    # the ones not interested in us are left out, however fast
+    peers[1].interested = False
+    unchoke = choker.unchoke_set(peers, seeding=False)
+    assert {peers[3], peers[2], peers[4]} < unchoke
+    assert peers[1] not in unchoke
+
+
+def test_seeding_ranks_by_upload_rate():
+    clock = Clock()
+    peers = new_peers(clock, [10, 50, 30, 40], seeding=True)
+    # fast to download from, but we are not downloading any more
+    peers[0].download_rate.add(1000 * RATE_WINDOW)
+    choker = Choker(upload_slots=3, clock=clock, rng=TakeTurns())
+    unchoke = choker.unchoke_set(peers, seeding=True)
+    assert {peers[1], peers[3]} < unchoke
+    assert choker.optimistic in (peers[0], peers[2])
+
+
+def test_optimistic_unchoke_rotates_every_interval():
+    clock = Clock()
+    peers = new_peers(clock, [100, 90, 1, 2, 3])
+    rng = TakeTurns()
+    choker = Choker(upload_slots=3, clock=clock, rng=rng)
+    regular = {peers[0], peers[1]}
+
+    seen = []
+    for second in range(0, 4 * OPTIMISTIC_INTERVAL, 10):
+        clock.now = second
+        unchoke = choker.unchoke_set(peers, seeding=False)
+        assert regular < unchoke and len(unchoke) == 3
+        seen.append(choker.optimistic)
+    # kept for a whole interval, then handed on to the next peer outside the regular slots
+    per_interval = OPTIMISTIC_INTERVAL // 10
+    assert seen == [peers[2]] * per_interval + [peers[3]] * per_interval + \
+                   [peers[4]] * per_interval + [peers[2]] * per_interval
+    assert rng.calls == 4
+
+
+def test_optimistic_peer_that_loses_interest_is_replaced_at_once():
+    clock = Clock()
+    peers = new_peers(clock, [100, 1, 2])
+    choker = Choker(upload_slots=2, clock=clock, rng=TakeTurns())
+    choker.unchoke_set(peers, seeding=False)
+    assert choker.optimistic is peers[1]
+    clock.now = 10
+    peers[1].interested = False
+    assert choker.unchoke_set(peers, seeding=False) == {peers[0], peers[2]}
+
+
+def test_optimistic_peer_that_earns_a_regular_slot_is_replaced():
+    clock = Clock()
+    peers = new_peers(clock, [100, 50, 1, 2])
+    choker = Choker(upload_slots=3, clock=clock, rng=TakeTurns())
+    choker.unchoke_set(peers, seeding=False)
+    assert choker.optimistic is peers[2]
+    clock.now = 10
+    peers[2].download_rate.add(1000 * RATE_WINDOW)
+    unchoke = choker.unchoke_set(peers, seeding=False)
+    # the slot goes to one of the peers left over, here the second of peers[1] and peers[3]
+    assert unchoke == {peers[2], peers[0], peers[3]}
+    assert choker.optimistic is peers[3]
+
+
+def test_snubbed_peer_only_gets_the_optimistic_slot():
+    clock = Clock()
+    peers = new_peers(clock, [100, 50, 10, 5])
+    snubber = peers[0]
+    snubber.choked = False
+    snubber.window.add({'index': 0, 'begin_offset': 0, 'length': BLOCK})
+    choker = Choker(upload_slots=3, clock=clock, rng=TakeTurns())
+
+    # not snubbed while the last block is recent
+    clock.now = SNUB_TIME
+    assert not choker.snubbed(snubber, clock.now)
+    assert {peers[0], peers[1]} < choker.unchoke_set(peers, seeding=False)
+
+    clock.now = SNUB_TIME + 1
+    assert choker.snubbed(snubber, clock.now)
+    choker.optimistic = None
+    unchoke = choker.unchoke_set(peers, seeding=False)
+    # its old rate is still the best there is, yet the regular slots go to the others
+    assert {peers[1], peers[2]} < unchoke
+    assert choker.optimistic in (peers[0], peers[3])
+
+    # without requests of ours waiting on it, a quiet peer is not snubbed
+    snubber.window.cancel(0, 0)
+    assert not choker.snubbed(snubber, clock.now)
+    # nor when it chokes us
+    snubber.window.add({'index': 0, 'begin_offset': 0, 'length': BLOCK})
+    snubber.choked = True
+    assert not choker.snubbed(snubber, clock.now)
+
+
+def test_free_slots():
+    clock = Clock()
+    peers = new_peers(clock, [1, 2, 3])
+    choker = Choker(upload_slots=2, clock=clock)
+    assert choker.has_free_slot(peers)
+    peers[0].am_choking = False
+    assert choker.has_free_slot(peers)
+    peers[1].am_choking = False
+    assert not choker.has_free_slot(peers)
@@ -0,0 +1,207 @@
+import os
+import struct
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+from bittorrent.client import TorrentClient
+from bittorrent.connections import Candidate, MAX_HASH_FAILURES
+from bittorrent.timers import TimerWheel
+from benchmarks.swarm import make_torrent
+
+PIECE_LENGTH = 2**16
+BLOCK = 2**14
+
+
+class Connection():
+    """ stands in for the PeerProtocol of a peer, remembers being closed """
+
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def new_client(tmp_path, loop, content):
+    path = make_torrent(str(tmp_path), 'http://127.0.0.1:1/announce', content, PIECE_LENGTH)
+    destination = tmp_path / 'download'
+    destination.mkdir()
+    return TorrentClient(path, str(destination), loop, port=None)
+
+
+def test_close_a_peer_that_never_connected(tmp_path):
+    loop = asyncio.new_event_loop()
+    client = new_client(tmp_path, loop, os.urandom(4 * PIECE_LENGTH))
+    peer = client._new_peer('10.0.0.1', 6881)
+    client._close_connection(peer)
+    client.close()
+    loop.close()
+
+
+def test_late_ban_of_a_connecting_peer_does_not_strand_the_piece(tmp_path):
+    loop = asyncio.new_event_loop()
+    content = os.urandom(4 * PIECE_LENGTH)
+    client = new_client(tmp_path, loop, content)
+
+    # sent a bad block of piece 0 earlier, and is reconnecting now
+    peer = client._new_peer('10.0.0.1', 6881)
+    candidate = Candidate('10.0.0.1', 6881)
+    candidate.peer = peer
+    candidate.hash_failures = MAX_HASH_FAILURES - 1
+    peer.candidate = candidate
+    attempt = loop.create_future()
+    client.connections.tasks[candidate] = attempt
+    client.suspects[0] = [(0, peer, b'not the digest of the good block')]
+
+    async def scenario():
+        assert client.pieces.reserve(0)
+        piece = memoryview(client.pieces.temp_piece_holder[0])[:PIECE_LENGTH]
+        piece[:] = content[:PIECE_LENGTH]
+        await client.verifier.acquire()
+        await client._finish_piece(0, piece)
+
+    loop.run_until_complete(scenario())
+    assert client.pieces_downloaded == [0]
+    assert client.pieces.pool.in_use == 0
+    assert candidate.banned
+    assert attempt.cancelled()
+    client.close()
+    loop.close()
+
+
+@pytest.mark.parametrize('index', [4, 2**31, 2**32 - 1])
+def test_block_of_a_piece_that_does_not_exist(tmp_path, index):
+    loop = asyncio.new_event_loop()
+    client = new_client(tmp_path, loop, os.urandom(4 * PIECE_LENGTH))
+    peer = client._new_peer('10.0.0.1', 6881)
+    peer.writer = Connection()
+
+    message = struct.pack('!II', index, 0) + bytes(BLOCK)
+    loop.run_until_complete(client._handle_piece_msg(message, peer))
+    assert peer.writer.closed
+    assert client.contributors == {}
+    assert client.pieces.pool.in_use == 0
+    assert client.pieces.state == bytearray(len(client.pieces.state))
+    client.close()
+    loop.close()
+
+
+def test_block_that_is_not_one_of_ours_gets_the_peer_banned(tmp_path):
+    loop = asyncio.new_event_loop()
+    client = new_client(tmp_path, loop, os.urandom(4 * PIECE_LENGTH))
+    peer = client._new_peer('10.0.0.1', 6881)
+    peer.candidate = Candidate('10.0.0.1', 6881)
+    peer.writer = Connection()
+    assert client.pieces.reserve(0)
+
+    message = struct.pack('!II', 0, PIECE_LENGTH - BLOCK) + bytes(2 * BLOCK)
+    loop.run_until_complete(client._handle_piece_msg(message, peer))
+    assert peer.writer.closed
+    assert peer.candidate.banned
+    assert client.contributors == {}
+    assert client.pieces.received[0] == 0
+    client.close()
+    loop.close()
+
+
+@pytest.mark.parametrize('message', [
+    struct.pack('!II', 0, PIECE_LENGTH - BLOCK) + bytes(BLOCK + 1),
+    struct.pack('!II', 0, 1) + bytes(BLOCK),
+    b'\x00\x00\x00',
+])
+def test_bad_block_closes_the_peer_in_pwrite_mode(tmp_path, message):
+    loop = asyncio.new_event_loop()
+    client = new_client(tmp_path, loop, os.urandom(4 * PIECE_LENGTH))
+    assert client.pieces.store_blocks
+    peer = client._new_peer('10.0.0.1', 6881)
+    peer.writer = Connection()
+    assert client.pieces.reserve(0)
+
+    loop.run_until_complete(client._handle_piece_msg(message, peer))
+    assert peer.writer.closed
+    assert client.pieces.received[0] == 0
+    client.close()
+    loop.close()
+
+
+class BrokenPool():
+    """ an executor whose worker processes died """
+
+    def submit(self, *args, **kwargs):
+        raise BrokenProcessPool('a child process terminated abruptly')
+
+    def shutdown(self, wait=True):
+        pass
+
+
+def shut_down_pool():
+    executor = ThreadPoolExecutor(1)
+    executor.shutdown()
+    return executor
+
+
+@pytest.mark.parametrize('executor', [shut_down_pool, BrokenPool])
+def test_piece_the_verifier_cannot_take_goes_back_to_the_picker(tmp_path, executor):
+    loop = asyncio.new_event_loop()
+    content = os.urandom(4 * PIECE_LENGTH)
+    client = new_client(tmp_path, loop, content)
+    client.verifier.hash_executor.shutdown()
+    client.verifier.hash_executor = executor()
+    peer = client._new_peer('10.0.0.1', 6881)
+    peer.candidate = Candidate('10.0.0.1', 6881)
+    client.contributors[0] = {0: peer}
+
+    async def scenario():
+        assert client.pieces.reserve(0)
+        client.picker._remove_fresh(0)
+        piece = memoryview(client.pieces.temp_piece_holder[0])[:PIECE_LENGTH]
+        piece[:] = content[:PIECE_LENGTH]
+        await client.verifier.acquire()
+        await client._finish_piece(0, piece)
+
+    loop.run_until_complete(scenario())
+    assert client.pieces_downloaded == []
+    # the buffer and the verifier's slot are free again and the piece can be picked anew
+    assert client.pieces.pool.in_use == 0
+    assert client.verifier.pending == 0
+    assert 0 in client.picker.fresh
+    assert client.contributors == {}
+    # nobody sent anything wrong
+    assert peer.candidate.hash_failures == 0
+    client.close()
+    loop.close()
+
+
+def test_resume_data_is_saved_while_the_download_runs(tmp_path):
+    loop = asyncio.new_event_loop()
+    client = new_client(tmp_path, loop, os.urandom(4 * PIECE_LENGTH))
+    client.timers = TimerWheel(loop, tick=0.01)
+    client.resume.save_interval = 0.05
+    saves = []
+    save = client.resume.save
+
+    def counting_save(verified):
+        saves.append(bytes(verified))
+        save(verified)
+
+    client.resume.save = counting_save
+
+    async def scenario():
+        running = asyncio.ensure_future(client.connect_to_peers())
+        await asyncio.sleep(0.12)
+        # a piece comes in, nothing finishes after it
+        client.picker.piece_done(2)
+        await asyncio.sleep(0.12)
+        client.connections.stop()
+        await running
+        await client.announcer.stop()
+
+    loop.run_until_complete(scenario())
+    # one save with nothing in it, one once the piece was in, none in between
+    assert saves == [bytes(4), bytes([0, 0, 1, 0])]
+    assert client.resume.load() == [2]
+    client.close()
+    loop.close()
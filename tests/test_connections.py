@@ -0,0 +1,168 @@
+import asyncio
+
+from bittorrent.timers import TimerWheel
+from bittorrent.connections import (ConnectionManager, MAX_HASH_FAILURES, MIN_CONNECTED_TIME,
+                                    EVICT_BACKOFF)
+
+
+class StubPeer():
+    pass
+
+
+def manager(loop, connect, closed):
+    return ConnectionManager(loop, TimerWheel(loop), connect, lambda host, port: StubPeer(),
+                             closed.append, lambda peer: 1)
+
+
+def test_ban_while_connecting_cancels_the_attempt():
+    loop = asyncio.new_event_loop()
+    closed = []
+
+    async def connect(peer):
+        await asyncio.sleep(3600)
+
+    async def scenario():
+        connections = manager(loop, connect, closed)
+        running = asyncio.ensure_future(connections.run())
+        await asyncio.sleep(0)
+        connections.add([{'hostname': '10.0.0.1', 'port': 6881}])
+        await asyncio.sleep(0)
+        candidate = connections.candidates[('10.0.0.1', 6881)]
+        attempt = connections.tasks[candidate]
+        assert candidate not in connections.active
+
+        for _ in range(MAX_HASH_FAILURES):
+            connections.hash_failed(candidate.peer)
+        await asyncio.sleep(0)
+        assert candidate.banned
+        assert attempt.cancelled()
+        assert closed == []
+        connections.stop()
+        await running
+
+    loop.run_until_complete(scenario())
+    loop.close()
+
+
+def test_ban_closes_the_current_connection():
+    loop = asyncio.new_event_loop()
+    closed = []
+
+    async def connect(peer):
+        connections.connected(peer)
+        await asyncio.sleep(3600)
+
+    async def scenario():
+        running = asyncio.ensure_future(connections.run())
+        await asyncio.sleep(0)
+        connections.add([{'hostname': '10.0.0.1', 'port': 6881}])
+        await asyncio.sleep(0)
+        candidate = connections.candidates[('10.0.0.1', 6881)]
+        assert candidate in connections.active
+
+        # blame for blocks sent over an earlier connection
+        earlier = StubPeer()
+        earlier.candidate = candidate
+        for _ in range(MAX_HASH_FAILURES):
+            connections.hash_failed(earlier)
+        assert closed == [candidate.peer]
+        connections.stop()
+        await running
+
+    connections = manager(loop, connect, closed)
+    loop.run_until_complete(scenario())
+    loop.close()
+
+
+def evicting_manager(loop, connect):
+    """ room for one peer, every peer useless, closing ends the connection """
+
+    def close(peer):
+        connections.tasks[peer.candidate].cancel()
+
+    connections = ConnectionManager(loop, TimerWheel(loop), connect, lambda host, port: StubPeer(),
+                                    close, lambda peer: 0, max_active=1)
+    return connections
+
+
+def test_evicted_peer_waits_longer_every_time():
+    loop = asyncio.new_event_loop()
+
+    async def connect(peer):
+        connections.connected(peer)
+        await asyncio.sleep(3600)
+
+    async def evict(candidate):
+        """ evict `candidate`, returns how long it has to wait """
+
+        assert candidate in connections.active
+        candidate.connected_at -= MIN_CONNECTED_TIME
+        connections._evict()
+        # the connection ends, and the one waiting gets going
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        assert candidate not in connections.tasks
+        # the latest entry, an earlier one is skipped once it comes up
+        _, when = max((sequence, w) for w, sequence, c in connections.waiting if c is candidate)
+        return when - loop.time()
+
+    async def scenario():
+        running = asyncio.ensure_future(connections.run())
+        await asyncio.sleep(0)
+        connections.add([{'hostname': '10.0.0.1', 'port': 6881}])
+        await asyncio.sleep(0)
+        candidate = connections.candidates[('10.0.0.1', 6881)]
+        delays = []
+        for i in range(3):
+            # someone waiting for the slot is what makes the manager evict
+            connections.add([{'hostname': '10.0.1.{}'.format(i), 'port': 6881}])
+            delays.append(await evict(candidate))
+            assert candidate.failures == 0
+            # the slot is free again once the newcomer is gone too
+            other = connections.candidates[('10.0.1.{}'.format(i), 6881)]
+            assert other in connections.active
+            connections.tasks[other].cancel()
+            await asyncio.sleep(0)
+            connections._start(candidate, connect)
+            await asyncio.sleep(0)
+
+        connections.stop()
+        await running
+        return delays
+
+    connections = evicting_manager(loop, connect)
+    delays = loop.run_until_complete(scenario())
+    assert [round(d) for d in delays] == [EVICT_BACKOFF, 2 * EVICT_BACKOFF, 4 * EVICT_BACKOFF]
+    loop.close()
+
+
+def test_evicted_inbound_peer_is_kept_out_for_a_while():
+    loop = asyncio.new_event_loop()
+
+    async def serve(peer):
+        connections.connected(peer)
+        await asyncio.sleep(3600)
+
+    async def scenario():
+        running = asyncio.ensure_future(connections.run())
+        await asyncio.sleep(0)
+        assert connections.accept('10.0.0.1', 50000, serve)
+        await asyncio.sleep(0)
+        candidate = connections.candidates[('10.0.0.1', 50000)]
+        connections.add([{'hostname': '10.0.0.2', 'port': 6881}])
+        candidate.connected_at -= MIN_CONNECTED_TIME
+        connections._evict()
+        await asyncio.sleep(0)
+        assert candidate not in connections.tasks
+        # the outbound one that was waiting took the slot, make room again
+        connections.max_active = 2
+        refused = connections.accept('10.0.0.1', 50000, serve)
+        candidate.not_before = loop.time()
+        accepted = connections.accept('10.0.0.1', 50000, serve)
+        connections.stop()
+        await running
+        return refused, accepted
+
+    connections = evicting_manager(loop, serve)
+    assert loop.run_until_complete(scenario()) == (False, True)
+    loop.close()
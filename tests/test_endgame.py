@@ -0,0 +1,160 @@
+import os
+import struct
+import asyncio
+
+from bittorrent.endgame import EndGame
+from bittorrent.peer import Peer
+from benchmarks.swarm import SyntheticTorrent
+from tests.test_client import new_client, PIECE_LENGTH, BLOCK
+
+
+class Outbound():
+    """ stands in for the OutboundQueue of a peer, keeps what was sent """
+
+    def __init__(self):
+        self.requests = []
+        self.cancels = []
+
+    def request(self, index, begin_offset, length):
+        self.requests.append((index, begin_offset))
+
+    def cancel(self, index, begin_offset, length):
+        self.cancels.append((index, begin_offset))
+
+    async def drain(self):
+        pass
+
+
+def block(index, begin_offset):
+    return {'index': index, 'begin_offset': begin_offset, 'request_length': BLOCK}
+
+
+def new_peers(n, pieces=4):
+    torrent = SyntheticTorrent(total_length=pieces * PIECE_LENGTH, piece_length=PIECE_LENGTH, files=1)
+    peers = []
+    for i in range(n):
+        peer = Peer('10.0.0.{}'.format(i + 1), 6881, torrent)
+        peer.have.set_all()
+        peers.append(peer)
+    return peers
+
+
+def test_start_takes_over_what_is_in_flight():
+    a, b = new_peers(2)
+    a.window.add(block(0, 0))
+    a.window.add(block(0, BLOCK))
+    b.window.add(block(0, BLOCK))
+    endgame = EndGame()
+    endgame.start([a, b])
+    assert endgame.active
+    assert endgame.requesters == {(0, 0): [a], (0, BLOCK): [a, b]}
+    assert endgame.duplicates == 1
+
+
+def test_duplicates_go_to_the_least_requested_blocks_first():
+    a, b, c = new_peers(3)
+    endgame = EndGame(max_copies=3)
+    endgame.add(a, block(0, 0))
+    endgame.add(b, block(0, 0))
+    endgame.add(a, block(1, 0))
+
+    assert endgame.pick(c) == block(1, 0)
+    assert endgame.pick(c) == block(0, 0)
+    # c has asked for everything in flight already
+    assert endgame.pick(c) is None
+    assert endgame.pick(b) == block(1, 0)
+    assert endgame.duplicates == 4
+
+
+def test_duplicates_are_bounded():
+    a, b, c = new_peers(3)
+    endgame = EndGame(max_copies=2, max_duplicates=2)
+    for index in range(3):
+        endgame.add(a, block(index, 0))
+    assert endgame.pick(b) == block(0, 0)
+    # never more than `max_copies` peers for a block
+    assert endgame.pick(c) == block(1, 0)
+    assert endgame.pick(c) is None
+    assert endgame.pick(b) is None
+
+    # nor more than `max_duplicates` extra requests overall
+    endgame.max_copies = 3
+    assert endgame.pick(c) is None
+
+
+def test_only_blocks_of_pieces_the_peer_has():
+    a, b = new_peers(2)
+    b.have.discard(0)
+    endgame = EndGame()
+    endgame.add(a, block(0, 0))
+    assert endgame.pick(b) is None
+    endgame.add(a, block(1, 0))
+    assert endgame.pick(b) == block(1, 0)
+
+
+def test_arrival_cancels_the_other_requests():
+    a, b, c = new_peers(3)
+    endgame = EndGame(max_copies=3)
+    endgame.add(a, block(0, 0))
+    endgame.pick(b)
+    endgame.pick(c)
+    assert endgame.duplicates == 2
+
+    assert endgame.received(b, 0, 0) == [a, c]
+    assert endgame.requesters == {}
+    assert endgame.duplicates == 0
+    assert endgame.cancels == 2
+    # a late copy from someone else is nothing to cancel
+    assert endgame.received(a, 0, 0) == []
+
+
+def test_released_block_stays_with_the_other_requesters():
+    a, b = new_peers(2)
+    endgame = EndGame()
+    endgame.add(a, block(0, 0))
+    endgame.pick(b)
+    # b choked us, a may still deliver
+    assert endgame.released(b, block(0, 0))
+    assert endgame.duplicates == 0
+    assert endgame.requesters == {(0, 0): [a]}
+    # and then a goes too, the block has to be requested anew
+    assert not endgame.released(a, block(0, 0))
+    assert endgame.requesters == {}
+    assert not endgame.released(a, block(0, 0))
+
+
+def test_client_requests_duplicates_and_cancels_on_arrival(tmp_path):
+    loop = asyncio.new_event_loop()
+    client = new_client(tmp_path, loop, os.urandom(PIECE_LENGTH))
+    peers = []
+    for i in range(2):
+        peer = client._new_peer('10.0.0.{}'.format(i + 1), 6881)
+        peer.have.set_all()
+        client.picker.peer_has_pieces(peer.have)
+        peer.outbound = Outbound()
+        peer.choked = False
+        client.active_peers.append(peer)
+        peers.append(peer)
+    a, b = peers
+    everything = [(0, begin) for begin in range(0, PIECE_LENGTH, BLOCK)]
+
+    # a gets every block of the only piece, which leaves b with duplicates
+    assert client._fill_window(a) == len(everything)
+    assert a.outbound.requests == everything
+    assert not client.endgame.active
+    assert client._fill_window(b) == len(everything)
+    assert client.endgame.active
+    assert b.outbound.requests == everything
+
+    message = struct.pack('!II', 0, BLOCK) + os.urandom(BLOCK)
+    loop.run_until_complete(client._handle_piece_msg(message, b))
+    assert a.outbound.cancels == [(0, BLOCK)]
+    assert (0, BLOCK) not in a.window
+    assert (0, BLOCK) not in client.endgame.requesters
+    assert b.outbound.cancels == []
+    # and a's copy coming in after all is dropped, not cancelled again
+    loop.run_until_complete(client._handle_piece_msg(message, a))
+    assert a.outbound.cancels == [(0, BLOCK)]
+    assert b.outbound.cancels == []
+    client.close()
+    loop.close()
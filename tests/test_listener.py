@@ -0,0 +1,215 @@
+import os
+import asyncio
+
+import pytest
+
+import bittorrent.listener
+from bittorrent.listener import Listener
+from bittorrent.messages import handshake
+from bittorrent.session import Session
+from benchmarks.swarm import make_torrent
+
+PEER_ID = b'-XX0001-000000000000'
+PIECE_LENGTH = 2**16
+
+
+class Client():
+    """ stands in for the TorrentClient of a torrent, keeps what it was handed """
+
+    def __init__(self, takes=True):
+        self.takes = takes
+        self.accepted = []
+
+    def accept(self, protocol, handshake):
+        self.accepted.append(bytes(handshake))
+        return self.takes
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine(loop))
+    finally:
+        loop.close()
+
+
+async def start_listener(loop, clients, **kwargs):
+    listener = Listener(loop, clients.get, host='127.0.0.1', **kwargs)
+    port = await listener.start()
+    return listener, port
+
+
+async def send(port, data, pieces=1):
+    """ connect and send `data` in `pieces` writes, returns the connection """
+
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    step = -(-len(data) // pieces)
+    for start in range(0, len(data), step):
+        writer.write(data[start:start + step])
+        await writer.drain()
+        await asyncio.sleep(0.01)
+    return reader, writer
+
+
+async def dropped(reader):
+    """ whether the listener closed the connection on us """
+
+    try:
+        return await asyncio.wait_for(reader.read(1), 2) == b''
+    except ConnectionError:
+        return True
+
+
+async def settle(listener):
+    while listener.handshaking:
+        await asyncio.sleep(0.01)
+
+
+def test_handshake_goes_to_the_torrent_it_names():
+    first, second = bytes([1]) * 20, bytes([2]) * 20
+    clients = {first: Client(), second: Client()}
+
+    async def scenario(loop):
+        listener, port = await start_listener(loop, clients)
+        connections = [await send(port, handshake(second, PEER_ID)),
+                       # the handshake may come in bits
+                       await send(port, handshake(first, PEER_ID), pieces=5),
+                       await send(port, handshake(second, PEER_ID))]
+        await settle(listener)
+        listener.close()
+        for _, writer in connections:
+            writer.close()
+        return listener
+
+    listener = run(scenario)
+    assert clients[first].accepted == [handshake(first, PEER_ID)]
+    assert clients[second].accepted == [handshake(second, PEER_ID)] * 2
+    assert (listener.accepted, listener.refused) == (3, 0)
+
+
+@pytest.mark.parametrize('data', [
+    handshake(bytes([9]) * 20, PEER_ID),                      # a torrent we do not have
+    b'\x13BitTorrent protocoX' + bytes(48),                   # not bittorrent
+    bytes([19]) + b'BitTorrent protocol' + bytes(8) + bytes([1]),  # cut short
+])
+def test_unroutable_handshake_is_dropped(data):
+    clients = {bytes([1]) * 20: Client()}
+
+    async def scenario(loop):
+        listener, port = await start_listener(loop, clients)
+        reader, writer = await send(port, data)
+        writer.write_eof()
+        closed = await dropped(reader)
+        writer.close()
+        listener.close()
+        return listener, closed
+
+    listener, closed = run(scenario)
+    assert closed
+    assert clients[bytes([1]) * 20].accepted == []
+    assert (listener.accepted, listener.refused) == (0, 1)
+
+
+def test_connection_the_client_turns_down_is_dropped():
+    info_hash = bytes([1]) * 20
+    clients = {info_hash: Client(takes=False)}
+
+    async def scenario(loop):
+        listener, port = await start_listener(loop, clients)
+        reader, writer = await send(port, handshake(info_hash, PEER_ID))
+        closed = await dropped(reader)
+        writer.close()
+        listener.close()
+        return listener, closed
+
+    listener, closed = run(scenario)
+    assert closed
+    assert clients[info_hash].accepted == [handshake(info_hash, PEER_ID)]
+    assert (listener.accepted, listener.refused) == (0, 1)
+
+
+def test_silent_connection_times_out(monkeypatch):
+    monkeypatch.setattr(bittorrent.listener, 'HANDSHAKE_TIMEOUT', 0.1)
+
+    async def scenario(loop):
+        listener, port = await start_listener(loop, {})
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        closed = await dropped(reader)
+        writer.close()
+        listener.close()
+        return listener, closed
+
+    listener, closed = run(scenario)
+    assert closed
+    assert listener.refused == 1
+
+
+def test_too_many_handshaking_connections_are_refused():
+    info_hash = bytes([1]) * 20
+    clients = {info_hash: Client()}
+
+    async def scenario(loop):
+        listener, port = await start_listener(loop, clients, max_handshaking=2)
+        # two that keep quiet take up every handshake slot
+        quiet = [await asyncio.open_connection('127.0.0.1', port) for _ in range(2)]
+        while len(listener.handshaking) < 2:
+            await asyncio.sleep(0.01)
+        reader, writer = await send(port, handshake(info_hash, PEER_ID))
+        closed = await dropped(reader)
+        for _, w in quiet + [(reader, writer)]:
+            w.close()
+        listener.close()
+        await settle(listener)
+        return listener, closed
+
+    listener, closed = run(scenario)
+    assert closed
+    assert clients[info_hash].accepted == []
+    assert listener.refused >= 1
+
+
+def test_taken_port_moves_on_to_the_next():
+    async def scenario(loop):
+        first = Listener(loop, {}.get, host='127.0.0.1')
+        port = await first.start()
+        second = Listener(loop, {}.get, host='127.0.0.1', port=port)
+        try:
+            return port, await second.start()
+        finally:
+            first.close()
+            second.close()
+
+    port, next_port = run(scenario)
+    assert next_port != port
+    assert port < next_port < port + bittorrent.listener.PORT_RANGE
+
+
+def test_session_routes_inbound_peers_to_their_torrent(tmp_path):
+    clients = []
+
+    async def scenario(loop):
+        session = Session(loop, port=0)
+        for name in ('first', 'second'):
+            directory = tmp_path / name
+            directory.mkdir()
+            path = make_torrent(str(directory), 'http://127.0.0.1:1/announce',
+                                os.urandom(4 * PIECE_LENGTH), PIECE_LENGTH)
+            destination = directory / 'download'
+            destination.mkdir()
+            client = session.add_torrent(path, str(destination))
+            # as if running, without the trackers and the recheck
+            client.checking = False
+            client.connections.running = True
+            clients.append(client)
+        port = await session.listener.start()
+        reader, writer = await send(port, handshake(clients[1].torrent.info_hash, PEER_ID))
+        # the torrent answers with its own handshake
+        answer = await asyncio.wait_for(reader.readexactly(68), 2)
+        served = [PEER_ID in client.peer_ids for client in clients]
+        writer.close()
+        await session.stop()
+        return answer, served
+
+    answer, served = run(scenario)
+    assert answer[28:48] == clients[1].torrent.info_hash
+    assert served == [False, True]
@@ -0,0 +1,145 @@
+import os
+from hashlib import sha1
+
+import pytest
+from bcoding import bdecode, bencode
+
+from bittorrent import metainfo
+from benchmarks.swarm import make_torrent
+from benchmarks.bench_metainfo import write_big_torrent
+
+PIECE_LENGTH = 2**16
+
+
+def fixtures(directory):
+    """ the bytes of .torrent files as the benchmarks write them """
+
+    content = os.urandom(9 * PIECE_LENGTH + 123)
+    torrents = []
+    for name, options in [('multi', {}),
+                          ('single', {'single': True}),
+                          ('tiers', {'announce_list': [['http://a/announce', 'udp://b:80'],
+                                                       ['http://c/announce']]})]:
+        os.mkdir(os.path.join(directory, name))
+        path = make_torrent(os.path.join(directory, name), 'http://127.0.0.1:1/announce',
+                            content, PIECE_LENGTH, **options)
+        torrents.append(path)
+    torrents.append(write_big_torrent(directory, 3000, 2500, PIECE_LENGTH))
+    datas = []
+    for path in torrents:
+        with open(path, 'rb') as f:
+            datas.append(f.read())
+    return datas
+
+
+def plain(value):
+    """ views as bytes, for comparing with what bcoding decodes """
+
+    if isinstance(value, memoryview):
+        return bytes(value)
+    if isinstance(value, dict):
+        return {k: plain(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [plain(v) for v in value]
+    return value
+
+
+def check_against_bcoding(data, cache_dir=None):
+    expected = bdecode(data)
+    top, info, files, info_hash = metainfo.load(data, cache_dir)
+
+    assert plain(top) == {k: v for k, v in expected.items() if k != 'info'}
+    wanted_info = dict(expected['info'])
+    wanted_files = wanted_info.pop('files', None)
+    assert plain(info) == wanted_info
+    if wanted_files is None:
+        assert files is None
+    else:
+        assert files == [(tuple(f['path']), f['length']) for f in wanted_files]
+    assert info_hash == sha1(bencode(expected['info'])).digest()
+    assert metainfo.decode(data) == expected
+
+
+def test_fixtures_decode_like_bcoding(tmp_path):
+    for data in fixtures(str(tmp_path)):
+        check_against_bcoding(data)
+
+
+def test_fixtures_from_the_cache_decode_like_bcoding(tmp_path):
+    cache = str(tmp_path / 'cache')
+    for data in fixtures(str(tmp_path)):
+        check_against_bcoding(data, cache)
+        # the second time it comes out of the cache
+        check_against_bcoding(data, cache)
+    # the multi file torrent and the one with tiers share their info dict
+    assert len(os.listdir(cache)) == 3
+
+
+def test_values_decode_like_bcoding():
+    for value in [0, -7, 2**70, b'', 'text', 'café', b'\xff\xfe', [], {},
+                  [1, [2, [b'\x00']], {'k': []}],
+                  {'a': {'b': {'c': -1}}, 'z': [b'\x80' * 30, '']}]:
+        data = bencode(value)
+        assert metainfo.decode(data) == bdecode(data)
+
+
+PIECES = b'6:pieces40:' + bytes(range(40))
+INFO = b'd6:lengthi300e4:name3:abc12:piece lengthi256e' + PIECES + b'e'
+UNSORTED_INFO = b'd12:piece lengthi256e4:name3:abc6:lengthi300e' + PIECES + b'e'
+PADDED_INFO = b'd6:lengthi0300e4:name3:abc12:piece lengthi256e' + PIECES + b'e'
+
+
+@pytest.mark.parametrize('data, raw_info', [
+    # keys out of order
+    (b'd4:info' + UNSORTED_INFO + b'8:announce5:http:e', UNSORTED_INFO),
+    # info not last, and keys after it
+    (b'd8:announce5:http:4:info' + UNSORTED_INFO + b'7:comment2:hie', UNSORTED_INFO),
+    # an integer with a leading zero
+    (b'd4:info' + PADDED_INFO + b'e', PADDED_INFO),
+])
+def test_info_hash_covers_the_bytes_as_they_are(data, raw_info, tmp_path):
+    top, info, files, info_hash = metainfo.load(data)
+    assert info_hash == sha1(raw_info).digest()
+    # re-encoding what bcoding decodes gives the hash of some other torrent
+    assert info_hash != sha1(bencode(bdecode(data)['info'])).digest()
+    assert info['length'] == 300 and bytes(info['pieces']) == bytes(range(40))
+    # and the cache hands back the same
+    for _ in range(2):
+        assert metainfo.load(data, str(tmp_path))[3] == info_hash
+
+
+def test_canonical_info_hashes_like_bcoding():
+    data = b'd8:announce5:http:4:info' + INFO + b'e'
+    assert metainfo.load(data)[3] == sha1(INFO).digest() == sha1(bencode(bdecode(data)['info'])).digest()
+
+
+@pytest.mark.parametrize('data', [
+    b'',
+    b'l4:infoe',
+    b'd8:announce5:http:e',
+    b'd4:infoi1ee',
+    b'd4:infod4:name3:abcee',
+    b'd4:infod6:pieces40:' + bytes(10),
+    b'd4:infod6:pieces99:' + bytes(40) + b'ee',
+    b'd4:infod6:pieces40:' + bytes(40) + b'5:filesl',
+    b'd4:infod6:piecesx:ee',
+])
+def test_malformed_torrent_is_a_value_error(data):
+    with pytest.raises(ValueError):
+        metainfo.load(data)
+
+
+@pytest.mark.parametrize('data', [b'', b'i12', b'5:abc', b'l1:a', b'd1:ai1e', b'ix e'])
+def test_malformed_value_is_a_value_error(data):
+    with pytest.raises(ValueError):
+        metainfo.decode(data)
+
+
+def test_piece_hashes():
+    hashes = metainfo.PieceHashes(bytes(range(60)))
+    assert len(hashes) == 3
+    assert bytes(hashes[1]) == bytes(range(20, 40))
+    with pytest.raises(IndexError):
+        hashes[3]
+    with pytest.raises(ValueError):
+        metainfo.PieceHashes(bytes(30))
@@ -0,0 +1,141 @@
+import random
+
+from bittorrent.utils import Pieces
+from bittorrent.picker import PiecePicker, SKIP, NORMAL
+from bittorrent.bitfield import Bitfield
+from benchmarks.swarm import SyntheticTorrent
+
+
+def new_picker(pieces_count, piece_length=2**16):
+    torrent = SyntheticTorrent(pieces_count * piece_length, piece_length=piece_length)
+    pieces = Pieces(torrent)
+    picker = PiecePicker(torrent, pieces, random_first=0)
+    return torrent, pieces, picker
+
+
+def bitfield_of(length, indexes):
+    bitfield = Bitfield(length)
+    for index in indexes:
+        bitfield.add(index)
+    return bitfield
+
+
+def everything(torrent):
+    have = Bitfield(torrent.number_of_pieces)
+    for index in range(torrent.number_of_pieces):
+        have.add(index)
+    return have
+
+
+def test_released_blocks_that_arrive_anyway():
+    torrent, pieces, picker = new_picker(2)
+    peer_has = everything(torrent)
+    picker.peer_has_pieces(peer_has)
+
+    blocks = [picker.pick(peer_has) for _ in range(torrent.blocks_per_piece(0))]
+    index = blocks[0]['index']
+    # the peer is given up on, then its blocks come in after all
+    for block in blocks:
+        pieces.remove_requested(block)
+        picker.block_released(block)
+    assert index in picker.partial
+    for block in blocks:
+        pieces.add_received(dict(block, payload=bytes(block['request_length'])))
+
+    block = picker.pick(peer_has)
+    assert block['index'] != index
+    assert index not in picker.partial
+
+
+def test_peer_with_nothing_unstarted():
+    torrent, pieces, picker = new_picker(16)
+    others, peer_has = Bitfield(16), Bitfield(16)
+    for index in range(16):
+        (peer_has if index < 8 else others).add(index)
+    picker.peer_has_pieces(Bitfield.full(16))
+
+    started = [picker.pick(peer_has)['index'] for _ in range(8 * torrent.blocks_per_piece(0))]
+    assert sorted(set(started)) == list(range(8))
+    assert picker.pick(peer_has) is None
+    assert picker.pick(others)['index'] >= 8
+
+    pieces.discard_piece(3)
+    picker.piece_failed(3)
+    assert picker.pick(peer_has)['index'] == 3
+
+
+def test_buckets_follow_the_peers():
+    rng = random.Random(0)
+    torrent, pieces, picker = new_picker(300)
+    n = torrent.number_of_pieces
+    peers = []
+    for step in range(400):
+        action = rng.random()
+        if action < 0.2 or not peers:
+            have = Bitfield(n)
+            for index in rng.sample(range(n), rng.randrange(2, n)):
+                have.add(index)
+            picker.peer_has_pieces(have)
+            peers.append(have)
+        elif action < 0.35:
+            picker.peer_lost(peers.pop(rng.randrange(len(peers))))
+        elif action < 0.6:
+            have = rng.choice(peers)
+            index = rng.randrange(n)
+            if index not in have:
+                have.add(index)
+                picker.peer_has(index)
+        elif action < 0.7:
+            picker.set_priority(rng.randrange(n), rng.choice([SKIP, NORMAL]))
+        elif action < 0.75:
+            picker.piece_done(rng.randrange(n))
+        elif action < 0.8:
+            picker.seed_joined()
+        elif action < 0.85 and picker.seeds:
+            picker.seed_left()
+
+        availability = [sum(index in have for have in peers) for index in range(n)]
+        assert list(picker.availability) == availability
+        for a, bucket in enumerate(picker.buckets):
+            assert all(availability[index] == a for index in bucket)
+        assert sum(len(bucket) for bucket in picker.buckets) == len(picker.fresh)
+
+        if picker.seeds and rng.random() < 0.3:
+            peer_has = Bitfield.full(n)
+        elif peers:
+            peer_has = rng.choice(peers)
+        else:
+            continue
+        index = picker._pick_rarest(peer_has)
+        candidates = [i for i in peer_has if picker._fresh(i)]
+        if not candidates:
+            assert index is None
+        else:
+            assert index in candidates
+            assert availability[index] == min(availability[i] for i in candidates)
+
+
+def test_highest_priority_first_then_the_rarest():
+    torrent, pieces, picker = new_picker(64)
+    n = torrent.number_of_pieces
+    peer_has = Bitfield.full(n)
+    picker.peer_has_pieces(peer_has)
+    picker.peer_has_pieces(bitfield_of(n, [10, 20, 40]))
+    for index in (10, 11, 20, 21):
+        picker.set_priority(index, 2)
+    picker.set_priority(40, 3)
+    picker.set_priority(41, 3)
+
+    # 41 is rarer than 40, and 11 and 21 are rarer than 10 and 20
+    assert picker.pick(peer_has)['index'] == 41
+    assert picker._pick_prioritized(peer_has) == 40
+    picker.set_priority(40, NORMAL)
+    assert picker._pick_prioritized(peer_has) in (11, 21)
+    picker.piece_done(11)
+    picker.piece_done(21)
+    assert picker._pick_prioritized(peer_has) in (10, 20)
+    picker.piece_done(10)
+    picker.piece_done(20)
+    picker.piece_done(41)
+    assert picker._pick_prioritized(peer_has) is None
+    assert picker.prioritized == {}
@@ -0,0 +1,148 @@
+import struct
+import asyncio
+
+import pytest
+
+from bittorrent.protocol import (PeerProtocol, HANDSHAKE_LENGTH, MAX_MESSAGE_LENGTH,
+                                 MAX_QUEUED_MESSAGES, MIN_FREE)
+
+HANDSHAKE = bytes([19]) + b'BitTorrent protocol' + bytes(8) + b'i' * 20 + b'p' * 20
+
+
+class Transport():
+    def __init__(self):
+        self.closed = False
+        self.paused = False
+
+    def close(self):
+        self.closed = True
+
+    def pause_reading(self):
+        self.paused = True
+
+    def resume_reading(self):
+        self.paused = False
+
+
+def message(message_id, payload=b''):
+    return struct.pack('!IB', len(payload) + 1, message_id) + payload
+
+
+def keep_alive():
+    return bytes(4)
+
+
+def new_protocol(buffer_size=2**16):
+    protocol = PeerProtocol(None, buffer_size=buffer_size)
+    protocol.connection_made(Transport())
+    return protocol
+
+
+def feed(protocol, data, chunk=None):
+    """ hand `data` over like the loop would, at most `chunk` bytes per call """
+
+    data = memoryview(data)
+    while data:
+        buffer = protocol.get_buffer(-1)
+        n = min(len(buffer), len(data), chunk or len(data))
+        buffer[:n] = data[:n]
+        protocol.buffer_updated(n)
+        data = data[n:]
+
+
+def drain(protocol):
+    """ every complete message so far, payloads copied """
+
+    messages = []
+    while True:
+        m = protocol.next_message()
+        if m is None:
+            return messages
+        message_id, payload = m
+        messages.append((message_id, None if payload is None else bytes(payload)))
+
+
+def test_handshake_then_messages_in_one_chunk():
+    protocol = new_protocol()
+    feed(protocol, HANDSHAKE + message(2) + message(4, struct.pack('!I', 7)) + keep_alive())
+    assert protocol.handshake == HANDSHAKE
+    assert drain(protocol) == [(2, b''), (4, struct.pack('!I', 7)), (None, None)]
+
+
+@pytest.mark.parametrize('chunk', [1, 3, 5, 4099])
+def test_messages_split_across_reads(chunk):
+    payloads = [bytes([i]) * (i * 1000) for i in range(1, 10)]
+    data = HANDSHAKE + b''.join(message(7, p) for p in payloads)
+    protocol = new_protocol()
+    received = []
+    for start in range(0, len(data), chunk):
+        feed(protocol, data[start:start + chunk])
+        received += drain(protocol)
+        if start + chunk < HANDSHAKE_LENGTH:
+            assert protocol.handshake is None
+    assert protocol.handshake == HANDSHAKE
+    assert received == [(7, p) for p in payloads]
+
+
+def test_message_bigger_than_the_buffer_grows_it():
+    protocol = new_protocol(buffer_size=MIN_FREE * 2)
+    big = bytes(range(256)) * (MIN_FREE // 64)
+    feed(protocol, HANDSHAKE + message(7, big) + message(1), chunk=1000)
+    assert len(protocol.buffer) >= len(big) + 5
+    assert drain(protocol) == [(7, big), (1, b'')]
+
+
+def test_payload_handed_out_survives_until_the_next_read():
+    protocol = new_protocol(buffer_size=MIN_FREE * 2)
+    first = b'a' * (MIN_FREE + 100)
+    second = message(7, b'b' * 10)
+    feed(protocol, HANDSHAKE + message(7, first) + second[:8])
+    message_id, payload = protocol.next_message()
+    buffer = protocol.buffer
+    # the rest arrives while the caller still holds on to `payload`,
+    # which makes the protocol move the unread data to the front
+    feed(protocol, second[8:] + message(7, b'c' * MIN_FREE))
+    assert protocol.buffer is not buffer
+    assert bytes(payload) == first
+    assert drain(protocol) == [(7, b'b' * 10), (7, b'c' * MIN_FREE)]
+
+
+def test_oversized_length_prefix_drops_the_connection():
+    protocol = new_protocol()
+    feed(protocol, HANDSHAKE + message(2) + struct.pack('!I', MAX_MESSAGE_LENGTH + 1) + b'x' * 10)
+    assert protocol.transport.closed
+    # what came before it is still delivered, nothing after it
+    assert drain(protocol) == [(2, b'')]
+
+    protocol = new_protocol()
+    feed(protocol, HANDSHAKE + struct.pack('!IB', MAX_MESSAGE_LENGTH, 7))
+    assert not protocol.transport.closed
+
+
+def test_reading_pauses_while_too_many_messages_wait():
+    protocol = new_protocol()
+    feed(protocol, HANDSHAKE + keep_alive() * (MAX_QUEUED_MESSAGES + 1))
+    assert protocol.transport.paused
+    while len(protocol.frames) >= MAX_QUEUED_MESSAGES // 2:
+        assert protocol.transport.paused
+        protocol.next_message()
+    assert not protocol.transport.paused
+
+
+def test_read_message_waits_for_a_whole_message():
+    loop = asyncio.new_event_loop()
+    protocol = PeerProtocol(loop)
+    protocol.connection_made(Transport())
+
+    async def read():
+        handshake = await protocol.read_handshake()
+        message_id, payload = await protocol.read_message()
+        return handshake, message_id, bytes(payload), await protocol.read_message()
+
+    data = HANDSHAKE + message(5, b'\xff\x00')
+    task = loop.create_task(read())
+    for i in range(len(data)):
+        loop.call_soon(feed, protocol, data[i:i + 1])
+    loop.call_soon(protocol.connection_lost, None)
+    assert loop.run_until_complete(task) == (HANDSHAKE, 5, b'\xff\x00', None)
+    loop.close()
@@ -0,0 +1,123 @@
+import heapq
+import asyncio
+
+import pytest
+
+from bittorrent.ratelimit import TokenBucket, Throttle
+from bittorrent.uploader import Uploader
+from bittorrent.peer import Peer
+from benchmarks.swarm import SyntheticTorrent
+
+BLOCK = 2**14
+
+
+class SimulatedClock():
+    """ time that only moves on `advance`, futures from a real event loop """
+
+    class Handle():
+        def __init__(self):
+            self.cancelled = False
+
+        def cancel(self):
+            self.cancelled = True
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.now = 0.0
+        self.timers = []
+        self.sequence = 0
+
+    def time(self):
+        return self.now
+
+    def call_later(self, delay, callback, *args):
+        handle = self.Handle()
+        self.sequence += 1
+        heapq.heappush(self.timers, (self.now + delay, self.sequence, handle, callback, args))
+        return handle
+
+    def create_future(self):
+        return self.loop.create_future()
+
+    def advance(self, seconds):
+        end = self.now + seconds
+        while self.timers and self.timers[0][0] <= end:
+            when, _, handle, callback, args = heapq.heappop(self.timers)
+            self.now = when
+            if not handle.cancelled:
+                callback(*args)
+        self.now = end
+
+
+def settle(loop):
+    """ let every task that can run, run """
+
+    for _ in range(10):
+        loop.run_until_complete(asyncio.sleep(0))
+
+
+def test_acquire_waits_until_the_debt_is_paid():
+    loop = asyncio.new_event_loop()
+    clock = SimulatedClock(loop)
+    throttle = Throttle(clock, [TokenBucket(clock, rate=BLOCK, burst=BLOCK)])
+    loop.run_until_complete(throttle.acquire(BLOCK))
+    # what is saved up is spent, this one puts the bucket in debt
+    loop.run_until_complete(throttle.acquire(BLOCK))
+
+    third = loop.create_task(throttle.acquire(BLOCK))
+    settle(loop)
+    clock.advance(0.9)
+    settle(loop)
+    assert not third.done()
+    clock.advance(0.2)
+    settle(loop)
+    assert third.done() and third.exception() is None
+    loop.close()
+
+
+def test_close_wakes_a_waiting_acquire():
+    loop = asyncio.new_event_loop()
+    clock = SimulatedClock(loop)
+    bucket = TokenBucket(clock, rate=BLOCK, burst=BLOCK)
+    bucket.take(10 * BLOCK)
+    throttle = Throttle(clock, [bucket])
+
+    waiting = loop.create_task(throttle.acquire(BLOCK))
+    settle(loop)
+    assert not waiting.done()
+    throttle.close()
+    settle(loop)
+    assert isinstance(waiting.exception(), ConnectionError)
+    with pytest.raises(ConnectionError):
+        loop.run_until_complete(throttle.acquire(BLOCK))
+    # the bucket paying off its debt later finds nothing to do
+    clock.advance(60)
+    loop.close()
+
+
+def test_uploader_lets_go_of_a_closed_peer():
+    loop = asyncio.new_event_loop()
+    clock = SimulatedClock(loop)
+    torrent = SyntheticTorrent(4 * 2**16, piece_length=2**16)
+    bucket = TokenBucket(clock, rate=BLOCK, burst=BLOCK)
+    bucket.take(10 * BLOCK)
+    uploader = Uploader(loop, torrent, None, bytearray([1]) * torrent.number_of_pieces, None)
+    peer = Peer('10.0.0.1', 6881, torrent)
+    peer.am_choking = False
+    peer.upload_throttle = Throttle(clock, [bucket])
+
+    async def scenario():
+        uploader.request(peer, 0, 0, BLOCK)
+        for _ in range(3):
+            await asyncio.sleep(0)
+        assert peer.uploading
+        peer.upload_throttle.close()
+        for _ in range(3):
+            await asyncio.sleep(0)
+        assert not peer.uploading
+        assert len(peer.upload_requests) == 0
+        others = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        assert others == []
+
+    loop.run_until_complete(scenario())
+    loop.close()
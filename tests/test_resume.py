@@ -0,0 +1,53 @@
+import os
+
+import pytest
+from bcoding import bencode
+
+from bittorrent.resume import ResumeData
+from bittorrent.file_manager import FileManager
+from benchmarks.swarm import SyntheticTorrent
+
+
+@pytest.fixture
+def resume(tmp_path):
+    torrent = SyntheticTorrent(10 * 2**16, piece_length=2**16, files=2)
+    torrent.info_hash = bytes(range(20))
+    file_manager = FileManager(torrent, str(tmp_path))
+    yield ResumeData(torrent, file_manager, str(tmp_path))
+    file_manager.close()
+
+
+def test_saved_state_loads(resume):
+    verified = bytearray(10)
+    verified[0] = verified[3] = verified[9] = 1
+    resume.save(verified)
+    assert resume.load() == [0, 3, 9]
+
+
+@pytest.mark.parametrize('state', [
+    b'not bencoded at all',
+    bencode([1, 2, 3]),
+    bencode({'info_hash': bytes(range(20)), 'files': []}),
+    bencode({'info_hash': bytes(range(20)), 'bitfield': b'\xff\xc0'}),
+    bencode({'info_hash': bytes(range(20)), 'bitfield': 7, 'files': []}),
+    bencode({'info_hash': bytes(range(20)), 'bitfield': b'\xff\xc0', 'files': [1, 2]}),
+    bencode({'info_hash': bytes(range(20)), 'bitfield': b'\xff', 'files': []}),
+])
+def test_damaged_state_means_a_recheck(resume, state):
+    resume.save(bytearray(10))
+    with open(resume.path, 'wb') as f:
+        f.write(state)
+    assert resume.load() is None
+
+
+def test_maybe_save_only_saves_what_changed(resume):
+    verified = bytearray(10)
+    resume.maybe_save(verified)
+    # the first time there is nothing on disk to keep
+    assert resume.load() == []
+    os.remove(resume.path)
+    resume.maybe_save(verified)
+    assert not os.path.exists(resume.path)
+    verified[4] = 1
+    resume.maybe_save(verified)
+    assert resume.load() == [4]
@@ -0,0 +1,120 @@
+import os
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from bittorrent.session import Session
+from benchmarks.swarm import make_torrent
+
+PIECE_LENGTH = 2**16
+
+
+class CountingExecutor(ThreadPoolExecutor):
+    submitted = 0
+
+    def submit(self, *args, **kwargs):
+        self.submitted += 1
+        return super().submit(*args, **kwargs)
+
+
+def write_files(destination, content, files=4):
+    directory = os.path.join(destination, 'bench')
+    os.makedirs(directory)
+    length = len(content) // files
+    for i in range(files):
+        end = len(content) if i == files - 1 else (i + 1) * length
+        with open(os.path.join(directory, 'file{}'.format(i)), 'wb') as f:
+            f.write(content[i * length:end])
+
+
+def test_recheck_runs_on_the_session_hash_pool_without_blocking_the_loop(tmp_path):
+    loop = asyncio.new_event_loop()
+    content = os.urandom(64 * PIECE_LENGTH)
+    path = make_torrent(str(tmp_path), 'http://127.0.0.1:1/announce', content, PIECE_LENGTH)
+    destination = str(tmp_path / 'download')
+    write_files(destination, content)
+
+    session = Session(loop, port=0, hash_workers=2)
+    session.hash_executor.shutdown()
+    session.hash_executor = CountingExecutor(2)
+    client = session.add_torrent(path, destination)
+    # nothing is hashed while the torrent is added
+    assert client.checking
+    assert client.pieces_downloaded == []
+    assert session.hash_executor.submitted == 0
+
+    ticks = []
+
+    async def ticker():
+        while client.checking:
+            ticks.append(loop.time())
+            await asyncio.sleep(0)
+
+    async def scenario():
+        await asyncio.gather(client._recheck(), ticker())
+
+    loop.run_until_complete(scenario())
+    assert not client.checking
+    assert sorted(client.pieces_downloaded) == list(range(64))
+    assert session.hash_executor.submitted == 64
+    assert len(ticks) > 1
+    client.close()
+    session.disk.close()
+    session.hash_executor.shutdown()
+    loop.close()
+
+
+def test_duplicate_torrent_is_refused_before_it_touches_the_files(tmp_path):
+    loop = asyncio.new_event_loop()
+    content = os.urandom(8 * PIECE_LENGTH)
+    path = make_torrent(str(tmp_path), 'http://127.0.0.1:1/announce', content, PIECE_LENGTH)
+    destination = str(tmp_path / 'download')
+    write_files(destination, content)
+    elsewhere = tmp_path / 'elsewhere'
+    elsewhere.mkdir()
+
+    session = Session(loop, port=0)
+    client = session.add_torrent(path, destination)
+    with pytest.raises(ValueError):
+        session.add_torrent(path, str(elsewhere))
+    # no files made or opened for the torrent that was turned down
+    assert os.listdir(str(elsewhere)) == []
+    assert list(session.torrents.values()) == [client]
+    loop.run_until_complete(session.stop())
+    loop.close()
+
+
+class SlowFiles():
+    """ a file manager whose writes take a while """
+
+    def __init__(self):
+        self.written = []
+
+    def write(self, piece_index, data):
+        time.sleep(0.05)
+        self.written.append(piece_index)
+
+
+def test_stop_waits_for_the_disk_without_blocking_the_loop(tmp_path):
+    loop = asyncio.new_event_loop()
+    session = Session(loop, port=0, io_workers=1)
+    files = SlowFiles()
+    writes = [session.disk.write(files, i, b'') for i in range(6)]
+    ticks = []
+
+    async def ticker():
+        while not all(w.done() for w in writes):
+            ticks.append(loop.time())
+            await asyncio.sleep(0.01)
+
+    async def scenario():
+        await asyncio.gather(session.stop(), ticker())
+
+    loop.run_until_complete(scenario())
+    assert sorted(files.written) == list(range(6))
+    # the loop went on while the writes were done
+    assert len(ticks) > 5
+    assert session.disk.unwritten == {}
+    loop.close()
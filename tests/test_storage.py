@@ -0,0 +1,126 @@
+import os
+from hashlib import sha1
+
+from bittorrent.utils import Pieces
+from bittorrent.file_manager import FileManager
+from benchmarks.swarm import SyntheticTorrent
+
+
+def block(torrent, content, index, begin, data=None):
+    start = index * torrent.standard_piece_length + begin
+    if data is None:
+        data = content[start:start + torrent.REQUEST_LENGTH]
+    return {'index': index, 'begin_offset': begin,
+            'request_length': len(data), 'payload': memoryview(data)}
+
+
+def on_disk(file_manager, index, begin, length):
+    return b''.join(bytes(chunk) for chunk in file_manager.read(index, begin, length))
+
+
+def request_piece(pieces, index):
+    """ what the picker does before it asks for a piece """
+
+    assert pieces.reserve(index)
+    while True:
+        requested = pieces.next_block(index)
+        if requested is None:
+            return
+        pieces.add_requested(requested)
+
+
+def receive_piece(torrent, content, pieces, index):
+    request_piece(pieces, index)
+    result = None
+    for i in range(torrent.blocks_per_piece(index)):
+        result = pieces.add_received(block(torrent, content, index, i * torrent.REQUEST_LENGTH))
+    return result
+
+
+def test_repeated_block_does_not_overwrite_a_verified_piece(tmp_path):
+    torrent = SyntheticTorrent(4 * 2**16, piece_length=2**16, files=2)
+    content = os.urandom(torrent.total_length)
+    file_manager = FileManager(torrent, str(tmp_path), storage='mmap')
+    pieces = Pieces(torrent, store_blocks=False, write_block=file_manager.write_block)
+    try:
+        assert receive_piece(torrent, content, pieces, 0) == (0, None)
+        assert file_manager.hash_piece(0) == sha1(content[:torrent.piece_length(0)]).digest()
+        pieces.release_piece(0)
+
+        garbage = bytes(torrent.REQUEST_LENGTH)
+        assert pieces.add_received(block(torrent, content, 0, 0, garbage)) == (None, None)
+        assert on_disk(file_manager, 0, 0, torrent.REQUEST_LENGTH) == content[:torrent.REQUEST_LENGTH]
+    finally:
+        file_manager.close()
+
+
+def test_repeated_block_does_not_change_a_piece_being_hashed(tmp_path):
+    torrent = SyntheticTorrent(2 * 2**16, piece_length=2**16)
+    content = os.urandom(torrent.total_length)
+    file_manager = FileManager(torrent, str(tmp_path), storage='mmap')
+    pieces = Pieces(torrent, store_blocks=False, write_block=file_manager.write_block)
+    try:
+        request_piece(pieces, 1)
+        for i in range(torrent.blocks_per_piece(1) - 1):
+            pieces.add_received(block(torrent, content, 1, i * torrent.REQUEST_LENGTH))
+        last = (torrent.blocks_per_piece(1) - 1) * torrent.REQUEST_LENGTH
+        assert pieces.add_received(block(torrent, content, 1, last)) == (1, None)
+
+        # the piece is complete and waiting for its hash check
+        before = on_disk(file_manager, 1, 0, torrent.piece_length(1))
+        pieces.add_received(block(torrent, content, 1, last, bytes(torrent.REQUEST_LENGTH)))
+        assert on_disk(file_manager, 1, 0, torrent.piece_length(1)) == before
+    finally:
+        file_manager.close()
+
+
+def test_blocks_of_a_piece_we_never_started_are_dropped():
+    torrent = SyntheticTorrent(4 * 2**16, piece_length=2**16)
+    content = os.urandom(torrent.total_length)
+    pieces = Pieces(torrent, max_buffer_bytes=2 * 2**16)
+    for index in range(torrent.number_of_pieces):
+        assert pieces.add_received(block(torrent, content, index, 0)) == (None, None)
+    assert pieces.pool.in_use == 0
+    assert len(pieces) == 0
+    assert pieces.state == bytearray(len(pieces.state))
+
+    # a block we released comes in anyway while the piece is under way
+    request_piece(pieces, 2)
+    pieces.remove_requested(block(torrent, content, 2, 0))
+    assert pieces.add_received(block(torrent, content, 2, 0)) == (None, None)
+    assert pieces.received[2] == 1
+
+
+def test_block_that_is_not_one_of_ours_leaves_storage_alone(tmp_path):
+    torrent = SyntheticTorrent(4 * 2**16, piece_length=2**16)
+    content = os.urandom(torrent.total_length)
+    file_manager = FileManager(torrent, str(tmp_path), storage='mmap')
+    pieces = Pieces(torrent, store_blocks=False, write_block=file_manager.write_block)
+    try:
+        assert receive_piece(torrent, content, pieces, 1) == (1, None)
+        request_piece(pieces, 0)
+        last = torrent.piece_length(0) - torrent.REQUEST_LENGTH
+        bad = [
+            (0, last, bytes(2 * torrent.REQUEST_LENGTH)), # runs on into piece 1
+            (0, 100, bytes(torrent.REQUEST_LENGTH)),      # not where a block starts
+            (0, 0, bytes(100)),                           # short
+            (0, torrent.piece_length(0), bytes(torrent.REQUEST_LENGTH)), # past the piece
+        ]
+        for index, begin, data in bad:
+            assert pieces.add_received(block(torrent, content, index, begin, data)) == (None, None)
+        assert pieces.received[0] == 0
+        assert on_disk(file_manager, 1, 0, torrent.piece_length(1)) == content[2**16:2 * 2**16]
+    finally:
+        file_manager.close()
+
+
+def test_block_that_is_not_one_of_ours_leaves_the_piece_buffer_alone():
+    torrent = SyntheticTorrent(4 * 2**16, piece_length=2**16)
+    content = os.urandom(torrent.total_length)
+    pieces = Pieces(torrent)
+    request_piece(pieces, 0)
+    last = torrent.piece_length(0) - torrent.REQUEST_LENGTH
+    # sliced into the buffer these would have raised ValueError
+    assert pieces.add_received(block(torrent, content, 0, last, bytes(20000))) == (None, None)
+    assert pieces.add_received(block(torrent, content, 0, last + 8, bytes(100))) == (None, None)
+    assert pieces.received[0] == 0
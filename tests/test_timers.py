@@ -0,0 +1,153 @@
+import pytest
+
+from bittorrent.timers import TimerWheel
+
+
+class Loop():
+    """ just enough of an event loop for the wheel, time moves on `run_until` """
+
+    class Handle():
+        def __init__(self, when, callback):
+            self.when = when
+            self.callback = callback
+            self.cancelled = False
+
+        def cancel(self):
+            self.cancelled = True
+
+    def __init__(self):
+        self.now = 0.0
+        self.handles = []
+
+    def time(self):
+        return self.now
+
+    def call_at(self, when, callback):
+        handle = self.Handle(when, callback)
+        self.handles.append(handle)
+        return handle
+
+    def run_until(self, when):
+        while True:
+            due = [h for h in self.handles if not h.cancelled and h.when <= when]
+            if not due:
+                break
+            handle = min(due, key=lambda h: h.when)
+            self.handles.remove(handle)
+            self.now = handle.when
+            handle.callback()
+        self.now = when
+
+
+def ticks_until_fired(wheel, fired, limit):
+    for tick in range(1, limit + 1):
+        wheel.advance()
+        if fired:
+            return tick
+    return None
+
+
+@pytest.mark.parametrize('delay, ticks', [(0, 1), (0.2, 1), (1, 1), (1.5, 2), (7, 7)])
+def test_fires_on_the_tick_it_is_due(delay, ticks):
+    wheel = TimerWheel(None, tick=1.0, slots=16)
+    fired = []
+    wheel.call_later(delay, fired.append, 'x')
+    assert ticks_until_fired(wheel, fired, 100) == ticks
+    assert fired == ['x']
+
+
+@pytest.mark.parametrize('delay', [16, 17, 40, 16 * 5 + 3])
+def test_delays_longer_than_a_turn_wrap_around(delay):
+    wheel = TimerWheel(None, tick=1.0, slots=16)
+    # start somewhere in the middle of the wheel
+    for _ in range(5):
+        wheel.advance()
+    fired = []
+    wheel.call_later(delay, fired.append, delay)
+    assert ticks_until_fired(wheel, fired, 200) == delay
+    assert fired == [delay]
+
+
+def test_tick_length_scales_the_delay():
+    wheel = TimerWheel(None, tick=0.5, slots=8)
+    fired = []
+    wheel.call_later(3, fired.append, 1)
+    assert ticks_until_fired(wheel, fired, 100) == 6
+
+
+def test_cancelled_timer_never_fires():
+    wheel = TimerWheel(None, tick=1.0, slots=16)
+    fired = []
+    wheel.call_later(3, fired.append, 'kept')
+    dropped = wheel.call_later(3, fired.append, 'dropped')
+    wheel.call_later(20, fired.append, 'late')
+    dropped.cancel()
+    for _ in range(40):
+        wheel.advance()
+    assert fired == ['kept', 'late']
+    # dropped from the wheel when its slot came around
+    assert sum(len(slot) for slot in wheel.wheel) == 0
+
+
+def test_repeating_timer_until_cancelled():
+    wheel = TimerWheel(None, tick=1.0, slots=16)
+    fired = []
+    timer = wheel.every(5, lambda: fired.append(wheel.position))
+    for _ in range(40):
+        wheel.advance()
+    # the slot just handled, 5 ticks apart, around the wheel more than once
+    assert [(p - 1) % 16 for p in fired] == [(5 * i - 1) % 16 for i in range(1, 9)]
+    timer.cancel()
+    for _ in range(40):
+        wheel.advance()
+    assert len(fired) == 8
+
+
+def test_repeating_timer_can_cancel_itself():
+    wheel = TimerWheel(None, tick=1.0, slots=16)
+    fired = []
+
+    def once():
+        fired.append(1)
+        timer.cancel()
+
+    timer = wheel.every(2, once)
+    for _ in range(10):
+        wheel.advance()
+    assert fired == [1]
+
+
+def test_failing_callback_does_not_stop_the_others():
+    wheel = TimerWheel(None, tick=1.0, slots=16)
+    fired = []
+    wheel.call_later(1, lambda: 1 / 0)
+    wheel.every(1, fired.append, 'every')
+    wheel.call_later(1, fired.append, 'once')
+    wheel.advance()
+    wheel.advance()
+    assert fired == ['every', 'once', 'every']
+
+
+def test_timer_added_while_firing_waits_a_tick():
+    wheel = TimerWheel(None, tick=1.0, slots=16)
+    fired = []
+    wheel.call_later(1, lambda: wheel.call_later(0, fired.append, 'next'))
+    wheel.advance()
+    assert fired == []
+    wheel.advance()
+    assert fired == ['next']
+
+
+def test_runs_off_the_loop_clock():
+    loop = Loop()
+    wheel = TimerWheel(loop, tick=1.0, slots=16)
+    fired = []
+    wheel.call_later(2.5, lambda: fired.append(loop.time()))
+    wheel.every(10, lambda: fired.append(loop.time()))
+    wheel.start()
+    wheel.start()
+    loop.run_until(25)
+    assert fired == [3.0, 10.0, 20.0]
+    wheel.stop()
+    loop.run_until(100)
+    assert fired == [3.0, 10.0, 20.0]
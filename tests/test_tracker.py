@@ -0,0 +1,212 @@
+import asyncio
+import struct
+
+import pytest
+
+from bittorrent.tracker import Announcer, Tracker, TrackerError, EVENTS
+from benchmarks.swarm import LocalTracker, LocalUdpTracker
+
+PEERS = [('127.0.0.{}'.format(i), 6881) for i in range(1, 6)]
+INTERVAL = 120
+EVENT_NAMES = {number: name for name, number in EVENTS.items()}
+
+
+class StubTorrent():
+    info_hash = bytes(20)
+    peer_id = '-AS0001-000000000000'
+
+    def __init__(self, tiers):
+        self.announce_tiers = tiers
+        self.announce_url = tiers[0][0]
+
+
+class ManualTimers():
+    """ keeps what the announcer schedules, for the test to fire """
+
+    class Handle():
+        def __init__(self, delay, callback, args):
+            self.delay = delay
+            self.callback = callback
+            self.args = args
+            self.cancelled = False
+
+        def cancel(self):
+            self.cancelled = True
+
+    def __init__(self):
+        self.handles = []
+
+    def call_later(self, delay, callback, *args):
+        handle = self.Handle(delay, callback, args)
+        self.handles.append(handle)
+        return handle
+
+    def pending(self):
+        return [h for h in self.handles if not h.cancelled]
+
+    def fire(self, handle):
+        self.handles.remove(handle)
+        handle.callback(*handle.args)
+
+
+def http_announces(tracker):
+    """ (event, uploaded, downloaded, left) of every announce so far """
+
+    return [(a.get('event'), int(a['uploaded']), int(a['downloaded']), int(a['left']))
+            for a in tracker.announces]
+
+
+def udp_announces(tracker):
+    return [(EVENT_NAMES[event], uploaded, downloaded, left)
+            for event, downloaded, left, uploaded in tracker.announces]
+
+
+def run_announcer(loop, url, announces):
+    timers = ManualTimers()
+    stats = [0, 0, 1000]
+    got = asyncio.Queue()
+    announcer = Announcer(loop, timers, StubTorrent([[url]]), lambda: tuple(stats), got.put_nowait)
+
+    async def next_peers():
+        return await asyncio.wait_for(got.get(), 5)
+
+    announcer.start()
+    # starting only schedules the announce, nothing has gone out yet
+    assert announces() == []
+    peers = loop.run_until_complete(next_peers())
+    assert sorted((p['hostname'], p['port']) for p in peers) == PEERS
+    assert announces() == [('started', 0, 0, 1000)]
+
+    # the next announce waits for the interval the tracker asked for
+    [reannounce] = timers.pending()
+    assert reannounce.delay == INTERVAL
+    stats[:] = [300, 700, 300]
+    timers.fire(reannounce)
+    loop.run_until_complete(next_peers())
+    assert announces()[-1] == (None, 300, 700, 300)
+    assert [h.delay for h in timers.pending()] == [INTERVAL]
+
+    stats[:] = [500, 1000, 0]
+    announcer.completed()
+    loop.run_until_complete(next_peers())
+    assert announces()[-1] == ('completed', 500, 1000, 0)
+
+    stats[:] = [800, 1000, 0]
+    loop.run_until_complete(announcer.stop())
+    assert announces()[-1] == ('stopped', 800, 1000, 0)
+    assert len(announces()) == 4
+    assert timers.pending() == []
+
+
+def test_announcer_over_http():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    with LocalTracker(PEERS, interval=INTERVAL) as tracker:
+        run_announcer(loop, tracker.url, lambda: http_announces(tracker))
+    loop.close()
+
+
+def test_announcer_over_udp():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    tracker = LocalUdpTracker(PEERS, interval=INTERVAL)
+    url = loop.run_until_complete(tracker.start())
+    run_announcer(loop, url, lambda: udp_announces(tracker))
+    # one connection id served every announce
+    assert tracker.connects == 1
+    tracker.stop()
+    loop.close()
+
+
+def test_udp_announce_retries_lost_packets():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    udp = LocalUdpTracker(PEERS, interval=INTERVAL, drop=2)
+    url = loop.run_until_complete(udp.start())
+    tracker = Tracker(StubTorrent([[url]]), loop, udp_timeout=0.01, udp_retries=3)
+    interval, peers = loop.run_until_complete(tracker.announce('started', 1, 2, 3))
+    assert interval == INTERVAL and len(peers) == len(PEERS)
+    assert udp_announces(udp) == [('started', 1, 2, 3)]
+
+    udp.drop = 10
+    # out of retries
+    with pytest.raises(TrackerError):
+        loop.run_until_complete(tracker.announce(None, 1, 2, 3))
+    tracker.close()
+    udp.stop()
+    loop.close()
+
+
+class ShortUdpTracker(asyncio.DatagramProtocol):
+    """ answers connects, and announces too once `connect` is whole, cut short """
+
+    def __init__(self, connect=12, announce=16):
+        self.connect = connect
+        self.announce = announce
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        action, transaction_id = struct.unpack_from('!II', data, 8)
+        answer = struct.pack('!IIQIIII', action, transaction_id, 42, INTERVAL, 0, 0, 0)
+        self.transport.sendto(answer[:self.connect if action == 0 else self.announce], addr)
+
+
+def short_udp_tracker(loop, **kwargs):
+    transport, protocol = loop.run_until_complete(loop.create_datagram_endpoint(
+            lambda: ShortUdpTracker(**kwargs), local_addr=('127.0.0.1', 0)))
+    return transport, 'udp://127.0.0.1:{}'.format(transport.get_extra_info('sockname')[1])
+
+
+@pytest.mark.parametrize('lengths', [
+    {'connect': 8}, {'connect': 15}, {'connect': 16, 'announce': 19}])
+def test_short_udp_answer_is_a_tracker_error(lengths):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    transport, url = short_udp_tracker(loop, **lengths)
+    tracker = Tracker(StubTorrent([[url]]), loop, udp_timeout=1, udp_retries=1)
+    with pytest.raises(TrackerError):
+        loop.run_until_complete(tracker.announce('started', 0, 0, 1000))
+    tracker.close()
+    transport.close()
+    loop.close()
+
+
+def test_tier_retries_after_a_short_udp_answer():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    transport, url = short_udp_tracker(loop)
+    timers = ManualTimers()
+    announcer = Announcer(loop, timers, StubTorrent([[url]]), lambda: (0, 0, 1000), lambda peers: None)
+    announcer.start()
+    [tier] = announcer.tiers
+
+    async def retry():
+        while not timers.pending():
+            await asyncio.sleep(0.01)
+        return timers.pending()
+
+    # the tier lives on and tries again later, still with `started`
+    [again] = loop.run_until_complete(asyncio.wait_for(retry(), 5))
+    assert again.args[-1] == 'started'
+    assert tier.trackers[0].failures == 1
+    loop.run_until_complete(announcer.stop())
+    transport.close()
+    loop.close()
+
+
+@pytest.mark.parametrize('response', [
+    {'interval': INTERVAL, 'peers': [b'junk']},
+    {'interval': INTERVAL, 'peers': [{'ip': '127.0.0.1'}]},
+    {'interval': INTERVAL, 'peers': 7},
+    {'interval': b'soon', 'peers': b''}])
+def test_malformed_http_answer_is_a_tracker_error(response):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    with LocalTracker(PEERS, response=response) as http:
+        tracker = Tracker(StubTorrent([[http.url]]), loop)
+        with pytest.raises(TrackerError):
+            loop.run_until_complete(tracker.announce('started', 0, 0, 1000))
+    loop.close()